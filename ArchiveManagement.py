@@ -0,0 +1,92 @@
+import os
+import re
+import json
+import zlib
+import struct
+from threading import Lock
+from collections import OrderedDict
+
+## Cold storage for memory contents which are rarely read. Records are appended to segment files and never rewritten;
+## each record is a 4 byte length followed by zlib compressed JSON. Where a record lives (segment, offset, length, and
+## checksum) is kept by the caller, so a record can be read back with one seek. Once the newest segment is past its size
+## limit the next append starts a new one. Recently read records are kept in a small LRU cache.
+
+_segment_name = re.compile(r"^segment_(\d+)\.seg$")
+_length_header = struct.Struct('>I')
+
+class ArchiveError(IOError):
+    pass
+
+class MemoryArchive:
+    def __init__(self, archive_dir, segment_max_bytes = 64 * 1024 * 1024, read_cache_size = 256, compression_level = 9):
+        self.__archive_dir = archive_dir
+        self.__segment_max_bytes = int(segment_max_bytes)
+        self.__read_cache_size = int(read_cache_size)
+        self.__compression_level = int(compression_level)
+        self.__read_cache = OrderedDict()
+        self.__lock = Lock()
+
+    @property
+    def archive_dir(self):
+        return self.__archive_dir
+
+    def __segment_path(self, segment):
+        return os.path.join(self.__archive_dir, segment)
+
+    ## The segment new records go to; a new one is started once the newest is full
+    def __active_segment(self):
+        os.makedirs(self.__archive_dir, exist_ok=True)
+        numbers = [int(m.group(1)) for m in (_segment_name.match(f) for f in os.listdir(self.__archive_dir)) if m is not None]
+        number = max(numbers) if len(numbers) > 0 else 1
+        segment = 'segment_%06i.seg' % number
+        if os.path.exists(self.__segment_path(segment)) and os.path.getsize(self.__segment_path(segment)) >= self.__segment_max_bytes:
+            segment = 'segment_%06i.seg' % (number + 1)
+        return segment
+
+    ## Append records (dictionaries with an 'id') and return where each was written, by id.
+    ## The data is flushed to disk before returning so the caller can safely drop its own copy.
+    def append(self, records):
+        locations = {}
+        with self.__lock:
+            segment = self.__active_segment()
+            with open(self.__segment_path(segment), 'ab') as segment_file:
+                offset = segment_file.tell()
+                for record in records:
+                    payload = zlib.compress(json.dumps(record).encode('utf-8'), self.__compression_level)
+                    segment_file.write(_length_header.pack(len(payload)))
+                    segment_file.write(payload)
+                    locations[record['id']] = {'segment': segment, 'offset': offset, 'length': len(payload), 'checksum': zlib.crc32(payload)}
+                    offset += _length_header.size + len(payload)
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+        return locations
+
+    ## Read records back given their locations (as returned by append), by id. Reads are grouped by segment and made in file order.
+    def read(self, locations):
+        records = {}
+        missing = {}
+        with self.__lock:
+            for record_id, location in locations.items():
+                if record_id in self.__read_cache:
+                    self.__read_cache.move_to_end(record_id)
+                    records[record_id] = self.__read_cache[record_id]
+                else:
+                    missing.setdefault(location['segment'], []).append((record_id, location))
+        for segment, segment_locations in missing.items():
+            with open(self.__segment_path(segment), 'rb') as segment_file:
+                for record_id, location in sorted(segment_locations, key=lambda l: int(l[1]['offset'])):
+                    segment_file.seek(int(location['offset']))
+                    header = segment_file.read(_length_header.size)
+                    if len(header) < _length_header.size or _length_header.unpack(header)[0] != int(location['length']):
+                        raise ArchiveError(f"Archived record {record_id} is not where its index says in {segment}")
+                    payload = segment_file.read(int(location['length']))
+                    if zlib.crc32(payload) != int(location['checksum']):
+                        raise ArchiveError(f"Archived record {record_id} in {segment} failed its checksum")
+                    records[record_id] = json.loads(zlib.decompress(payload).decode('utf-8'))
+        with self.__lock:
+            for segment_locations in missing.values():
+                for record_id, _ in segment_locations:
+                    self.__read_cache[record_id] = records[record_id]
+            while len(self.__read_cache) > self.__read_cache_size:
+                self.__read_cache.popitem(last=False)
+        return records
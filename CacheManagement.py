@@ -0,0 +1,177 @@
+import json
+import sqlite3
+import asyncio
+import hashlib
+from time import time
+from threading import Lock
+from concurrent.futures import Future
+
+## Completions made with deterministic settings (temperature 0) return the same text for the same request,
+## so their responses are stored in SQLite and reused. Entries expire after a time-to-live and the least
+## recently used entries are evicted once the cache grows past its maximum size.
+class ResponseCache:
+    def __init__(self, database_name, ttl_seconds, max_entries, enabled = True):
+        self.__database_name = database_name
+        self.__ttl_seconds = float(ttl_seconds)
+        self.__max_entries = int(max_entries)
+        self.__enabled = enabled
+        self.__lock = Lock()
+        self.__stats = {'hits': 0, 'misses': 0, 'stores': 0, 'expired': 0, 'evicted': 0}
+
+    @property
+    def enabled(self):
+        return self.__enabled
+
+    ## Copy of the hit counters since the cache was created
+    @property
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] / lookups) if lookups > 0 else 0.0
+        return stats
+
+    ## Only deterministic requests are cached
+    def is_cacheable(self, temperature):
+        return self.__enabled and float(temperature) == 0.0
+
+    ## Hash every setting which changes the response
+    def make_key(self, model, messages, temperature, max_tokens, stop):
+        key_source = json.dumps({
+            'model': model,
+            'messages': messages,
+            'temperature': float(temperature),
+            'max_tokens': int(max_tokens),
+            'stop': stop
+        }, sort_keys=True, ensure_ascii=True)
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+    def __count(self, stat, amount = 1):
+        with self.__lock:
+            self.__stats[stat] += amount
+
+    def __connect(self):
+        return sqlite3.connect(self.__database_name, timeout=30)
+
+    ## Return (response, tokens) for a cached request, or None if it is missing or expired
+    def get(self, cache_key):
+        now = time()
+        sqldb = self.__connect()
+        try:
+            row = sqldb.execute("select response, tokens, created_on from Completion_Cache where cache_key = ?", (cache_key,)).fetchone()
+            if row is None:
+                self.__count('misses')
+                return None
+            response, tokens, created_on = row
+            if self.__ttl_seconds > 0 and now - float(created_on) > self.__ttl_seconds:
+                sqldb.execute("delete from Completion_Cache where cache_key = ?", (cache_key,))
+                sqldb.commit()
+                self.__count('expired')
+                self.__count('misses')
+                return None
+            sqldb.execute("update Completion_Cache set hits = hits + 1, last_used_on = ? where cache_key = ?", (now, cache_key))
+            sqldb.commit()
+            self.__count('hits')
+            return response, int(tokens)
+        except sqlite3.Error as err:
+            print(f"Response cache lookup failed: {err}")
+            self.__count('misses')
+            return None
+        finally:
+            sqldb.close()
+
+    ## Store a response then evict the least recently used entries beyond the size limit
+    def put(self, cache_key, model, response, tokens):
+        now = time()
+        sqldb = self.__connect()
+        try:
+            sqldb.execute(
+                "insert or replace into Completion_Cache (cache_key, model, response, tokens, hits, created_on, last_used_on) values (?, ?, ?, ?, 0, ?, ?)",
+                (cache_key, model, response, int(tokens), now, now))
+            self.__count('stores')
+            if self.__max_entries > 0:
+                evicted = sqldb.execute(
+                    "delete from Completion_Cache where cache_key in (select cache_key from Completion_Cache order by last_used_on limit max(0, (select count(*) from Completion_Cache) - ?))",
+                    (self.__max_entries,)).rowcount
+                if evicted > 0:
+                    self.__count('evicted', evicted)
+            sqldb.commit()
+        except sqlite3.Error as err:
+            print(f"Response cache store failed: {err}")
+            sqldb.rollback()
+        finally:
+            sqldb.close()
+
+    ## Forget a cached response, for example one which turned out to be unusable
+    def discard(self, cache_key):
+        sqldb = self.__connect()
+        try:
+            sqldb.execute("delete from Completion_Cache where cache_key = ?", (cache_key,))
+            sqldb.commit()
+        except sqlite3.Error as err:
+            print(f"Response cache discard failed: {err}")
+        finally:
+            sqldb.close()
+
+    ## Remove every expired entry; returns the number of rows removed
+    def purge_expired(self):
+        if self.__ttl_seconds <= 0:
+            return 0
+        sqldb = self.__connect()
+        try:
+            removed = sqldb.execute("delete from Completion_Cache where created_on < ?", (time() - self.__ttl_seconds,)).rowcount
+            sqldb.commit()
+        finally:
+            sqldb.close()
+        self.__count('expired', removed)
+        return removed
+
+## Identical requests made at the same time share one call. The first caller for a key runs the request and every caller
+## which arrives while it is in flight waits on the same future instead of making its own. Nothing is kept once the call
+## finishes; keeping results is the response cache's job.
+class SingleFlight:
+    def __init__(self):
+        self.__lock = Lock()
+        self.__in_flight = {}
+        self.__stats = {'calls': 0, 'shared': 0}
+
+    @property
+    def stats(self):
+        with self.__lock:
+            return dict(self.__stats)
+
+    ## Run the function for the key, or wait on the call already in flight. Returns (result, shared) where shared is True
+    ## if the result came from another caller's call. Errors are raised to every caller waiting on the call.
+    def do(self, key, function):
+        with self.__lock:
+            future = self.__in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.__in_flight[key] = future
+                self.__stats['calls'] += 1
+            else:
+                self.__stats['shared'] += 1
+        if not leader:
+            return future.result(), True
+        try:
+            result = function()
+            future.set_result(result)
+            return result, False
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self.__lock:
+                del self.__in_flight[key]
+
+    ## For asyncio tasks: await the call in flight for the key without holding a thread, otherwise run the blocking
+    ## function (which must go through do with the same key) on a worker thread so later callers can join it
+    async def do_async(self, key, function, *args, **kwargs):
+        with self.__lock:
+            future = self.__in_flight.get(key)
+            if future is not None:
+                self.__stats['shared'] += 1
+        if future is not None:
+            return await asyncio.wrap_future(future)
+        return await asyncio.to_thread(function, *args, **kwargs)
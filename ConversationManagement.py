@@ -3,18 +3,27 @@ import os
 import json
 import glob
 from time import time,sleep
+from threading import RLock
 from uuid import uuid4
 from UtilityFunctions import *
 from MemoryManagement import MemoryManager
-from PromptManagement import PromptManager
+from PromptManagement import PromptManager, ConversationPromptAssembler
+from ThemeManagement import RethemeScheduler
+from TaskManagement import Stage, get_task_manager
 
 class ConversationManager:
     def __init__(self):
         self.__config = get_config()
         self.__memory_manager = MemoryManager()
         self.__prompts = PromptManager()
+        self.__tasks = get_task_manager()
+        self.__prompt_assembler = ConversationPromptAssembler(self.__prompts, self.__config['open_ai']['max_token_input'])
         self.__eidetic_memory_log = self.MemoryLog(750,4,0)
         self.__episodic_memory_log = self.MemoryLog(750,4,1)
+        ## Memory logs are refreshed by the compression worker as well as the conversation
+        self.__memory_log_lock = RLock()
+        self.__memory_manager.add_compression_listener(self.on_compression_complete)
+        self.__retheme_scheduler = RethemeScheduler()
         self.make_required_directories()
 
     class MemoryLog:
@@ -167,29 +176,42 @@ class ConversationManager:
         self.__episodic_memory_log.refresh()
         return chat_history
             
+    ## Begin retheming in the background whenever the user is idle
+    def start_idle_retheming(self):
+        self.__retheme_scheduler.start()
+
+    ## Tell the retheme scheduler the user is active so it yields
+    def notify_user_activity(self):
+        self.__retheme_scheduler.notify_activity()
+
     def log_message(self, speaker, content):
-        memory, tokens, compression_occurred = self.__memory_manager.create_new_memory(speaker, content)
-        ## If there was a compression refresh all memory logs
-        if compression_occurred:
+        self.notify_user_activity()
+        with telemetry_stage('log_message'):
+            memory, tokens, compression_queued = self.__memory_manager.create_new_memory(speaker, content)
+        ## Compression happens in the background, the logs are refreshed when it finishes
+        with self.__memory_log_lock:
+            self.__eidetic_memory_log.add(memory['id'], tokens)
+
+    ## Remove memories (and everything summarized from them) then rebuild the rolling logs without them
+    def prune_memories(self, memory_ids):
+        result = self.__memory_manager.prune_memories(memory_ids)
+        with self.__memory_log_lock:
             self.__eidetic_memory_log.refresh()
             self.__episodic_memory_log.refresh()
-        else:
-            ## Otherwise simply add the new memory
-            self.__eidetic_memory_log.add(memory['id'], tokens)
-    
-    def generate_response(self):
-        conversation = self.__eidetic_memory_log.memory_string
-        if conversation == '':
-            debug_message('Conversation is blank. Skipping generate response...')
-            return ''
+        return result
 
-        ## Get anticipation
-        anticipation = ''
-        anticipation_tokens = 0
+    ## Called on the compression worker once a new summary exists
+    def on_compression_complete(self, job):
+        with self.__memory_log_lock:
+            self.__eidetic_memory_log.refresh()
+            self.__episodic_memory_log.refresh()
+    
+    ## Anticipate the needs of the user based on the current conversation
+    def get_anticipation(self, conversation):
         anticipation_prompt = self.__prompts.Anticipation.get_prompt(conversation)
         anticipation_response_tokens = self.__prompts.Anticipation.response_tokens
         anticipation_temperature = self.__prompts.Anticipation.temperature
-        anticipation, anticipation_tokens = gpt_completion([compose_gpt_message(anticipation_prompt,'user')], anticipation_temperature, anticipation_response_tokens)
+        anticipation, anticipation_tokens = gpt_completion([compose_gpt_message(anticipation_prompt,'user')], anticipation_temperature, anticipation_response_tokens, prompt_type='Anticipation')
         ## Save anticipation prompt and response
         anticipation_prompt_row = create_row_object(
             table_name='Prompts',
@@ -201,52 +223,114 @@ class ConversationManager:
             comments='Anticipate user needs.',
             created_on=time()
         )
-        sql_insert_row('Prompts','id',anticipation_prompt_row)
+        self.__tasks.run_in_background(sql_insert_row, 'Prompts', 'id', anticipation_prompt_row)
+        return anticipation
 
+    ## Read both memory logs at once; a finished compression may refresh them from another thread.
+    ## Every stage of a response works from the same snapshot.
+    def snapshot_memory_logs(self):
+        with self.__memory_log_lock:
+            return {
+                'conversation': self.__eidetic_memory_log.memory_string,
+                'eidetic_memories': self.__eidetic_memory_log.memories,
+                'episodic_memories': self.__episodic_memory_log.memories,
+                'active_memory_ids': self.__eidetic_memory_log.memory_ids + self.__episodic_memory_log.memory_ids
+            }
 
-        ## Perform memory recall
-        recalled = ''
-        active_memory_count = self.__eidetic_memory_log.memory_count
-        if active_memory_count > 1:
-            active_memory_ids = self.__eidetic_memory_log.memory_ids
-            active_memories = self.__eidetic_memory_log.memories
-            most_recent_message = active_memories[active_memory_count-1]
-            recent_conversation = '\n'.join(list(map(lambda x: x['summary'], active_memories)))
-            recall_results, successful_recall = self.__memory_manager.memory_recall(most_recent_message['content'], conversation)
-            recalled_memories = sql_query_by_ids('Memories', 'id', recall_results)
-            recalled_memory_summaries = []
-            for recalled_memory in recalled_memories:
-                if recalled_memory['id'] in active_memory_ids:
-                    continue
-                recalled_memory_date = timestamp_to_datetime(recalled_memory['created_on'])
-                recalled_memory_content = recalled_memory['content']
-                recalled_memory_speaker = recalled_memory['speaker']
-                recalled_memory_summaries.append(f"[\nRECORDED ON: {recalled_memory_date}\nFROM: {recalled_memory_speaker}\nCONTENT: {recalled_memory_content}\n]")
-            recalled = '\n'.join(recalled_memory_summaries)
-        
-        ## Prompt conversation
-        prompt_sections_list = []
-        prompt_content_list = []
-        compiled_conversation_content = ''
-        if anticipation != '':
-            prompt_content_list.append(f"ANTICIPATED USER NEEDS:\n{anticipation}")
-        if recalled != '':
-            prompt_sections_list.append('CONVERSATION HISTORY')
-            prompt_content_list.append(f"CONVERSATION HISTORY:\n{recalled}")
-        notes = self.__episodic_memory_log.memory_string
-        if notes != '':
-            prompt_sections_list.append('CONVERSATION NOTES')
-            prompt_content_list.append(f"CONVERSATION NOTES:\n{notes}")
-        prompt_sections_list.append('CONVERSATION LOG')
-        prompt_content_list.append(f"CONVERSATION LOG:\n{conversation}")
+    ## Recall memories related to the most recent message which are not already part of the active conversation
+    def get_recalled_memories(self, log_snapshot = None):
+        log_snapshot = self.snapshot_memory_logs() if log_snapshot is None else log_snapshot
+        recalled_memories = []
+        active_memory_ids = log_snapshot['active_memory_ids']
+        active_memories = log_snapshot['eidetic_memories']
+        if len(active_memories) > 1:
+            most_recent_message = active_memories[-1]
+            recall_results, successful_recall = self.__memory_manager.memory_recall(most_recent_message['content'], log_snapshot['conversation'], active_memory_ids)
+            recalled_memories = [r for r in recall_results if r['memory']['id'] not in active_memory_ids]
+        return recalled_memories
 
-        prompt_sections = ' and '.join(prompt_sections_list)
-        prompt_content = '\n'.join(prompt_content_list)
+    ## If a stream callback is given it is called with each piece of the response as it arrives. The complete response is always returned.
+    ## Every call made while generating the response is recorded in telemetry under one turn id. The turn has a deadline
+    ## (see [tasks] in config.ini); optional work is skipped as it nears and the Turns table records what was dropped.
+    def generate_response(self, stream_callback = None):
+        task_config = self.__config['tasks']
+        deadline = Deadline(float(task_config['turn_deadline_seconds']), float(task_config['response_reserve_seconds']))
+        with telemetry.turn() as turn_id, deadline.activate():
+            start_time = time()
+            turn_details = {'stage_status': {}, 'trimmed': {}}
+            try:
+                return self.__generate_response(stream_callback, deadline, turn_details)
+            finally:
+                turn_row = create_row_object(
+                    table_name='Turns',
+                    id=turn_id,
+                    deadline_seconds=deadline.seconds,
+                    elapsed_seconds=time() - start_time,
+                    stage_status=turn_details['stage_status'],
+                    dropped=deadline.dropped,
+                    trimmed=turn_details['trimmed'],
+                    created_on=start_time
+                )
+                self.__tasks.run_in_background(sql_insert_row, 'Turns', 'id', turn_row)
 
-        conversation_prompt = self.__prompts.Conversation.get_prompt(prompt_content, prompt_sections)
+    ## The outcome of each stage and the tokens trimmed from each prompt section are noted in turn_details
+    def __generate_response(self, stream_callback, deadline, turn_details):
+        self.notify_user_activity()
+        log_snapshot = self.snapshot_memory_logs()
+        conversation = log_snapshot['conversation']
+        if conversation == '':
+            debug_message('Conversation is blank. Skipping generate response...')
+            return ''
+
+        ## Anticipation and memory recall do not depend on each other so run them at the same time.
+        ## Both are optional, so neither may run into the time reserved for the response.
+        task_config = self.__config['tasks']
+        optional_seconds = deadline.optional_remaining()
+        sub_prompt_stages = []
+        for name, function, argument, timeout, default in (('anticipation', self.get_anticipation, conversation, task_config['anticipation_timeout'], ''), ('recall', self.get_recalled_memories, log_snapshot, task_config['recall_timeout'], [])):
+            if optional_seconds > 0:
+                sub_prompt_stages.append(Stage(name, function, (argument,), timeout=min(float(timeout), optional_seconds), default=default))
+            else:
+                deadline.drop(name, 'deadline')
+        sub_prompt_results = self.__tasks.run_concurrently(sub_prompt_stages)
+        turn_details['stage_status'] = self.__tasks.last_stage_status
+        for name, status in turn_details['stage_status'].items():
+            if status != 'completed':
+                deadline.drop(name, status)
+        anticipation = sub_prompt_results.get('anticipation', '')
+        recalled_memories = sub_prompt_results.get('recall', [])
+
+        ## Episodic notes are optional too; a shorter prompt gets a faster response when time is short
+        note_memories = log_snapshot['episodic_memories']
+        if deadline.optional_remaining() <= 0 and len(note_memories) > 0:
+            deadline.drop('episodic_notes', 'deadline')
+            note_memories = None
+        
+        ## Prompt conversation, trimmed to fit the model's input limit before it is sent
+        with telemetry_stage('assemble'):
+            conversation_prompt, conversation_prompt_tokens, trimmed = self.__prompt_assembler.assemble(
+                log_snapshot['eidetic_memories'],
+                anticipation,
+                recalled_memories,
+                note_memories)
+        turn_details['trimmed'] = trimmed
+        if sum(trimmed.values()) > 0:
+            debug_message(f"Conversation prompt trimmed to {conversation_prompt_tokens} tokens: " + ', '.join(f"{k} -{v}" for k, v in trimmed.items()))
         conversation_response_tokens = self.__prompts.Conversation.response_tokens
         conversation_temperature = self.__prompts.Conversation.temperature
-        conversation_response, conversation_tokens = gpt_completion([compose_gpt_message(conversation_prompt,'user')], conversation_temperature, conversation_response_tokens)
+        conversation_messages = [compose_gpt_message(conversation_prompt,'user')]
+        with telemetry_stage('response'):
+            if stream_callback is None:
+                conversation_response, conversation_tokens = gpt_completion(conversation_messages, conversation_temperature, conversation_response_tokens, prompt_type='Conversation')
+            else:
+                ## Hand each piece of the response to the caller as it arrives, then keep the complete text
+                response_deltas = []
+                for delta in gpt_completion_stream(conversation_messages, conversation_temperature, conversation_response_tokens, prompt_type='Conversation'):
+                    response_deltas.append(delta)
+                    stream_callback(delta)
+                conversation_response = ''.join(response_deltas).strip()
+                ## Streamed responses do not report usage so estimate it
+                conversation_tokens = sum(get_token_estimates([conversation_prompt, conversation_response]))
         ## Save conversation prompt and response
         conversation_prompt_row = create_row_object(
             table_name='Prompts',
@@ -258,5 +342,6 @@ class ConversationManager:
             comments='Present conversation prompt.',
             created_on=time()
         )
-        sql_insert_row('Prompts','id',conversation_prompt_row)        
+        self.__tasks.run_in_background(sql_insert_row, 'Prompts', 'id', conversation_prompt_row)
+        self.notify_user_activity()
         return conversation_response
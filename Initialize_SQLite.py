@@ -4,6 +4,12 @@ config = configparser.ConfigParser()
 config.read('config.ini')
 conn = sqlite3.connect(config['database']['database_name'])
 
+## Columns added after a table was first created are added to existing databases here
+def add_missing_column(table_name, column_name, column_type):
+    columns = [c[1] for c in conn.execute(f"PRAGMA table_info({table_name})").fetchall()]
+    if column_name not in columns:
+        conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
 ## Memories Table
 conn.execute('''
 CREATE TABLE IF NOT EXISTS Memories (
@@ -19,10 +25,16 @@ CREATE TABLE IF NOT EXISTS Memories (
     past_sibling_id TEXT,
     next_sibling_id TEXT,
     total_themes INTEGER,
+    stale INTEGER,
+    archived INTEGER,
     created_on REAL,
     modified_on REAL
 )
 ''')
+## Set to 1 when a memory's children were pruned and its summary has to be remade
+add_missing_column('Memories', 'stale', 'INTEGER')
+## Set to 1 when a memory's content and summary were moved to the archive (see Memory_Archive)
+add_missing_column('Memories', 'archived', 'INTEGER')
 
 ## Themes Table
 conn.execute('''
@@ -60,9 +72,11 @@ CREATE TABLE IF NOT EXISTS Prompts (
     tokens INTEGER,
     temperature REAL,
     comments TEXT,
+    turn_id TEXT,
     created_on REAL
 )
 ''')
+add_missing_column('Prompts', 'turn_id', 'TEXT')
 
 ## Memory States Table
 conn.execute('''
@@ -92,6 +106,195 @@ CREATE TABLE IF NOT EXISTS Memory_Caches (
 )
 ''')
 
+## Memory Closure Table. One row for every memory and each of its ancestors (and itself, at distance 0) so a whole
+## subtree or every ancestor of a memory can be read with one indexed query instead of one query per depth.
+conn.execute('''
+CREATE TABLE IF NOT EXISTS Memory_Closure (
+    ancestor_id TEXT NOT NULL,
+    descendant_id TEXT NOT NULL,
+    distance INTEGER,
+    PRIMARY KEY (ancestor_id, descendant_id)
+)
+''')
+conn.execute('CREATE INDEX IF NOT EXISTS Memory_Closure_Descendant ON Memory_Closure (descendant_id, distance)')
+
+## Build closure rows for any memories which were saved before the closure table existed
+conn.execute('''
+INSERT OR IGNORE INTO Memory_Closure (ancestor_id, descendant_id, distance)
+WITH RECURSIVE closure(ancestor_id, descendant_id, distance) AS (
+    SELECT id, id, 0 FROM Memories
+    UNION ALL
+    SELECT m.episodic_parent_id, c.descendant_id, c.distance + 1 FROM closure AS c JOIN Memories AS m ON m.id = c.ancestor_id WHERE m.episodic_parent_id IS NOT NULL
+)
+SELECT ancestor_id, descendant_id, distance FROM closure
+''')
+
+## Memory Archive Table. Where the content of each archived memory was written in the archive's segment files.
+conn.execute('''
+CREATE TABLE IF NOT EXISTS Memory_Archive (
+    memory_id TEXT PRIMARY KEY NOT NULL,
+    segment TEXT,
+    offset INTEGER,
+    length INTEGER,
+    checksum INTEGER,
+    archived_on REAL
+)
+''')
+
+## Completion Cache Table
+conn.execute('''
+CREATE TABLE IF NOT EXISTS Completion_Cache (
+    cache_key TEXT PRIMARY KEY NOT NULL,
+    model TEXT,
+    response TEXT,
+    tokens INTEGER,
+    hits INTEGER,
+    created_on REAL,
+    last_used_on REAL
+)
+''')
+conn.execute('CREATE INDEX IF NOT EXISTS Completion_Cache_Last_Used ON Completion_Cache (last_used_on)')
+
+## Compression Jobs Table. Durable queue of memory caches waiting to be summarized.
+conn.execute('''
+CREATE TABLE IF NOT EXISTS Compression_Jobs (
+    id TEXT PRIMARY KEY NOT NULL,
+    depth INTEGER,
+    memory_ids TEXT,
+    source_cache_id TEXT,
+    status TEXT,
+    attempts INTEGER,
+    error TEXT,
+    result_memory_id TEXT,
+    created_on REAL,
+    modified_on REAL
+)
+''')
+conn.execute('CREATE INDEX IF NOT EXISTS Compression_Jobs_Status ON Compression_Jobs (status, created_on)')
+
+## Compression Steps Table. Journal of the steps each compression job has finished, keyed by job and step, with each step's result.
+conn.execute('''
+CREATE TABLE IF NOT EXISTS Compression_Steps (
+    id TEXT PRIMARY KEY NOT NULL,
+    job_id TEXT,
+    step TEXT,
+    result TEXT,
+    created_on REAL
+)
+''')
+conn.execute('CREATE INDEX IF NOT EXISTS Compression_Steps_Job ON Compression_Steps (job_id)')
+
+## Retheme Runs Table. Progress and cost of each idle-time retheme run.
+conn.execute('''
+CREATE TABLE IF NOT EXISTS Retheme_Runs (
+    id TEXT PRIMARY KEY NOT NULL,
+    themes_attempted INTEGER,
+    themes_completed INTEGER,
+    llm_calls INTEGER,
+    tokens INTEGER,
+    elapsed_seconds REAL,
+    stop_reason TEXT,
+    started_on REAL,
+    finished_on REAL
+)
+''')
+
+## Turns Table. The deadline of each conversation turn and the optional work dropped to meet it.
+conn.execute('''
+CREATE TABLE IF NOT EXISTS Turns (
+    id TEXT PRIMARY KEY NOT NULL,
+    deadline_seconds REAL,
+    elapsed_seconds REAL,
+    stage_status TEXT,
+    dropped TEXT,
+    trimmed TEXT,
+    created_on REAL
+)
+''')
+
+## Telemetry Spans Table. Wall time of every model, embedding, vector, and SQL call, grouped by conversation turn and pipeline stage.
+conn.execute('''
+CREATE TABLE IF NOT EXISTS Telemetry_Spans (
+    id TEXT PRIMARY KEY NOT NULL,
+    turn_id TEXT,
+    stage TEXT,
+    kind TEXT,
+    name TEXT,
+    model TEXT,
+    latency_ms REAL,
+    tokens INTEGER,
+    retries INTEGER,
+    cache_hit INTEGER,
+    success INTEGER,
+    cost REAL,
+    created_on REAL
+)
+''')
+conn.execute('CREATE INDEX IF NOT EXISTS Telemetry_Spans_Turn ON Telemetry_Spans (turn_id)')
+conn.execute('CREATE INDEX IF NOT EXISTS Telemetry_Spans_Created_On ON Telemetry_Spans (created_on)')
+
+## Recall Gate Decisions Table
+conn.execute('''
+CREATE TABLE IF NOT EXISTS Recall_Gate_Decisions (
+    id TEXT PRIMARY KEY NOT NULL,
+    message TEXT,
+    decision TEXT,
+    reason TEXT,
+    similarity REAL,
+    proper_nouns TEXT,
+    known_entities TEXT,
+    created_on REAL
+)
+''')
+
+## Full text index of memory contents used for lexical (BM25) recall. Rows share the rowid of their Memories record.
+conn.execute('''
+CREATE VIRTUAL TABLE IF NOT EXISTS Memories_FTS USING fts5(
+    memory_id UNINDEXED,
+    depth UNINDEXED,
+    content
+)
+''')
+
+## Keep the full text index in step with the Memories table
+conn.execute('''
+CREATE TRIGGER IF NOT EXISTS Memories_FTS_Insert AFTER INSERT ON Memories BEGIN
+    DELETE FROM Memories_FTS WHERE rowid = new.rowid;
+    INSERT INTO Memories_FTS (rowid, memory_id, depth, content) VALUES (new.rowid, new.id, new.depth, coalesce(new.content, new.summary));
+END
+''')
+conn.execute('''
+CREATE TRIGGER IF NOT EXISTS Memories_FTS_Update AFTER UPDATE OF depth, content, summary ON Memories BEGIN
+    DELETE FROM Memories_FTS WHERE rowid = old.rowid;
+    INSERT INTO Memories_FTS (rowid, memory_id, depth, content) VALUES (new.rowid, new.id, new.depth, coalesce(new.content, new.summary));
+END
+''')
+conn.execute('''
+CREATE TRIGGER IF NOT EXISTS Memories_FTS_Delete AFTER DELETE ON Memories BEGIN
+    DELETE FROM Memories_FTS WHERE rowid = old.rowid;
+END
+''')
+
+## Index any memories which were saved before the full text index existed
+conn.execute('''
+INSERT INTO Memories_FTS (rowid, memory_id, depth, content)
+SELECT rowid, id, depth, coalesce(content, summary) FROM Memories WHERE rowid NOT IN (SELECT rowid FROM Memories_FTS)
+''')
+
+## Theme totals and link weights are summed from the links of each memory
+conn.execute('CREATE INDEX IF NOT EXISTS Theme_Links_Memory ON Theme_Links (memory_id, recurrence)')
+## Retheming reads the links of a theme, and pruning looks for themes left with no links
+conn.execute('CREATE INDEX IF NOT EXISTS Theme_Links_Theme ON Theme_Links (theme_id)')
+
+## Recall by time scans messages of one depth by when they were made
+conn.execute('CREATE INDEX IF NOT EXISTS Memories_Depth_Created_On ON Memories (depth, created_on)')
+
+## Some timestamps were once saved as text. Store every numeric timestamp (a REAL column ending in _on) as a number.
+for (table_name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND sql NOT LIKE 'CREATE VIRTUAL%'").fetchall():
+    for column in conn.execute(f"PRAGMA table_info({table_name})").fetchall():
+        column_name, column_type = column[1], column[2]
+        if column_name.endswith('_on') and column_type.upper() == 'REAL':
+            conn.execute(f"UPDATE {table_name} SET {column_name} = CAST(trim({column_name}) AS REAL) WHERE typeof({column_name}) = 'text' AND trim({column_name}) GLOB '[0-9]*'")
 
 ## commit the changes to the database
 conn.commit()
@@ -3,11 +3,17 @@ import os
 import json
 import glob
 import datetime
-from uuid import uuid4
+from uuid import uuid4, uuid5, NAMESPACE_URL
 import re
+import copy
 import sqlite3
+import queue
+from threading import Thread, RLock
+from concurrent.futures import ThreadPoolExecutor
 from ThemeManagement import ThemeManager
 from PromptManagement import PromptManager
+from TaskManagement import get_task_manager
+from TemporalResolution import resolve_recall_time_range
 from UtilityFunctions import *
 
 ##### NOTE: Token counts should leave enough room for a variety of prompt instructions, since their use may vary. I am thinking of leaving a buffer of 1000 to ensure there is enough room, but I will generalize it so adjustments can be made easily
@@ -20,29 +26,57 @@ class MemoryManager:
         self.__config = get_config()
         self.__prompts = PromptManager()
         self.__themes = ThemeManager()
+        self.__tasks = get_task_manager()
         self.__cache_token_limit = int(self.__config['memory_management']['cache_token_limit'])
+        ## Optional per-depth limits; depths past the end of the list use its last value
+        self.__depth_cache_token_limits = [int(l) for l in self.__config['memory_management']['depth_cache_token_limits'].split(',') if l.strip() != '']
         self.__max_tokens = int(self.__config['open_ai']['max_token_input'])
-        self.__episodic_memory_caches = [] # index will represent memory depth, useful for dynamic memory expansion
-        self.__max_episodic_depth = 2 # will restrict memory expansion. 0 is unlimited depth.
+        self.__episodic_memory_caches = [] # index will represent memory depth, caches are added as memories reach each new depth
+        self.__max_episodic_depth = int(self.__config['memory_management']['max_episodic_depth']) # will restrict memory expansion. 0 is unlimited depth.
+        self.__min_memories_per_compression = max(int(self.__config['memory_management']['min_memories_per_compression']), 2)
         self.__pinecone_indexing_enabled = self.__config.getboolean('pinecone', 'pinecone_indexing_enabled')
         self.debug_messages_enabled = True
+        ## Latency (in seconds) of each source searched during the most recent hybrid recall
+        self.last_recall_timings = {}
+        ## Caches are changed by both the conversation and the compression worker
+        self.__state_lock = RLock()
+        ## Compression jobs are stored in the Compression_Jobs table and their ids are fed to a single worker thread
+        self.__background_compression_enabled = self.__config.getboolean('memory_management', 'background_compression_enabled')
+        self.__compression_queue = queue.Queue()
+        self.__compression_listeners = []
+        ## Memories snapshotted from a cache's working set, by compression job id, so a queued job need not reload them
+        self.__compression_job_memories = {}
 
         ## When initialized, attempt to load cached state, otherwise make a new state
         if not (self.load_state()):
             self.create_state()
+        if self.__background_compression_enabled:
+            Thread(target=self.__compression_worker, name='raven-compression', daemon=True).start()
+        self.resume_compression_jobs()
+        if self.__config.getboolean('archive', 'archive_enabled'):
+            self.__tasks.run_in_background(self.archive_cold_memories)
 
     ## Houses memories of a particular depth. Each change will trigger will be followed with a state save
+    ## The cache keeps its memory records in memory (its working set) and writes every change through to the database,
+    ## so reading the cache never touches the database. The working set is loaded once, when the cache is.
     class _MemoryCache:
         ## Depth should not be changed after initialization.
         ## If cache is not empty then load it, otherwise start fresh.
         def __init__(self, depth, cache_token_limit, max_tokens, cache = None):
             self.debug_messages_enabled = True
             self.__config = get_config()
+            ## Memory records by id, in the order they were added
+            self.__memories = {}
+            ## Last memory of the cache before this one, once known; it is the past sibling of this cache's first memory
+            self.__past_cache_last_memory_id = None
             if cache is not None:
                 self.__cache = cache
-                self.__depth = self.__cache['depth']
-                self.__cache_token_limit = self.__cache['cache_token_limit']
+                self.__depth = int(self.__cache['depth'])
+                ## The configured limit wins over the saved one so limits can be changed between runs
+                self.__cache_token_limit = int(cache_token_limit)
+                self.__cache['cache_token_limit'] = self.__cache_token_limit
                 self.__max_tokens = self.__cache['max_tokens']
+                self.load_memories()
             else:
                 self.__depth = int(depth)
                 self.__cache_token_limit = int(cache_token_limit)
@@ -64,8 +98,20 @@ class MemoryManager:
         ## Returns a copy of memories; useful for compression and will not bork stuff when flushed
         @property
         def memories(self):
-            memories = sql_query_by_ids('Memories','id',self.__cache['memory_ids'])
-            return memories
+            return [copy.deepcopy(self.__memories[memory_id]) for memory_id in self.__cache['memory_ids'] if memory_id in self.__memories]
+
+        ## Fill the working set from the database in one query
+        def load_memories(self):
+            memory_ids = list(self.__cache['memory_ids'])
+            self.__memories = {}
+            if len(memory_ids) == 0:
+                return
+            memories = {memory['id']: memory for memory in sql_query_by_ids('Memories', 'id', memory_ids)}
+            for memory_id in memory_ids:
+                if memory_id in memories:
+                    self.__memories[memory_id] = memories[memory_id]
+                else:
+                    debug_message(f"Memory {memory_id} of cache {self.__cache['id']} no longer exists.", self.debug_messages_enabled)
 
         @property
         def memory_count(self):
@@ -84,7 +130,9 @@ class MemoryManager:
         # def previous_memory_ids(self):
         #     return self.__previous_memory_ids
 
-        def get_new_cache(self, new_cache_id = str(uuid4())):
+        def get_new_cache(self, new_cache_id = None):
+            if new_cache_id is None:
+                new_cache_id = str(uuid4())
             new_cache = create_row_object(
                 table_name='Memory_Caches',
                 id=new_cache_id,
@@ -111,8 +159,10 @@ class MemoryManager:
                 past_sibling_id = self.__cache['last_memory_id']
             else:
                 self.__cache['first_memory_id'] = memory['id']
-                if self.__cache['past_cache_id'] is not None:
-                    ## Update cache's first memory id
+                if self.__past_cache_last_memory_id is not None:
+                    past_sibling_id = self.__past_cache_last_memory_id
+                elif self.__cache['past_cache_id'] is not None:
+                    ## Only a cache loaded empty has to look up the cache it replaced
                     past_cache_results = sql_query_by_ids('Memory_Caches','id',self.__cache['past_cache_id'])
                     if len(past_cache_results) <= 0:
                         debug_message(f"Unable to load past memory cache {self.__cache['past_cache_id']}")
@@ -125,10 +175,32 @@ class MemoryManager:
             memory['past_sibling_id'] = past_sibling_id
             self.save_memory(memory)
             ## Update cache
+            self.__memories[memory_id] = memory
             self.__cache['last_memory_id'] = memory['id']
             self.__cache['memory_ids'].append(memory['id'])
             self.save_memory_cache()
 
+        ## Take pruned memories out of the cache and reload the rest, whose siblings may have been relinked
+        def remove_memories(self, memory_ids):
+            memory_ids = set(memory_ids)
+            if self.__past_cache_last_memory_id in memory_ids:
+                self.__past_cache_last_memory_id = None
+            remaining_ids = [memory_id for memory_id in self.__cache['memory_ids'] if memory_id not in memory_ids]
+            if len(remaining_ids) == len(self.__cache['memory_ids']):
+                return False
+            self.__cache['memory_ids'] = remaining_ids
+            self.load_memories()
+            self.__cache['token_count'] = sum(int(self.__memories[memory_id]['summary_tokens']) for memory_id in self.__memories)
+            self.__cache['first_memory_id'] = remaining_ids[0] if len(remaining_ids) > 0 else None
+            self.__cache['last_memory_id'] = remaining_ids[-1] if len(remaining_ids) > 0 else None
+            self.save_memory_cache()
+            return True
+
+        ## Apply a change which was already saved to the database to the working set
+        def update_memory(self, memory_id, fields):
+            if memory_id in self.__memories:
+                self.__memories[memory_id].update(fields)
+
         ## Before adding a memory, check to see if there will be space with next memory.
         def has_memory_space(self, next_number_of_tokens):
             if self.__cache['token_count'] + int(next_number_of_tokens) <= self.__cache['cache_token_limit']:
@@ -144,8 +216,11 @@ class MemoryManager:
             self.__cache['next_cache_id'] = new_cache_id
             self.save_memory_cache()
             ## Clear memory cache, set past cache id, then save
+            if self.__cache.get('last_memory_id') is not None:
+                self.__past_cache_last_memory_id = self.__cache['last_memory_id']
             self.__cache = self.get_new_cache(new_cache_id)
             self.__cache['past_cache_id'] = old_cache_id
+            self.__memories = {}
             self.save_memory_cache()
 
         def save_memory_cache(self):
@@ -153,6 +228,10 @@ class MemoryManager:
 
         ## Add memory id to past sibling's 'next_sibling' id
         def update_past_sibling(self, memory_id, past_sibling_id):
+            if past_sibling_id is None:
+                return
+            if past_sibling_id in self.__memories:
+                self.__memories[past_sibling_id]['next_sibling_id'] = memory_id
             sql_update_row('Memories','id',{'id':past_sibling_id,'next_sibling_id':memory_id})
             
         ## Save the memory in the sql database
@@ -167,19 +246,66 @@ class MemoryManager:
                 if memory['episodic_children_ids'] is None:
                     memory['episodic_children_ids'] = []
                 child_ids = list(memory['episodic_children_ids'])
-                children_memories = sql_query_by_ids('Memories', 'id', child_ids)
-                for child_memory in children_memories:
-                    child_memory['episodic_parent_id'] = memory_id
-                    sql_update_row('Memories','id',child_memory)
+            else:
+                child_ids = []
+            with sql_transaction() as sqldb:
+                ## Every memory is its own closure row; a parent also becomes an ancestor of its children's whole subtrees
+                sqldb.execute('insert or ignore into Memory_Closure (ancestor_id, descendant_id, distance) values (?,?,0)', (memory_id, memory_id))
+                if len(child_ids) > 0:
+                    ## Children were flushed from their own cache before compression, so only the database holds them
+                    sqldb.execute('update Memories set episodic_parent_id = ?, modified_on = ? where id in (select value from json_each(?))', (memory_id, time(), json.dumps(child_ids)))
+                    sqldb.execute('''
+                        insert or ignore into Memory_Closure (ancestor_id, descendant_id, distance)
+                        select a.ancestor_id, d.descendant_id, a.distance + d.distance + 1
+                        from Memory_Closure as a, Memory_Closure as d
+                        where a.descendant_id = ? and d.ancestor_id in (select value from json_each(?))
+                        ''', (memory_id, json.dumps(child_ids)))
+
+    ## Move the content of old eidetic memories which have already been summarized into the archive, leaving stub rows.
+    ## Each batch is written to a segment file and flushed to disk before its rows are stubbed in one transaction, so a
+    ## crash can leave an unused record in a segment but never a stub without its content. Reads fault the content back in
+    ## (see fault_in_archived_memories). Archived messages leave the full text index; their summaries stay searchable.
+    ## Freed pages are reused by new rows; vacuum shrinks the database file as well. Returns the number of memories archived.
+    def archive_cold_memories(self, now = None, vacuum = False):
+        archive_config = self.__config['archive']
+        cutoff = (time() if now is None else float(now)) - float(archive_config['archive_after_days']) * 86400
+        batch_size = int(archive_config['archive_batch_size'])
+        with self.__state_lock:
+            cached_ids = set(memory_id for cache in self.__episodic_memory_caches for memory_id in cache.memory_ids)
+        archived_count = 0
+        while True:
+            memories = sql_custom_query('''
+                select id, content, summary from Memories
+                where depth = 0 and created_on < ? and coalesce(archived, 0) != 1 and episodic_parent_id is not null and content is not null
+                limit ?
+                ''', (cutoff, batch_size))
+            memories = [m for m in memories if m['id'] not in cached_ids]
+            if len(memories) == 0:
+                break
+            locations = memory_archive.append([{'id': m['id'], 'content': m['content'], 'summary': m['summary']} for m in memories])
+            with sql_transaction() as sqldb:
+                sqldb.executemany('insert or replace into Memory_Archive (memory_id, segment, offset, length, checksum, archived_on) values (?,?,?,?,?,?)',
+                    [(memory_id, l['segment'], l['offset'], l['length'], l['checksum'], time()) for memory_id, l in locations.items()])
+                sqldb.execute('update Memories set content = NULL, summary = NULL, archived = 1 where id in (select value from json_each(?))', (json.dumps(list(locations.keys())),))
+            archived_count += len(memories)
+            if len(memories) < batch_size:
+                break
+        if archived_count > 0:
+            debug_message(f"Archived {archived_count} memories older than {archive_config['archive_after_days']} days.", self.debug_messages_enabled)
+            if vacuum:
+                sql_vacuum()
+        return archived_count
 
     ## Return the number of memories of a given cache
     def get_cache_memory_count(self,depth):
-        if int(depth) > len(self.__episodic_memory_caches):
+        if int(depth) >= len(self.__episodic_memory_caches):
             return -1
         return self.__episodic_memory_caches[int(depth)].memory_count
 
     ## Return the list of memories currently in cache
     def get_memories_from_cache(self, depth):
+        if int(depth) >= len(self.__episodic_memory_caches):
+            return []
         return self.__episodic_memory_caches[int(depth)].memories
 
     # ## Return id list of memories in previous cache before it was flushed.
@@ -190,6 +316,31 @@ class MemoryManager:
     def cache_count(self):
         return len(self.__episodic_memory_caches)
 
+    def get_cache_token_limit(self, depth):
+        if len(self.__depth_cache_token_limits) == 0:
+            return self.__cache_token_limit
+        return self.__depth_cache_token_limits[min(int(depth), len(self.__depth_cache_token_limits) - 1)]
+
+    ## Return the cache of the given depth, creating it (and any missing shallower caches) the first time that depth is reached
+    def get_cache(self, depth):
+        depth = int(depth)
+        with self.__state_lock:
+            while len(self.__episodic_memory_caches) <= depth:
+                new_depth = len(self.__episodic_memory_caches)
+                debug_message(f"Creating memory cache of depth ({new_depth})...", self.debug_messages_enabled)
+                self.__episodic_memory_caches.append(self._MemoryCache(new_depth, self.get_cache_token_limit(new_depth), self.__max_tokens))
+            return self.__episodic_memory_caches[depth]
+
+    ## A full cache is only compressed once it holds enough memories for the summary to be worth making; until then it overflows.
+    ## Every summary stands for at least this many memories of the depth below, so the number of depths stays logarithmic.
+    def needs_compression(self, depth, tokens):
+        cache = self.get_cache(depth)
+        return not cache.has_memory_space(tokens) and cache.memory_count >= self.__min_memories_per_compression
+
+    ## True if memories of this depth may be compressed into a deeper one
+    def can_compress_depth(self, depth):
+        return self.__max_episodic_depth <= 0 or int(depth) < self.__max_episodic_depth
+
     ## Load JSON object representing state. State is all memory caches not yet summarized, active tasks, and active context.
     def load_state(self):
         ## Get most recent memory state from database
@@ -202,34 +353,41 @@ class MemoryManager:
         ## Append a new cache
         debug_message("state backups loaded...", self.debug_messages_enabled)
         memory_caches = sql_query_by_ids('Memory_Caches','id', states[0]['memory_cache_ids'])
-        for cache in memory_caches:
-            depth = cache['depth']
-            self.__episodic_memory_caches.append(self._MemoryCache(depth, self.__cache_token_limit, self.__max_tokens, cache))
+        ## The cache list is indexed by depth, so replace (rather than add to) whatever was loaded before
+        with self.__state_lock:
+            self.__episodic_memory_caches = []
+            for cache in sorted(memory_caches, key=lambda c: int(c['depth'])):
+                depth = int(cache['depth'])
+                ## Fill any gap so each cache stays at the index of its depth
+                if depth > 0:
+                    self.get_cache(depth - 1)
+                self.__episodic_memory_caches.append(self._MemoryCache(depth, self.get_cache_token_limit(depth), self.__max_tokens, cache))
         return True
 
+    ## Deeper caches are created when memories first reach them
     def create_state(self):
-        for i in range(self.__max_episodic_depth+1):
-            ## Initialize all episodic memory caches
-            self.__episodic_memory_caches.append(self._MemoryCache(i, self.__cache_token_limit, self.__max_tokens))
-        self.save_state()
+        with self.__state_lock:
+            self.get_cache(0)
+            self.save_state()
 
     def save_state(self):
         unique_id = str(uuid4())
 
-        memory_cache_ids = list()
-        for cache in self.__episodic_memory_caches:
-            memory_cache_ids.append(cache.id)
-            cache.save_memory_cache()
+        with self.__state_lock:
+            memory_cache_ids = list()
+            for cache in self.__episodic_memory_caches:
+                memory_cache_ids.append(cache.id)
+                cache.save_memory_cache()
         
-        ## Insert Memory State
-        state = create_row_object(
-            table_name='Memory_States',
-            id=unique_id,
-            memory_cache_ids=memory_cache_ids,
-            created_on=time(),
-            modified_on=time()
-        )
-        success = sql_insert_row('Memory_States','id',state)
+            ## Insert Memory State
+            state = create_row_object(
+                table_name='Memory_States',
+                id=unique_id,
+                memory_cache_ids=memory_cache_ids,
+                created_on=time(),
+                modified_on=time()
+            )
+            success = sql_insert_row('Memory_States','id',state)
         if success:
             debug_message('State saved.', self.debug_messages_enabled)
         else:
@@ -242,9 +400,8 @@ class MemoryManager:
         
         unique_id = str(uuid4())
         depth = 0
-        content_tokens = get_token_estimate(content)
         summary = ('%s: %s') % (speaker, content)
-        summary_tokens = get_token_estimate(summary)
+        content_tokens, summary_tokens = get_token_estimates([content, summary])
 
         ## Build episodic memory object
         eidetic_memory = create_row_object(
@@ -263,11 +420,9 @@ class MemoryManager:
         return eidetic_memory, summary_tokens
 
     ## Assemble an eposodic memory from a collection of eidetic or lower-depth episodic memories
-    def generate_episodic_memory(self, memories, depth):
-        timestamp = time()
+    ## Given a compression job, each step is journaled so a job resumed after a crash carries on after its last finished step
+    def generate_episodic_memory(self, memories, depth, job_id = None):
         debug_message('Generating episodic memory of cache depth (%s)...' % str(depth), self.debug_messages_enabled)
-        unique_id = str(uuid4())
-        timestring = timestamp_to_datetime(timestamp)
 
         ## Append all summaries together, get a token total, and get a list of memory ids
         contents = []
@@ -278,53 +433,82 @@ class MemoryManager:
             content_tokens += int(memory['summary_tokens'])
             memory_ids.append(str(memory['id']))
         content = '\n'.join(contents)
-        summary_result = self.summarize_content(content, depth, content_tokens = content_tokens)
-        summary = self.cleanup_response(summary_result)
-        summary_tokens = get_token_estimate(summary)
-        
-        ## Extract the themes of this memory
-        themes = self.__themes.extract_themes(content)
+
+        ## The new memory's id and time are decided with its summary so a resumed job makes the same memory
+        def summarize():
+            summary_result = self.summarize_content(content, depth, content_tokens = content_tokens, prompt_id = self.get_step_prompt_id(job_id, 'summarize'))
+            summary = self.cleanup_response(summary_result)
+            return {'memory_id': str(uuid4()), 'created_on': time(), 'summary': summary, 'summary_tokens': get_token_estimate(summary)}
+        summarized = self.run_compression_step(job_id, 'summarize', summarize)
+
+        ## Extract the themes of this memory. The changes to themes are planned first (nothing is written while waiting on the model)
+        ## and saved on the step's transaction, so a step interrupted before it was journaled has changed no themes when it runs again.
+        def extract_themes(sqldb):
+            theme_plan = self.__themes.plan_themes(content, prompt_id = self.get_step_prompt_id(job_id, 'extract_themes'))
+            return {'themes': self.__themes.apply_themes(sqldb, theme_plan)}
+        themes = self.run_compression_step(job_id, 'extract_themes', None, extract_themes)['themes']
 
         ## Make new theme links and update old memories
-        for memory in memories:
-            total_themes = 0
-            for theme_id in themes.keys():
-                recurrence = themes[theme_id]['recurrence']
-                total_themes += recurrence
-                ## Create a new theme link record
-                new_theme_id = str(uuid4())
-                new_theme = self.__themes.create_theme_link_object(
-                    id=new_theme_id,
-                    depth=int(memory['depth']),
-                    memory_id=memory['id'],
-                    theme_id=theme_id,
-                    recurrence=recurrence,
-                    cooldown=0,
-                    created_on=time(),
-                    modified_on=time()
-                )
-                ## Insert new theme link record
-                sql_insert_row('Theme_Links','id',new_theme)
-            ## Update memory with new total_themes:
-            new_total_themes = memory['total_themes']
-            if new_total_themes < 0 or type(new_total_themes) != int:
-                new_total_themes = 0
-            new_total_themes += total_themes
-            sql_update_row('Memories', 'id', {'id':memory['id'], 'total_themes':new_total_themes})
+        self.run_compression_step(job_id, 'link_themes', None, lambda sqldb: self.link_memory_themes(sqldb, memories, themes, job_id))
 
         ## Build episodic memory object
         episodic_memory = create_row_object(
             table_name='Memories',
-            id=unique_id,
+            id=summarized['memory_id'],
             depth=int(depth),
-            summary=summary,
-            summary_tokens=int(summary_tokens),
+            summary=summarized['summary'],
+            summary_tokens=int(summarized['summary_tokens']),
             episodic_children_ids=memory_ids,
             total_themes=0,
-            created_on=time(),
+            created_on=summarized['created_on'],
             modified_on=time()
         )
-        return episodic_memory, summary_tokens
+        return episodic_memory, int(summarized['summary_tokens'])
+
+    ## Link each memory to the extracted themes and recompute their theme totals and link weights, all on the given transaction.
+    ## Link ids are derived from the job, memory, and theme so a repeated step replaces its links instead of doubling them.
+    def link_memory_themes(self, sqldb, memories, themes, job_id = None):
+        for memory in memories:
+            for theme_id in themes.keys():
+                recurrence = themes[theme_id]['recurrence']
+                ## Create a new theme link record
+                if job_id is None:
+                    new_theme_id = str(uuid4())
+                else:
+                    new_theme_id = str(uuid5(NAMESPACE_URL, f"{job_id}:{memory['id']}:{theme_id}"))
+                sqldb.execute('insert or replace into Theme_Links (id, depth, memory_id, theme_id, weight, recurrence, cooldown, created_on, modified_on) values (?,?,?,?,?,?,?,?,?)',
+                    (new_theme_id, int(memory['depth']), memory['id'], theme_id, -1.0, recurrence, 0, time(), time()))
+        ## Totals are summed from the links in the database since retheming may have changed them since the memories were read
+        self.__themes.recompute_theme_weights([m['id'] for m in memories], sqldb)
+        return {'memory_count': len(memories), 'theme_count': len(themes)}
+
+    ## Compression jobs keep a journal of the steps they have finished in Compression_Steps, keyed by job and step.
+    ## A finished step is never run again; its saved result is returned instead. Without a job the step simply runs.
+    ## A step given a transactional function runs it and records itself on the same transaction, so it happens exactly once.
+    def run_compression_step(self, job_id, step, function, transactional_function = None):
+        if job_id is None:
+            if transactional_function is not None:
+                with sql_transaction() as sqldb:
+                    return transactional_function(sqldb)
+            return function()
+        step_id = f"{job_id}:{step}"
+        finished_steps = sql_query_by_ids('Compression_Steps', 'id', step_id)
+        if len(finished_steps) > 0:
+            debug_message(f"Compression step {step} of job {job_id} already finished.", self.debug_messages_enabled)
+            return finished_steps[0]['result']
+        with sql_transaction() as sqldb:
+            if transactional_function is not None:
+                result = transactional_function(sqldb)
+            else:
+                result = function()
+            sqldb.execute('insert or replace into Compression_Steps (id, job_id, step, result, created_on) values (?,?,?,?,?)', (step_id, job_id, step, json.dumps(result), time()))
+        return result
+
+    ## Prompts made for a journaled step are saved under an id derived from the step so a resumed job can reuse the response
+    def get_step_prompt_id(self, job_id, step):
+        if job_id is None:
+            return None
+        return str(uuid5(NAMESPACE_URL, f"{job_id}:{step}"))
 
     ## Strip away unwanted characters from gpt response
     def cleanup_response(self, response):
@@ -334,87 +518,191 @@ class MemoryManager:
         return response
 
     ## Caching memories may cascade and compress higher depth caches
-    ## Check to see if cache as room, if so then add memory, otherwise compress that cache before adding
-    def cache_memory(self, memory, tokens, depth):
+    ## Check to see if cache as room, if so then add memory, otherwise queue the cache for compression before adding
+    def cache_memory(self, memory, tokens, depth, index = True):
         debug_message('adding memory to cache (%s)' % str(depth), self.debug_messages_enabled)
-        if self.__episodic_memory_caches[int(depth)].has_memory_space(tokens):
-            debug_message('There is enough space in the cache...', self.debug_messages_enabled)
-            self.__episodic_memory_caches[int(depth)].add_memory(memory, tokens)
-        else:
-            debug_message('There is not enough space in the cache (%s), compressing...' % str(depth), self.debug_messages_enabled)    
-            self.compress_memory_cache(depth)
-            debug_message('Flushing cache of depth (%s)...' % str(depth), self.debug_messages_enabled)
-            self.__episodic_memory_caches[int(depth)].flush_memory_cache()
-            # Add the new message to the recently flushed memory cache
-            self.__episodic_memory_caches[int(depth)].add_memory(memory, tokens)
-        debug_message('Saving state...', self.debug_messages_enabled)
-        self.index_memory(memory)
-        self.save_state()
+        with self.__state_lock:
+            cache = self.get_cache(depth)
+            if not self.needs_compression(depth, tokens):
+                debug_message('There is enough space in the cache...', self.debug_messages_enabled)
+            else:
+                debug_message('There is not enough space in the cache (%s), compressing...' % str(depth), self.debug_messages_enabled)    
+                self.compress_memory_cache(depth)
+            cache.add_memory(memory, tokens)
+            debug_message('Saving state...', self.debug_messages_enabled)
+            self.save_state()
+        if index:
+            self.index_memory(memory)
 
+    ## Returns the new memory, its tokens, and whether a compression was queued
     def create_new_memory(self, speaker, content):
-        compression_occurred = False
-        episodic_memory = None
-        episodic_tokens = 0
+        compression_queued = False
         depth = 0
         memory, tokens = self.generate_eidetic_memory(speaker, content)
         debug_message('adding memory to cache (%s)' % str(depth), self.debug_messages_enabled)
-        if self.__episodic_memory_caches[depth].has_memory_space(tokens):
-            debug_message('There is enough space in the cache...', self.debug_messages_enabled)
-            self.__episodic_memory_caches[depth].add_memory(memory, tokens)
-        else:
-            debug_message('There is not enough space in the cache, compressing...', self.debug_messages_enabled)
-            self.compress_memory_cache(depth)
-            self.__episodic_memory_caches[depth].flush_memory_cache()
-            self.__episodic_memory_caches[depth].add_memory(memory, tokens)
-            compression_occurred = True
+        with self.__state_lock:
+            cache = self.get_cache(depth)
+            if not self.needs_compression(depth, tokens):
+                debug_message('There is enough space in the cache...', self.debug_messages_enabled)
+            else:
+                debug_message('There is not enough space in the cache, compressing...', self.debug_messages_enabled)
+                compression_queued = self.compress_memory_cache(depth) is not None
+            cache.add_memory(memory, tokens)
+            if speaker == 'RAVEN' or compression_queued:
+                debug_message('Saving state...', self.debug_messages_enabled)
+                self.save_state()
         self.index_memory(memory)
-        if speaker == 'RAVEN':
-            debug_message('Saving state...', self.debug_messages_enabled)
-            self.save_state()
 
-        return memory, tokens, compression_occurred
+        return memory, tokens, compression_queued
 
-    ## Summarize all active memories and return the new memory id
-    ## TODO: This process could cascade several memory caches, but only depth 1 caches will be returned.
-    ## Need to account for this by passing a list down the line, then let the conversation manager
-    ## decide how to utilize the returned memories. will figure that out when I am less drunk.
+    ## Register a function to call (with the finished job) whenever a compression job completes
+    def add_compression_listener(self, listener):
+        self.__compression_listeners.append(listener)
+
+    ## Snapshot the cache of the given depth, flush it so it can take new memories right away, and queue the snapshot for compression.
+    ## The summary is added to the next depth's cache when the job runs, which may cascade into more jobs. Each depth holds a
+    ## cache full of summaries of the depth below, so the number of depths grows with the logarithm of the conversation length.
+    ## At the deepest allowed depth the cache is only flushed; its memories stay in the database but are not summarized further.
+    ## Returns the queued job, if there is one.
     def compress_memory_cache(self, depth):
-        debug_message('Compressing cache of depth (%s)...' % str(depth), self.debug_messages_enabled)
-        ## Get a copy of the cached memories
-        memories = self.__episodic_memory_caches[int(depth)].memories
+        if not self.can_compress_depth(depth):
+            debug_message('Cache depth (%s) is the deepest allowed, flushing without compression...' % str(depth), self.debug_messages_enabled)
+            with self.__state_lock:
+                self.get_cache(depth).flush_memory_cache()
+            return None
+        debug_message('Queueing compression of cache depth (%s)...' % str(depth), self.debug_messages_enabled)
+        with self.__state_lock:
+            cache = self.get_cache(depth)
+            job = create_row_object(
+                table_name='Compression_Jobs',
+                id=str(uuid4()),
+                depth=int(depth),
+                memory_ids=cache.memory_ids.copy(),
+                source_cache_id=cache.id,
+                status='pending',
+                attempts=0,
+                created_on=time(),
+                modified_on=time()
+            )
+            sql_insert_row('Compression_Jobs','id',job)
+            self.__compression_job_memories[job['id']] = cache.memories
+            debug_message('Flushing cache of depth (%s)...' % str(depth), self.debug_messages_enabled)
+            self.run_compression_step(job['id'], 'flush', lambda: self.flush_for_job(job))
+        if self.__background_compression_enabled:
+            self.__compression_queue.put(job['id'])
+        else:
+            self.run_compression_job(job['id'])
+        return job
+
+    ## Queue any jobs left unfinished when the program last stopped
+    def resume_compression_jobs(self):
+        max_attempts = int(self.__config['memory_management']['compression_max_attempts'])
+        unfinished_jobs = sql_custom_query("select * from Compression_Jobs where status in ('pending','running','failed') and attempts < ? order by created_on", max_attempts)
+        for job in unfinished_jobs:
+            debug_message(f"Resuming compression job {job['id']}...", self.debug_messages_enabled)
+            ## A crash between queueing the job and saving the state leaves the job's memories in the loaded cache
+            with self.__state_lock:
+                self.run_compression_step(job['id'], 'flush', lambda: self.flush_for_job(job))
+            if self.__background_compression_enabled:
+                self.__compression_queue.put(job['id'])
+            else:
+                self.run_compression_job(job['id'])
+
+    def __compression_worker(self):
+        while True:
+            job_id = self.__compression_queue.get()
+            try:
+                with telemetry_stage('compression'):
+                    self.run_compression_job(job_id)
+            except Exception as err:
+                debug_message(f"Compression job {job_id} failed: {err}", True)
+            finally:
+                self.__compression_queue.task_done()
+
+    ## Flush the cache a job was made from, unless it has been flushed already
+    def flush_for_job(self, job):
+        with self.__state_lock:
+            cache = self.get_cache(job['depth'])
+            if cache.id == job['source_cache_id']:
+                cache.flush_memory_cache()
+                self.save_state()
+            return {'cache_id': cache.id}
 
-        debug_message('Pushing compressed memory to cache of depth (%s)...' % str(int(depth)+1), self.debug_messages_enabled)
-        ## Generate a higher depth memory
-        episodic_memory, episodic_tokens = self.generate_episodic_memory(memories, int(depth)+1)
+    ## Add a compression job's memory to the next cache unless a saved cache already holds it
+    def cache_job_memory(self, memory, tokens, depth):
+        with self.__state_lock:
+            cached = sql_custom_query("select c.id from Memory_Caches as c, json_each(c.memory_ids) as j where j.value = ? limit 1", memory['id'])
+            if len(cached) == 0:
+                self.cache_memory(memory, tokens, depth, index = False)
+        return {'memory_id': memory['id']}
 
-        ## Add the new memory to the cache
-        self.cache_memory(episodic_memory, episodic_tokens, int(depth)+1)
-        debug_message('Flushing cache of depth (%s)...' % str(depth), self.debug_messages_enabled)
-        self.__episodic_memory_caches[int(depth)].flush_memory_cache()
-        return episodic_memory, episodic_tokens
+    ## Block until every queued compression has finished
+    def wait_for_compression(self):
+        if self.__background_compression_enabled:
+            self.__compression_queue.join()
 
+    ## Summarize the memories captured by a compression job and push the summary to the next depth
+    def run_compression_job(self, job_id):
+        jobs = sql_query_by_ids('Compression_Jobs', 'id', job_id)
+        if len(jobs) == 0 or jobs[0]['status'] == 'completed':
+            return
+        job = jobs[0]
+        depth = int(job['depth'])
+        sql_update_row('Compression_Jobs', 'id', {'id': job_id, 'status': 'running', 'attempts': int(job['attempts']) + 1, 'modified_on': time()})
+        try:
+            ## Jobs resumed after a restart have no snapshot and load their memories from the database
+            memories = self.__compression_job_memories.pop(job_id, None)
+            if memories is None:
+                memories = sql_query_by_ids('Memories', 'id', job['memory_ids'])
+            memories = sorted(memories, key=lambda m: float(m['created_on']))
+            debug_message('Pushing compressed memory to cache of depth (%s)...' % str(depth+1), self.debug_messages_enabled)
+            ## Generate a higher depth memory and add it to the cache
+            episodic_memory, episodic_tokens = self.generate_episodic_memory(memories, depth+1, job_id)
+            self.run_compression_step(job_id, 'cache', lambda: self.cache_job_memory(episodic_memory, episodic_tokens, depth+1))
+            self.run_compression_step(job_id, 'index', lambda: self.index_memory(episodic_memory) or {'memory_id': episodic_memory['id']})
+        except Exception as err:
+            sql_update_row('Compression_Jobs', 'id', {'id': job_id, 'status': 'failed', 'error': str(err), 'modified_on': time()})
+            raise
+        job['status'] = 'completed'
+        job['result_memory_id'] = episodic_memory['id']
+        sql_update_row('Compression_Jobs', 'id', {'id': job_id, 'status': 'completed', 'result_memory_id': episodic_memory['id'], 'error': None, 'modified_on': time()})
+        for listener in self.__compression_listeners:
+            try:
+                listener(job)
+            except Exception as err:
+                debug_message(f"Compression listener failed: {err}", True)
 
-    def summarize_content(self, content, depth, speaker = '', content_tokens = 0):
+    ## A prompt id can be given so a response already saved under it is reused instead of prompting again.
+    ## A failed request is saved with -1 tokens, never reused, and raised so a compression step does not record it as the summary.
+    def summarize_content(self, content, depth, speaker = '', content_tokens = 0, prompt_id = None):
+        if prompt_id is not None:
+            saved_prompts = sql_query_by_ids('Prompts', 'id', prompt_id)
+            if len(saved_prompts) > 0 and saved_prompts[0]['response'] and int(saved_prompts[0]['tokens'] or 0) >= 0:
+                debug_message(f"Reusing saved summary {prompt_id}...", self.debug_messages_enabled)
+                return str(saved_prompts[0]['response'])
         ## Choose which memory processing prompt to use
         if int(depth) == 0:
+            prompt_type = 'EideticSummary'
             prompt = self.__prompts.EideticSummary.get_prompt(speaker, content)
             response_tokens = self.__prompts.EideticSummary.response_tokens
             temperature = self.__prompts.EideticSummary.temperature
         elif int(depth) == 1:
+            prompt_type = 'EideticToEpisodicSummary'
             prompt = self.__prompts.EideticToEpisodicSummary.get_prompt(content)
             response_tokens = self.__prompts.EideticToEpisodicSummary.response_tokens
             temperature = self.__prompts.EideticToEpisodicSummary.temperature
         else:
+            prompt_type = 'EpisodicSummary'
             prompt = self.__prompts.EpisodicSummary.get_prompt(content)
             response_tokens = self.__prompts.EpisodicSummary.response_tokens
             temperature = self.__prompts.EpisodicSummary.temperature
 
         messages = [compose_gpt_message(prompt,'user')]
-        memory_element, total_tokens = gpt_completion(messages, temperature, response_tokens)
+        memory_element, total_tokens = gpt_completion(messages, temperature, response_tokens, priority=PRIORITY_BACKGROUND, prompt_type=prompt_type)
         ## Save prompt and response
         prompt_row = create_row_object(
             table_name='Prompts',
-            id=str(uuid4()),
+            id=prompt_id if prompt_id is not None else str(uuid4()),
             prompt=prompt,
             response=memory_element,
             tokens=total_tokens,
@@ -423,6 +711,8 @@ class MemoryManager:
             created_on=time()
         )
         sql_insert_row('Prompts','id',prompt_row)
+        if int(total_tokens) < 0:
+            raise RuntimeError(f"Summarization of memories at depth {depth} failed: {memory_element}")
         return memory_element
 
     ## Save memory locally, update local child memories, and save memory vector to pinecone
@@ -434,16 +724,132 @@ class MemoryManager:
         memory_datetime = timestamp_to_detailed_datetime(memory['created_on'])
         memory_summary = f"[{memory_datetime}]\n{str(memory['summary'])}"
         debug_message('indexing memory (%s)' % memory_id, self.debug_messages_enabled)
-        vector = gpt3_embedding(memory_summary)
+        vector = gpt3_embedding(memory_summary, PRIORITY_BACKGROUND)
         ## The metadata and namespace are redundant but I need the data split for later
         metadata = {'memory_type': 'episodic', 'depth': str(depth)}
         namespace = self.__config['memory_management']['memory_namespace_template'] % depth
         save_vector_to_pinecone(vector, memory_id, metadata, namespace)
 
-    ## TODO: Raven will need a form of temporal recall as well
-        # Temporal categorization can mostly be done programatically but some aspects will need subprompt processing
-        # This will get tricky when it comes to decoding phrases like 'yesterday' or 'last time' considering each message
-        # by the User could be days apart but still consolidated into the same context
+    ## Recall by time instead of by meaning. Questions like 'what did we talk about yesterday' or 'where were we last time' are
+    ## resolved locally into a time range, and memories from that range are read with an indexed range scan. The current
+    ## conversation and the given active memories (already in the prompt) are left out.
+    ## Returns None if the message does not ask about a time, otherwise recalled memories like relevant_memory_recall's.
+    def temporal_memory_recall(self, message, now = None, active_memory_ids = None):
+        time_range = resolve_recall_time_range(message, now)
+        if time_range is None:
+            return None
+        if time_range.get('session') == 'previous':
+            session_range = self.get_previous_session_range(now)
+            if session_range is None:
+                debug_message('There is no previous conversation to recall.', self.debug_messages_enabled)
+                return []
+            time_range.update(session_range)
+        session_start = self.get_current_session_start(now)
+        if session_start is not None:
+            time_range['end'] = min(time_range['end'], session_start)
+        if time_range['start'] >= time_range['end']:
+            debug_message(f"'{time_range['phrase']}' is the current conversation; nothing to recall by time.", self.debug_messages_enabled)
+            return []
+        debug_message(f"Recalling memories from '{time_range['phrase']}' ({timestamp_to_datetime(time_range['start'])} to {timestamp_to_datetime(time_range['end'])})...", self.debug_messages_enabled)
+        active_memory_ids = set(active_memory_ids or [])
+        return [r for r in self.recall_time_range(time_range['start'], time_range['end'], time_range['phrase']) if r['memory']['id'] not in active_memory_ids]
+
+    ## When the current conversation began: the first message after the most recent pause of at least session_gap_seconds
+    def get_current_session_start(self, now = None):
+        now = time() if now is None else float(now)
+        gap_seconds = float(self.__config['memory_management']['session_gap_seconds'])
+        later_time = None
+        for page in sql_query_pages('select created_on from Memories where depth = 0 and created_on < ? order by created_on desc', now, int(self.__config['memory_management']['expansion_page_size'])):
+            for row in page:
+                created_on = float(row['created_on'])
+                if (now if later_time is None else later_time) - created_on >= gap_seconds:
+                    return now if later_time is None else later_time
+                later_time = created_on
+        return later_time
+
+    ## The start and end of the conversation before the current one. Conversations are separated by a pause of at least session_gap_seconds.
+    ## Messages are read newest first, a page at a time, only until the second pause is found.
+    def get_previous_session_range(self, now = None):
+        now = time() if now is None else float(now)
+        gap_seconds = float(self.__config['memory_management']['session_gap_seconds'])
+        session_end = None
+        later_time = now
+        for page in sql_query_pages('select created_on from Memories where depth = 0 and created_on < ? order by created_on desc', now, int(self.__config['memory_management']['expansion_page_size'])):
+            for row in page:
+                created_on = float(row['created_on'])
+                if later_time - created_on >= gap_seconds:
+                    if session_end is not None:
+                        return {'start': later_time, 'end': session_end}
+                    session_end = created_on + 1.0
+                later_time = created_on
+        if session_end is None:
+            return None
+        return {'start': later_time, 'end': session_end}
+
+    ## Memories from a time range, from the coarsest depth which covers it. A depth covers the range if every message sent in
+    ## it has been summarized into a memory of that depth, and at least temporal_min_precision of those memories' messages
+    ## fall inside the range (so one summary of a whole month does not answer for a single day). Too many tokens falls back
+    ## to a coarser depth, and past the coarsest to the most recent memories.
+    def recall_time_range(self, start, end, phrase = ''):
+        memory_config = self.__config['memory_management']
+        token_limit = int(memory_config['temporal_recall_token_limit'])
+        min_precision = float(memory_config['temporal_min_precision'])
+        ## Every ancestor (and the message itself) of each message in the range, with how many of its messages are in range
+        candidates = sql_custom_query('''
+            select
+                m.*
+                ,count(*) as range_leaves
+                ,(select count(*) from Memory_Closure as t join Memories as l on l.id = t.descendant_id where t.ancestor_id = m.id and l.depth = 0) as total_leaves
+            from
+                Memories as leaf
+            join
+                Memory_Closure as c on c.descendant_id = leaf.id
+            join
+                Memories as m on m.id = c.ancestor_id
+            where
+                leaf.depth = 0
+                and leaf.created_on >= ?
+                and leaf.created_on < ?
+            group by
+                m.id
+            ''', (float(start), float(end)))
+        if len(candidates) == 0:
+            return []
+        by_depth = {}
+        for memory in candidates:
+            by_depth.setdefault(int(memory['depth']), []).append(memory)
+        leaf_count = len(by_depth.get(0, []))
+        covering_depths = []
+        for depth in sorted(by_depth.keys(), reverse=True):
+            memories = by_depth[depth]
+            if sum(m['range_leaves'] for m in memories) < leaf_count:
+                continue
+            covering_depths.append(depth)
+        chosen_depth = 0
+        for depth in covering_depths:
+            memories = by_depth[depth]
+            if sum(m['range_leaves'] for m in memories) / max(sum(m['total_leaves'] for m in memories), 1) >= min_precision:
+                chosen_depth = depth
+                break
+        ## Coarser covering depths are tried in turn if the chosen one is too long
+        for depth in [d for d in covering_depths if d > chosen_depth][::-1]:
+            if sum(int(m['summary_tokens']) for m in by_depth[chosen_depth]) <= token_limit:
+                break
+            chosen_depth = depth
+        memories = sorted(by_depth[chosen_depth], key=lambda m: float(m['created_on']))
+        recalled_memories = []
+        token_count = 0
+        for memory in reversed(memories):
+            token_count += int(memory['summary_tokens'])
+            if token_count > token_limit and len(recalled_memories) > 0:
+                break
+            coverage = memory['range_leaves'] / max(memory['total_leaves'], 1)
+            recalled_memories.append({
+                'memory': {k: v for k, v in memory.items() if k not in ('range_leaves', 'total_leaves')},
+                'score': coverage,
+                'metadata': {'temporal_phrase': phrase, 'temporal_depth': chosen_depth, 'range_start': float(start), 'range_end': float(end)}
+            })
+        return recalled_memories[::-1]
 
     ## Memory recall happens in two phases (for now). Direct recall and thematic recall.
     ## Direct recall is a vector search on depth-0 memories, almost like a keyword search.
@@ -461,19 +867,110 @@ class MemoryManager:
         # Neither recalls produce strong candidates
             # Recall was not successful, leave the section blank or notify Raven
 
-    ## Return recalled memory ids and a boolean if the recall returned results
-    def memory_recall(self, most_recent_message, conversation_log):
+    ## Proper nouns in the message which do not appear in the rest of the conversation
+    def find_new_proper_nouns(self, message, context):
+        context_words = set(w.lower() for w in re.findall(r"[A-Za-z][A-Za-z'-]+", context))
+        proper_nouns = []
+        for sentence in re.split(r"[.!?\n]+", message):
+            words = re.findall(r"[A-Za-z][A-Za-z'-]+", sentence)
+            ## The first word of a sentence is capitalized anyway, so it says nothing about being a name
+            for word in words[1:]:
+                if word[0].isupper() and word not in ('I', 'RAVEN', 'USER') and word.lower() not in context_words and word not in proper_nouns:
+                    proper_nouns.append(word)
+        return proper_nouns
+
+    ## Of the given words, return those which are part of a known theme phrase. One query covers every word.
+    def find_known_entities(self, words):
+        if len(words) == 0:
+            return []
+        conditions = ' or '.join('lower(phrases) like ?' for _ in words)
+        matching_themes = sql_custom_query(f"select phrases from Themes where {conditions}", [f"%{w.lower()}%" for w in words])
+        theme_words = set()
+        for theme in matching_themes:
+            phrases = theme['phrases'] if type(theme['phrases']) == list else [str(theme['phrases'])]
+            for phrase in phrases:
+                theme_words.update(re.findall(r"[a-z][a-z'-]+", str(phrase).lower()))
+        return [w for w in words if w.lower() in theme_words]
+
+    ## Cheap local check in front of the RecallExtraction prompt. Returns a decision and what it was based on:
+    ##   force: the message names known lore which is not in the active conversation, recall without asking
+    ##   skip: the message closely follows the active conversation and introduces no new names
+    ##   ask: not confident either way, let the RecallExtraction prompt decide
+    def recall_gate(self, most_recent_message, conversation_log):
+        memory_config = self.__config['memory_management']
+        ## Compare the message against the rest of the conversation, not against itself
+        context = conversation_log
+        message_position = conversation_log.rfind(most_recent_message)
+        if message_position >= 0:
+            context = conversation_log[:message_position]
+        new_proper_nouns = self.find_new_proper_nouns(most_recent_message, context)
+        known_entities = self.find_known_entities(new_proper_nouns)
+        gate = {'decision': 'ask', 'similarity': None, 'proper_nouns': new_proper_nouns, 'known_entities': known_entities}
+        if len(known_entities) > 0:
+            gate['decision'] = 'force'
+            gate['reason'] = 'Message names known lore which is not in the active conversation.'
+            return gate
+        if context.strip() == '' or len(new_proper_nouns) > 0:
+            gate['reason'] = 'Message introduces unknown names or has no prior conversation to compare against.'
+            return gate
+        similarity = cosine_similarity(gpt3_embedding(most_recent_message), gpt3_embedding(context))
+        gate['similarity'] = similarity
+        if similarity >= float(memory_config['recall_gate_skip_similarity']):
+            gate['decision'] = 'skip'
+            gate['reason'] = 'Message is a close follow-up to the active conversation.'
+        else:
+            gate['reason'] = 'Message is not clearly a follow-up.'
+        return gate
+
+    ## Keep every gate decision so skipped or forced recalls can be audited later
+    def log_recall_gate(self, most_recent_message, gate):
+        gate_row = create_row_object(
+            table_name='Recall_Gate_Decisions',
+            id=str(uuid4()),
+            message=most_recent_message,
+            decision=gate['decision'],
+            reason=gate['reason'],
+            similarity=gate['similarity'],
+            proper_nouns=gate['proper_nouns'],
+            known_entities=gate['known_entities'],
+            created_on=time()
+        )
+        self.__tasks.run_in_background(sql_insert_row, 'Recall_Gate_Decisions', 'id', gate_row)
+
+    ## Return recalled memories (see hydrate_memory_matches, in relevance order) and a boolean if the recall returned results
+    ## Memories already part of the conversation (active_memory_ids) are not recalled by time
+    def memory_recall(self, most_recent_message, conversation_log, active_memory_ids = None):
         debug_message('Beginning memory recall.', self.debug_messages_enabled)
         if conversation_log == '':
-            breakpoint('Conversation log is empty. Skipping memory recall...')
+            debug_message('Conversation log is empty. Skipping memory recall...', self.debug_messages_enabled)
             return [], False
+        ## Questions about a time are answered from that time, without a search or relevancy check.
+        ## If nothing is found in that time the message is recalled as usual.
+        if self.__config.getboolean('memory_management', 'temporal_recall_enabled'):
+            temporal_memories = self.temporal_memory_recall(most_recent_message, active_memory_ids = active_memory_ids)
+            if temporal_memories is not None and len(temporal_memories) > 0:
+                return temporal_memories, True
+        ## Let the local gate settle the obvious cases without a completion
+        if self.__config.getboolean('memory_management', 'recall_gate_enabled'):
+            gate = self.recall_gate(most_recent_message, conversation_log)
+            self.log_recall_gate(most_recent_message, gate)
+            debug_message(f"Recall gate decided to {gate['decision']}: {gate['reason']}", self.debug_messages_enabled)
+            if gate['decision'] == 'skip':
+                return [], False
+            if gate['decision'] == 'force':
+                recalled_hyde = 'The USER is referring to %s.' % ', '.join(gate['known_entities'])
+                return self.relevant_memory_recall(recalled_hyde, most_recent_message)
         ## Determine if memory recall is necessary:
         recall_prompt = self.__prompts.RecallExtraction.get_prompt(conversation_log)
         recall_response_tokens = self.__prompts.RecallExtraction.response_tokens
         recall_temperature = self.__prompts.RecallExtraction.temperature
         recall_instructions = self.__prompts.RecallExtraction.system_instructions
         recall_messages = [compose_gpt_message(recall_instructions,'system'), compose_gpt_message(recall_prompt,'user')]
-        recall_element, recall_total_tokens = gpt_completion(recall_messages, recall_temperature, recall_response_tokens)
+        try:
+            recall_obj, recall_element, recall_total_tokens = gpt_structured_completion(recall_messages, self.__prompts.RecallExtraction.response_schema, recall_temperature, recall_response_tokens, prompt_type='RecallExtraction')
+        except StructuredOutputError as err:
+            debug_message(f"Issue processing memory recall extraction object: {err}", self.debug_messages_enabled)
+            recall_obj, recall_element, recall_total_tokens = None, err.response, -1
         ## Save recall prompt and response
         recall_prompt_row = create_row_object(
             table_name='Prompts',
@@ -486,11 +983,9 @@ class MemoryManager:
             comments='Checking if memory recall is needed.',
             created_on=time()
         )
-        sql_insert_row('Prompts','id',recall_prompt_row)
+        self.__tasks.run_in_background(sql_insert_row, 'Prompts', 'id', recall_prompt_row)
         
-        recall_obj = string_to_json(recall_element)
-        if 'sufficient_information' not in recall_obj:
-            debug_message('Issue processing memory recall extraction object.', self.debug_messages_enabled)
+        if recall_obj is None:
             return [], False
 
         if recall_obj['sufficient_information']:
@@ -499,73 +994,394 @@ class MemoryManager:
 
         ## Recall determined that more information is needed. Perform an explict search against the user's most recent message
         recalled_hyde = recall_obj['reasoning'] + ('' if (recall_obj['required_information'] == '') else '\n%s' % recall_obj['required_information'])
-        relevant_result_obj = self.explicit_memory_recall(recalled_hyde, most_recent_message)
+        return self.relevant_memory_recall(recalled_hyde, most_recent_message)
+
+    ## Search for memories and keep those the relevancy check marked as pertinent
+    def relevant_memory_recall(self, recalled_hyde, most_recent_message):
+        relevant_result_obj, recalled_memories = self.explicit_memory_recall(recalled_hyde, most_recent_message)
 
         if 'pertinent_information_present' not in relevant_result_obj:
             debug_message('Memory relevancy didn''t return any results...', self.debug_messages_enabled)
             return [], False
         elif relevant_result_obj['pertinent_information_present']:
-            return relevant_result_obj['relevant_information_ids'], True
+            ## Keep the vector-score order of the recalled memories and reuse the rows loaded during recall
+            relevant_ids = set(relevant_result_obj['relevant_information_ids'])
+            relevant_memories = [r for r in recalled_memories.values() if r['memory']['id'] in relevant_ids]
+            return relevant_memories, True
         return [], False
 
+    ## Load all matched memories in a single query.
+    ## Returns a dictionary keyed by memory id, in the same order as the matches, holding the memory row and its match metadata.
+    def hydrate_memory_matches(self, matches):
+        if len(matches) == 0:
+            return {}
+        memory_rows = {m['id']: m for m in sql_query_by_ids('Memories', 'id', [m['id'] for m in matches])}
+        recalled_memories = {}
+        for match_memory in matches:
+            match_id = match_memory['id']
+            if match_id not in memory_rows:
+                debug_message(f"Unable to find memory {match_id}", self.debug_messages_enabled)
+                continue
+            recalled_memories[match_id] = {
+                'memory': memory_rows[match_id],
+                'score': float(match_memory['score']),
+                'metadata': match_memory['metadata']
+            }
+        return recalled_memories
+
+    ## Turn free text into an FTS5 query which matches any of its meaningful words
+    def build_lexical_query(self, text):
+        stop_words = {'the','and','for','are','but','not','you','your','what','when','where','who','how','why','was','were','this','that','with','from','have','has','had','they','them','then','than','there','their','about','into','would','could','should','does','did','will','can','its','our','out','any','all','some','more','need','needs','information','user','raven'}
+        terms = []
+        for word in re.findall(r"[A-Za-z0-9]+", text):
+            term = word.lower()
+            if len(term) < 3 or term in stop_words or term in terms:
+                continue
+            terms.append(term)
+        return ' OR '.join(f'"{t}"' for t in terms)
+
+    ## Lexical (BM25) search of memory contents. Returns ids in rank order.
+    def lexical_memory_search(self, query_string, depth, top_k):
+        match_query = self.build_lexical_query(query_string)
+        if match_query == '':
+            return []
+        try:
+            results = sql_fulltext_search(match_query, depth, top_k)
+        except sqlite3.OperationalError as err:
+            debug_message(f"Lexical memory search failed: {err}", self.debug_messages_enabled)
+            return []
+        return [r['id'] for r in results]
+
+    ## Vector search of memory contents. Matches under the threshold are dropped. Returns (id, score) pairs in rank order.
+    def vector_memory_search(self, query_string, depth, top_k, threshold):
+        query_vector = gpt3_embedding(query_string)
+        query_namespace = (self.__config['memory_management']['memory_namespace_template']) % int(depth)
+        query_results = query_pinecone(vector = query_vector, return_n = top_k, namespace = query_namespace)
+        if query_results is None:
+            return []
+        return [(m['id'], float(m['score'])) for m in query_results['matches'] if float(m['score']) >= threshold]
+
+    ## Run a callable and record how long it took under the given source name
+    def __timed_search(self, source, timings, search, *args):
+        start_time = time()
+        try:
+            return search(*args)
+        finally:
+            timings[source] = time() - start_time
+
+    ## Run the lexical and vector searches concurrently and merge them with reciprocal-rank fusion.
+    ## Returns match objects (id, score, metadata) ordered by fused score, best first.
+    def hybrid_memory_recall(self, query_string, depth = 0, top_k = None, threshold = None, candidate_count = None):
+        memory_config = self.__config['memory_management']
+        if threshold is None:
+            threshold = float(memory_config['recall_match_threshold'])
+        if top_k is None:
+            top_k = int(memory_config['recall_top_k'])
+        if candidate_count is None:
+            candidate_count = int(memory_config['recall_candidate_count'])
+        rrf_k = int(memory_config['recall_rrf_k'])
+        lexical_enabled = self.__config.getboolean('memory_management', 'recall_lexical_enabled')
+
+        timings = {}
+        start_time = time()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            vector_future = executor.submit(self.__timed_search, 'vector', timings, self.vector_memory_search, query_string, depth, top_k, threshold)
+            lexical_future = None
+            if lexical_enabled:
+                lexical_future = executor.submit(self.__timed_search, 'lexical', timings, self.lexical_memory_search, query_string, depth, top_k)
+            vector_results = vector_future.result()
+            lexical_results = lexical_future.result() if lexical_future is not None else []
+        timings['total'] = time() - start_time
+        self.last_recall_timings = timings
+        debug_message('Hybrid recall timings: ' + ', '.join(f"{k}={v*1000:.0f}ms" for k, v in timings.items()), self.debug_messages_enabled)
+
+        ## Reciprocal-rank fusion: each source contributes 1/(k + rank) for every memory it returned
+        fused = {}
+        for rank, (memory_id, vector_score) in enumerate(vector_results, start=1):
+            match = fused.setdefault(memory_id, {'id': memory_id, 'score': 0.0, 'metadata': {}})
+            match['score'] += 1.0 / (rrf_k + rank)
+            match['metadata']['vector_rank'] = rank
+            match['metadata']['vector_score'] = vector_score
+        for rank, memory_id in enumerate(lexical_results, start=1):
+            match = fused.setdefault(memory_id, {'id': memory_id, 'score': 0.0, 'metadata': {}})
+            match['score'] += 1.0 / (rrf_k + rank)
+            match['metadata']['lexical_rank'] = rank
+        ranked_matches = sorted(fused.values(), key=lambda m: m['score'], reverse=True)
+        return ranked_matches[:candidate_count]
+
+    ## Yield pages of a memory's subtree (the memory itself first), top down and oldest first within each depth.
+    ## A max distance of 1 gives just the memory and its children.
+    def iter_memory_subtree(self, memory_id, max_distance = None, page_size = None):
+        if page_size is None:
+            page_size = int(self.__config['memory_management']['expansion_page_size'])
+        query = '''
+            select m.*, c.distance as distance from Memory_Closure as c join Memories as m on m.id = c.descendant_id
+            where c.ancestor_id = ? and c.distance <= ?
+            order by c.distance, m.created_on
+            '''
+        ## Subtrees are only as deep as the deepest memory, so no limit is the same as a limit past any depth
+        max_distance = len(self.__episodic_memory_caches) if max_distance is None else int(max_distance)
+        yield from sql_query_pages(query, (memory_id, max_distance), page_size)
+
+    ## Yield pages of the eidetic memories (the original messages) summarized into a memory, oldest first, optionally within a time range
+    def iter_eidetic_leaves(self, memory_id, start_time = None, end_time = None, page_size = None):
+        if page_size is None:
+            page_size = int(self.__config['memory_management']['expansion_page_size'])
+        query = '''
+            select m.* from Memory_Closure as c join Memories as m on m.id = c.descendant_id
+            where c.ancestor_id = ? and m.depth = 0 and m.created_on >= ? and m.created_on <= ?
+            order by m.created_on
+            '''
+        start_time = float('-inf') if start_time is None else float(start_time)
+        end_time = float('inf') if end_time is None else float(end_time)
+        yield from sql_query_pages(query, (memory_id, start_time, end_time), page_size)
+
+    ## Every summary a memory was compressed into, nearest first
+    def get_memory_ancestors(self, memory_id):
+        return sql_custom_query('''
+            select m.*, c.distance as distance from Memory_Closure as c join Memories as m on m.id = c.ancestor_id
+            where c.descendant_id = ? and c.distance > 0
+            order by c.distance
+            ''', memory_id)
+
+    ## Recall starting from coarse summaries and drill down only into the most promising of them.
+    ## The summaries at the start depth are found with hybrid recall, then only memories of the target depth summarized
+    ## into the best few are searched, which is much cheaper than searching (and reading) every memory of that depth.
+    ## Returns match objects (id, score, metadata) like hybrid_memory_recall, with the branch each match was found under.
+    def zoom_in_recall(self, query_string, start_depth, target_depth = 0, branch_count = None, top_k = None):
+        memory_config = self.__config['memory_management']
+        if branch_count is None:
+            branch_count = int(memory_config['zoom_branch_count'])
+        if top_k is None:
+            top_k = int(memory_config['recall_top_k'])
+        rrf_k = int(memory_config['recall_rrf_k'])
+        if int(start_depth) <= int(target_depth):
+            return self.hybrid_memory_recall(query_string, target_depth, top_k)
+        branches = self.hybrid_memory_recall(query_string, start_depth, candidate_count = branch_count)
+        if len(branches) == 0:
+            return []
+        branch_ranks = {branch['id']: rank for rank, branch in enumerate(branches, start=1)}
+        match_query = self.build_lexical_query(query_string)
+        if match_query == '':
+            return []
+        try:
+            results = sql_fulltext_search(match_query, target_depth, top_k, list(branch_ranks.keys()))
+        except sqlite3.OperationalError as err:
+            debug_message(f"Zoom in recall failed: {err}", self.debug_messages_enabled)
+            return []
+        ## A match is ranked by its own lexical rank and the rank of the branch it came from
+        matches = []
+        for rank, result in enumerate(results, start=1):
+            branch_id = result['ancestor_id']
+            score = 1.0 / (rrf_k + rank) + 1.0 / (rrf_k + branch_ranks[branch_id])
+            matches.append({'id': result['id'], 'score': score, 'metadata': {'lexical_rank': rank, 'branch_id': branch_id, 'branch_rank': branch_ranks[branch_id]}})
+        return sorted(matches, key=lambda m: m['score'], reverse=True)
+
     ## TODO: If the explicit memory recall fails to produce results then thematic search and a lower threshold explicit search will be needed
-    def explicit_memory_recall(self, hyde_query, most_recent_message, threshold = 0.8):
+    ## Returns the relevancy object and the recalled memories (see hydrate_memory_matches) so later stages do not need to re-query them
+    def explicit_memory_recall(self, hyde_query, most_recent_message, threshold = None, top_k = None):
         relevant_obj = {}
-        relevant_results = ''
 
         query_string = '%s\nUSER:\n%s' % (hyde_query, most_recent_message)
-        query_vector = gpt3_embedding(query_string)
-        query_namespace = (self.__config['memory_management']['memory_namespace_template']) % 0
-        query_results = query_pinecone(vector = query_vector, return_n = 10, namespace = query_namespace)
-
-        if query_results is not None:
-            if len(query_results['matches']) > 0:
-                relevant_content = ''
-                recalled_memories = {}
-                for match_memory in query_results['matches']:
-                    if match_memory['score'] < 0.8:
-                        continue
-                    ## Load memory file
-                    memories = sql_query_by_ids('Memories', 'id', [match_memory['id']])
-                    if len(memories) == 0:
-                        breakpoint(f"Unable to find memory {match_memory['id']}")
-                        continue
-                    memory_obj = memories[0]
-                    ## Get memory contents
-                    memory_id = memory_obj['id']
-                    memory_date = timestamp_to_datetime(memory_obj['created_on'])
-                    memory_content = memory_obj['content']
-                    memory_speaker = memory_obj['speaker']
-                    relevant_information_content = f"[\nINFORMATION ID: {memory_id}\nRECORDED ON: {memory_date}\nFROM: {memory_speaker}\nCONTENT: {memory_content}\n]\n"
-
-                    recalled_memories[memory_id] = memory_obj
-                    ## Append for relevant content body
-                    relevant_content += relevant_information_content
-                ## Determine if recalled memories are relevant:
-                relevant_prompt = self.__prompts.RecallRelevancy.get_prompt(most_recent_message, hyde_query, relevant_content)
-                relevant_response_tokens = self.__prompts.RecallRelevancy.response_tokens
-                relevant_temperature = self.__prompts.RecallRelevancy.temperature
-                relevant_instructions = self.__prompts.RecallRelevancy.system_instructions
-                relevant_messages = [compose_gpt_message(relevant_instructions,'system'), compose_gpt_message(relevant_prompt,'user')]
-                relevant_element, relevant_total_tokens = gpt_completion(relevant_messages, relevant_temperature, relevant_response_tokens)
-                ## Save relevant memory prompt and response
-                relevant_prompt_row = create_row_object(
-                    table_name='Prompts',
-                    id=str(uuid4()),
-                    prompt=relevant_prompt,
-                    response=relevant_element,
-                    system_message=relevant_instructions,
-                    tokens=relevant_response_tokens,
-                    temperature=relevant_temperature,
-                    comments='Checking if recalled memories are relevant.',
-                    created_on=time()
-                )
-                sql_insert_row('Prompts','id',relevant_prompt_row)
-
-                relevant_obj = string_to_json(relevant_element)
-        return relevant_obj
-
-    ## TODO: I need a "memory pruning" feature which properly removes memories from all places (pinecone, memory caches, ). If it triggered a memory compression it should remove those compressions. This will be tricky...
+        matches = self.hybrid_memory_recall(query_string, 0, top_k, threshold)
+        recalled_memories = self.hydrate_memory_matches(matches)
+
+        if len(recalled_memories) == 0:
+            debug_message('No memories were recalled by the lexical or vector search...', self.debug_messages_enabled)
+            return relevant_obj, recalled_memories
+
+        ## Checking relevancy is optional; near the turn deadline keep the search results as they are
+        deadline = current_deadline()
+        if deadline is not None and deadline.optional_remaining() < float(self.__config['tasks']['relevancy_min_seconds']):
+            debug_message('Not enough time left in the turn to check recall relevancy, keeping the search results...', self.debug_messages_enabled)
+            deadline.drop('recall_relevancy', 'deadline')
+            return {'pertinent_information_present': True, 'relevant_information_ids': list(recalled_memories.keys())}, recalled_memories
+
+        relevant_content = ''
+        for memory_id, recalled_memory in recalled_memories.items():
+            memory_obj = recalled_memory['memory']
+            ## Get memory contents
+            memory_date = timestamp_to_datetime(memory_obj['created_on'])
+            ## Summaries have no content of their own
+            memory_content = memory_obj['content'] or memory_obj['summary']
+            memory_speaker = memory_obj['speaker']
+            ## Append for relevant content body
+            relevant_content += f"[\nINFORMATION ID: {memory_id}\nRECORDED ON: {memory_date}\nFROM: {memory_speaker}\nCONTENT: {memory_content}\n]\n"
+
+        ## Determine if recalled memories are relevant:
+        relevant_prompt = self.__prompts.RecallRelevancy.get_prompt(most_recent_message, hyde_query, relevant_content)
+        relevant_response_tokens = self.__prompts.RecallRelevancy.response_tokens
+        relevant_temperature = self.__prompts.RecallRelevancy.temperature
+        relevant_instructions = self.__prompts.RecallRelevancy.system_instructions
+        relevant_messages = [compose_gpt_message(relevant_instructions,'system'), compose_gpt_message(relevant_prompt,'user')]
+        try:
+            relevant_obj, relevant_element, relevant_total_tokens = gpt_structured_completion(relevant_messages, self.__prompts.RecallRelevancy.response_schema, relevant_temperature, relevant_response_tokens, prompt_type='RecallRelevancy')
+        except StructuredOutputError as err:
+            debug_message(f"Issue processing memory relevancy object: {err}", self.debug_messages_enabled)
+            relevant_obj, relevant_element = {}, err.response
+        ## Save relevant memory prompt and response
+        relevant_prompt_row = create_row_object(
+            table_name='Prompts',
+            id=str(uuid4()),
+            prompt=relevant_prompt,
+            response=relevant_element,
+            system_message=relevant_instructions,
+            tokens=relevant_response_tokens,
+            temperature=relevant_temperature,
+            comments='Checking if recalled memories are relevant.',
+            created_on=time()
+        )
+        self.__tasks.run_in_background(sql_insert_row, 'Prompts', 'id', relevant_prompt_row)
+        return relevant_obj, recalled_memories
+
+    ## Remove memories from everywhere they live: the Memories table (and its full text index), theme links (and themes left
+    ## with none), memory caches, compression jobs, and pinecone. Pruning a memory also prunes every memory summarized from
+    ## it, and any summary left with no children. Summaries which keep some of their children are marked stale and remade in the background.
+    ## Returns the ids which were deleted and the ids which were marked stale.
+    def prune_memories(self, memory_ids):
+        if type(memory_ids) == str:
+            memory_ids = [memory_ids]
+        if len(memory_ids) == 0:
+            return {'deleted': [], 'stale': []}
+        with self.__state_lock:
+            with sql_transaction() as sqldb:
+                pruned_ids, stale_memories = self.__prune_closure(sqldb, memory_ids)
+                if len(pruned_ids) == 0:
+                    return {'deleted': [], 'stale': []}
+                pruned_memories = sqldb.execute("select id, depth, past_sibling_id, next_sibling_id from Memories where id in (select value from json_each(?))", (json.dumps(pruned_ids),)).fetchall()
+                self.__relink_siblings(sqldb, pruned_memories, set(pruned_ids))
+                for memory in stale_memories:
+                    children_ids = [child_id for child_id in (memory['episodic_children_ids'] or []) if child_id not in pruned_ids]
+                    memory['episodic_children_ids'] = children_ids
+                    sqldb.execute('update Memories set episodic_children_ids = ?, stale = 1, modified_on = ? where id = ?', (json.dumps(children_ids), time(), memory['id']))
+                self.__prune_cache_rows(sqldb, pruned_ids)
+                self.__prune_compression_jobs(sqldb, pruned_ids)
+                orphaned_theme_ids = self.__prune_theme_links(sqldb, pruned_ids)
+                sqldb.execute('delete from Memory_Archive where memory_id in (select value from json_each(?))', (json.dumps(pruned_ids),))
+                sqldb.execute('delete from Memory_Closure where descendant_id in (select value from json_each(?))', (json.dumps(pruned_ids),))
+                sqldb.execute('delete from Memory_Closure where ancestor_id in (select value from json_each(?))', (json.dumps(pruned_ids),))
+                sqldb.execute('delete from Memories where id in (select value from json_each(?))', (json.dumps(pruned_ids),))
+            ## The live caches and queued snapshots are only changed once the transaction has committed
+            for cache in self.__episodic_memory_caches:
+                cache.remove_memories(pruned_ids)
+                for memory in stale_memories:
+                    cache.update_memory(memory['id'], {'episodic_children_ids': memory['episodic_children_ids'], 'stale': 1})
+            for job_id, job_memories in self.__compression_job_memories.items():
+                self.__compression_job_memories[job_id] = [m for m in job_memories if m['id'] not in pruned_ids]
+            self.save_state()
+        vector_batch_size = int(self.__config['memory_management']['prune_vector_batch_size'])
+        for depth in sorted(set(int(m['depth']) for m in pruned_memories)):
+            namespace = self.__config['memory_management']['memory_namespace_template'] % depth
+            delete_pinecone_vectors([m['id'] for m in pruned_memories if int(m['depth']) == depth], namespace, vector_batch_size)
+        delete_pinecone_vectors(orphaned_theme_ids, self.__config['memory_management']['theme_namespace_template'], vector_batch_size)
+        stale_ids = [m['id'] for m in stale_memories]
+        debug_message(f"Pruned {len(pruned_ids)} memories and {len(orphaned_theme_ids)} themes, {len(stale_ids)} summaries need to be remade.", self.debug_messages_enabled)
+        if len(stale_ids) > 0:
+            self.__tasks.run_in_background(self.refresh_stale_memories)
+        return {'deleted': pruned_ids, 'stale': stale_ids}
+
+    ## The memories to delete (the given memories and everything summarized from them, plus summaries left with no children)
+    ## and the summaries which lose some children. Both sides of the memory tree are walked with recursive queries.
+    def __prune_closure(self, sqldb, memory_ids):
+        descendants = sqldb.execute('''
+            with recursive descendants(id) as (
+                select id from Memories where id in (select value from json_each(?))
+                union
+                select m.id from Memories as m join descendants as d on m.episodic_parent_id = d.id
+            )
+            select id from descendants
+            ''', (json.dumps(list(memory_ids)),)).fetchall()
+        pruned_ids = set(m['id'] for m in descendants)
+        ancestors = sqldb.execute('''
+            with recursive ancestors(id) as (
+                select episodic_parent_id from Memories where id in (select value from json_each(?)) and episodic_parent_id is not null
+                union
+                select m.episodic_parent_id from Memories as m join ancestors as a on m.id = a.id where m.episodic_parent_id is not null
+            )
+            select m.id, m.depth, m.episodic_children_ids from Memories as m join ancestors as a on m.id = a.id order by m.depth
+            ''', (json.dumps(list(pruned_ids)),)).fetchall()
+        ## Shallowest first, so a summary emptied by this prune is seen as pruned by its own parent
+        stale_memories = []
+        for memory in ancestors:
+            children_ids = memory['episodic_children_ids'] or []
+            if all(child_id in pruned_ids for child_id in children_ids):
+                pruned_ids.add(memory['id'])
+            else:
+                stale_memories.append(memory)
+        return list(pruned_ids), stale_memories
+
+    ## Delete the theme links of pruned memories, and the themes left with no links at all so their phrases stop counting as
+    ## known lore. Returns the ids of the deleted themes, whose vectors are deleted once the transaction has committed.
+    def __prune_theme_links(self, sqldb, pruned_ids):
+        theme_ids = [t['theme_id'] for t in sqldb.execute('select distinct theme_id from Theme_Links where memory_id in (select value from json_each(?))', (json.dumps(pruned_ids),)).fetchall()]
+        sqldb.execute('delete from Theme_Links where memory_id in (select value from json_each(?))', (json.dumps(pruned_ids),))
+        orphaned_theme_ids = [t['id'] for t in sqldb.execute('''
+            select id from Themes
+            where id in (select value from json_each(?)) and not exists (select 1 from Theme_Links l where l.theme_id = Themes.id)
+            ''', (json.dumps(theme_ids),)).fetchall()]
+        sqldb.execute('delete from Themes where id in (select value from json_each(?))', (json.dumps(orphaned_theme_ids),))
+        return orphaned_theme_ids
+
+    ## Join the past and next siblings around every run of pruned memories
+    def __relink_siblings(self, sqldb, pruned_memories, pruned_ids):
+        by_id = {m['id']: m for m in pruned_memories}
+        links = {}
+        for memory in pruned_memories:
+            past_id = memory['past_sibling_id']
+            while past_id in pruned_ids:
+                past_id = by_id[past_id]['past_sibling_id']
+            next_id = memory['next_sibling_id']
+            while next_id in pruned_ids:
+                next_id = by_id[next_id]['next_sibling_id']
+            links[(past_id, next_id)] = True
+        for past_id, next_id in links.keys():
+            if past_id is not None:
+                sqldb.execute('update Memories set next_sibling_id = ? where id = ?', (next_id, past_id))
+            if next_id is not None:
+                sqldb.execute('update Memories set past_sibling_id = ? where id = ?', (past_id, next_id))
+
+    ## Take pruned memories out of every saved cache which lists them
+    def __prune_cache_rows(self, sqldb, pruned_ids):
+        caches = sqldb.execute('''
+            select distinct c.id, c.memory_ids from Memory_Caches as c, json_each(c.memory_ids) as j
+            where j.value in (select value from json_each(?))
+            ''', (json.dumps(pruned_ids),)).fetchall()
+        pruned_id_set = set(pruned_ids)
+        for cache in caches:
+            remaining_ids = [memory_id for memory_id in cache['memory_ids'] if memory_id not in pruned_id_set]
+            first_id = remaining_ids[0] if len(remaining_ids) > 0 else None
+            last_id = remaining_ids[-1] if len(remaining_ids) > 0 else None
+            sqldb.execute('update Memory_Caches set memory_ids = ?, first_memory_id = ?, last_memory_id = ?, modified_on = ? where id = ?', (json.dumps(remaining_ids), first_id, last_id, time(), cache['id']))
+
+    ## Take pruned memories out of unfinished compression jobs; a job left with nothing to compress is marked pruned
+    def __prune_compression_jobs(self, sqldb, pruned_ids):
+        jobs = sqldb.execute("select id, memory_ids from Compression_Jobs where status != 'completed'").fetchall()
+        pruned_id_set = set(pruned_ids)
+        for job in jobs:
+            remaining_ids = [memory_id for memory_id in (job['memory_ids'] or []) if memory_id not in pruned_id_set]
+            if len(remaining_ids) == len(job['memory_ids'] or []):
+                continue
+            status = 'pruned' if len(remaining_ids) == 0 else None
+            sqldb.execute('update Compression_Jobs set memory_ids = ?, status = coalesce(?, status), modified_on = ? where id = ?', (json.dumps(remaining_ids), status, time(), job['id']))
+
+    ## Remake the summaries of memories whose children were pruned, deepest last so each summary is made from fresh children
+    def refresh_stale_memories(self):
+        stale_memories = sql_custom_query('select * from Memories where stale = 1 order by depth')
+        for memory in stale_memories:
+            children = sorted(sql_query_by_ids('Memories', 'id', memory['episodic_children_ids'] or []), key=lambda m: float(m['created_on']))
+            if len(children) == 0:
+                continue
+            debug_message(f"Remaking summary of stale memory {memory['id']}...", self.debug_messages_enabled)
+            content = '\n'.join(child['summary'] for child in children)
+            content_tokens = sum(int(child['summary_tokens']) for child in children)
+            summary = self.cleanup_response(self.summarize_content(content, memory['depth'], content_tokens = content_tokens))
+            fields = {'summary': summary, 'summary_tokens': get_token_estimate(summary), 'stale': 0}
+            sql_update_row('Memories', 'id', dict(fields, id=memory['id']))
+            with self.__state_lock:
+                for cache in self.__episodic_memory_caches:
+                    cache.update_memory(memory['id'], fields)
+            memory.update(fields)
+            self.index_memory(memory)
 
 
 # breakpoint('Here is the hyde:')
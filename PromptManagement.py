@@ -1,4 +1,6 @@
-from UtilityFunctions import get_token_estimate, get_config, create_row_object
+import json
+import inspect
+from UtilityFunctions import get_token_estimate, get_token_estimates, truncate_to_token_limit, timestamp_to_datetime, get_config, create_row_object
 
 ## Classes to store prompts and their metadata
 class _Prompt:
@@ -6,6 +8,7 @@ class _Prompt:
         self.config = get_config()
         self.__prompt_temperature = temperature
         self.__response_tokens = response_tokens
+        self.__prompt_tokens = None
     
     def get_prompt(self):
         raise NotImplementedError()
@@ -18,16 +21,46 @@ class _Prompt:
     def response_tokens(self):
         return self.__response_tokens
     
-    ## Each child class implements this by calling its get_prompt function and passing it to the get_token_estimate utility function
+    ## Tokens used by the prompt template itself (and its system instructions, if any) before any content is added.
+    ## The template is rendered with a blank for every argument once and the count is kept.
     @property
     def prompt_tokens(self):
-        raise NotImplementedError()
+        if self.__prompt_tokens is None:
+            argument_count = len(inspect.signature(self.get_prompt).parameters)
+            template_tokens = get_token_estimate(self.get_prompt(*([' '] * argument_count)))
+            try:
+                template_tokens += get_token_estimate(self.system_instructions)
+            except NotImplementedError:
+                pass
+            self.__prompt_tokens = template_tokens
+        return self.__prompt_tokens
 
     ## Return system instructions to guide GPT's response. This will normally be used to request special formatting of the response or interface with Python.
     @property
     def system_instructions(self):
         raise NotImplementedError()
 
+    ## JSON schema the response must match, for prompts which interface with Python
+    @property
+    def response_schema(self):
+        raise NotImplementedError()
+
+    ## System instructions asking for JSON which matches the response schema
+    def schema_instructions(self):
+        return 'You are in interface to a Python program. All responses must conform to the following JSON schema:\n' + json.dumps(self.response_schema, indent='\t')
+
+## Schema of prompts which respond with a list of themes
+_themes_schema = {
+    'type': 'object',
+    'properties': {
+        'themes': {
+            'type': 'array',
+            'items': {'type': 'string'}
+        }
+    },
+    'required': ['themes']
+}
+
 ## Anticipate the needs of the USER based on the context of their conversation
 class _Anticipation(_Prompt):
     def __init__(self, temperature, response_tokens):
@@ -38,9 +71,6 @@ class _Anticipation(_Prompt):
         content = ("" if (notes is None) else f"CONVERSATION NOTES:\n{notes}\n") + f"CONVERSATION LOG:\n{log}"
         prompt = f"Given the following {prompt_sections}, infer the USER's actual information needs. Attempt to anticipate what the user truly needs even if the USER does not fully understand it yet themselves, or is asking the wrong questions. However, the USER may change topics, in which case their needs will have changed. Emphasize the needs of the last message by the USER.\n{content}"
         return prompt
-    @property
-    def prompt_tokens(self):
-        return get_token_estimate(self.get_prompt(' ',' '))
 
 ## Prompt RAVEN to address the USER's most recent message
 class _Conversation(_Prompt):
@@ -49,9 +79,6 @@ class _Conversation(_Prompt):
     def get_prompt(self, content, prompt_sections):
         prompt = f"I am a chatbot named RAVEN. My goals are to reduce suffering, increase prosperity, and increase understanding. I will review the {prompt_sections} below and then I will provide a detailed answer with emphasis on the last message by the user and my anticipation of their needs:\n{content}\nRAVEN:"
         return prompt
-    @property
-    def prompt_tokens(self):
-        return get_token_estimate(self.get_prompt(' ',' ',' '))
 
 ## Summarize a message from either USER or RAVEN
 class _EideticSummary(_Prompt):
@@ -60,9 +87,6 @@ class _EideticSummary(_Prompt):
     def get_prompt(self, speaker, content):
         prompt = f"I will review the message authored by {speaker} and summarize it so that all salient elements are represented in as little comprehensible text possible.\n{content}"
         return prompt
-    @property
-    def prompt_tokens(self):
-        return get_token_estimate(self.get_prompt(' ',' '))
 
 ## Summarize eidetic memories into an episodic memory
 class _EideticToEpisodicSummary(_Prompt):
@@ -71,9 +95,6 @@ class _EideticToEpisodicSummary(_Prompt):
     def get_prompt(self, content):
         prompt = f"I will read the following conversation between USER and RAVEN below and then follow the directions in the INSTRUCTIONS section.\n{content}\nINSTRUCTIONS:I will summarize the conversation so that salient elements are represented in as little comprehensible text possible."
         return prompt
-    @property
-    def prompt_tokens(self):
-        return get_token_estimate(self.get_prompt(' ',' ',' '))
 
 ## Summarize a cache of other episodic memories
 class _EpisodicSummary(_Prompt):
@@ -91,8 +112,8 @@ class _ThemeExtraction(_Prompt):
         prompt = f"Given the following chat log, identify the key themes of this information. Follow the INSTRUCTIONS at the end of the prompt.\n{content}\nINSTRUCTIONS:\nI will list all themes and format my response like this: {{\"themes\":[]}}"
         return prompt
     @property
-    def prompt_tokens(self):
-        return get_token_estimate(self.get_prompt(' '))
+    def response_schema(self):
+        return _themes_schema
     
 ## Prompt to check if RAVEN needs more information
 class _RecallExtraction(_Prompt):
@@ -102,11 +123,19 @@ class _RecallExtraction(_Prompt):
         prompt = f"Review the conversation log between RAVEN and USER then follow the INSTRUCTIONS.\n{content}\nINSTRUCTIONS:\nBased on the information in the conversation log, with emphasis on the USER's last message, is there sufficient detailed information to address everything in USER's last message?"
         return prompt
     @property
-    def prompt_tokens(self):
-        return get_token_estimate(self.get_prompt(' ')) + get_token_estimate(self.system_instructions())
-    @property
     def system_instructions(self):
-        return 'You are in interface to a Python program. All responses must conform to the following JSON schema:\n{\n\t\"type\": \"object\",\n\t\"properties\": {\n\t\t\"sufficient_information\": {\n\t\t\t\"type\": \"boolean\"\n\t\t},\n\t\t\"reasoning\": {\n\t\t\t\"type\": \"string\"\n\t\t},\n\t\t\"required_information\": {\n\t\t\t\"type\": \"string\"\n\t\t}\n\t},\n}'
+        return self.schema_instructions()
+    @property
+    def response_schema(self):
+        return {
+            'type': 'object',
+            'properties': {
+                'sufficient_information': {'type': 'boolean'},
+                'reasoning': {'type': 'string'},
+                'required_information': {'type': 'string'}
+            },
+            'required': ['sufficient_information', 'reasoning', 'required_information']
+        }
 
 ## Prompt to extract themes with a focus on the last user message
 class _RecallThemeExtraction(_Prompt):
@@ -116,8 +145,8 @@ class _RecallThemeExtraction(_Prompt):
         prompt = f"Given the following chat log, identify the key themes of this information. Follow the INSTRUCTIONS at the end of the prompt.\n{content}\nINSTRUCTIONS:\nWith emphasis on the USER's last message, list the themes of the user's request. Format your response like this: {{\"themes\":[]}}"
         return prompt
     @property
-    def prompt_tokens(self):
-        return get_token_estimate(self.get_prompt(' '))
+    def response_schema(self):
+        return _themes_schema
 
 ## Prompt to check if recalled information is relevant to the conversation
 class _RecallRelevancy(_Prompt):
@@ -128,11 +157,22 @@ class _RecallRelevancy(_Prompt):
         prompt = f"Review the most recent message from USER, the potential goals, and the potentially relevant information, then follow the INSTRUCTIONS at the end of the prompt.\n{content}\nINSTRUCTIONS:\nBased only on the potentially relevant information, is there any pertinent information related to addressing the USER's most recent message or the potential goals?"
         return prompt
     @property
-    def prompt_tokens(self):
-        return get_token_estimate(self.get_prompt(' '))
-    @property
     def system_instructions(self):
-        return 'You are in interface to a Python program. All responses must conform to the following JSON schema:\n{\n\t\"type\": \"object\",\n\t\"properties\": {\n\t\t\"pertinent_information_present\": {\n\t\t\t\"type\": \"boolean\"\n\t\t},\n\t\t\"reasoning\": {\n\t\t\t\"type\": \"string\"\n\t\t},\n\t\t\"relevant_information_ids\": {\n\t\t\t\"type\": \"array\",\n\t\t  \"items\": {\n\t\t\t\"type\": \"string\"\n\t\t  }\n\t\t}\n\t}\n}'
+        return self.schema_instructions()
+    @property
+    def response_schema(self):
+        return {
+            'type': 'object',
+            'properties': {
+                'pertinent_information_present': {'type': 'boolean'},
+                'reasoning': {'type': 'string'},
+                'relevant_information_ids': {
+                    'type': 'array',
+                    'items': {'type': 'string'}
+                }
+            },
+            'required': ['pertinent_information_present', 'relevant_information_ids']
+        }
 
 ## Initialize all prompt objects with their temperature and response token count
 class PromptManager:
@@ -146,9 +186,124 @@ class PromptManager:
         self.RecallExtraction = _RecallExtraction(0.7, 500)
         self.RecallThemeExtraction = _RecallThemeExtraction(0.0,250)
         self.RecallRelevancy = _RecallRelevancy(0.7, 500)
+        ## The template overhead never changes so it is only counted once
+        self.__conversation_token_buffer = self.Conversation.prompt_tokens + self.Anticipation.response_tokens + self.EideticToEpisodicSummary.response_tokens
         
     ## Conversation prompts will combine several sections and a special prompt, this estimates the number of tokens needed before any additional content is added
     @property
     def conversation_token_buffer(self):
-        token_buffer = self.Conversation.prompt_tokens + self.Anticipation.response_tokens + self.EideticToEpisodicSummary.response_tokens
-        return token_buffer
+        return self.__conversation_token_buffer
+
+
+## Fits every section of the conversation prompt into the model's input limit before the request is sent.
+## The conversation template, its section headers, the response, and the anticipation and notes allowances are reserved up front
+## (see conversation_token_buffer); the conversation log gets first claim on what is left, and recalled memories are packed into
+## the remainder by relevance per token. Estimates of the parts can undercount the whole, so the assembled prompt is measured
+## and trimmed again until it fits.
+class ConversationPromptAssembler:
+    def __init__(self, prompts, max_token_input):
+        self.__prompts = prompts
+        self.__max_token_input = int(max_token_input)
+        ## Headers and section names of a prompt with every section present, beyond the bare template
+        self.__section_tokens = max(0, get_token_estimate(self.__build_prompt(' ', [' '], ' ', [' '])) - self.__prompts.Conversation.prompt_tokens)
+
+    ## Tokens available for the conversation log and recalled memories once the fixed reservations are made
+    @property
+    def content_budget(self):
+        return self.__max_token_input - self.__prompts.conversation_token_buffer - self.__section_tokens - self.__prompts.Conversation.response_tokens
+
+    ## Keep the most recent memories whose summaries fit in the budget. The last memory is always kept, truncated if necessary.
+    def __fit_recent(self, memories, budget):
+        summaries = [m['summary'] for m in memories]
+        ## One extra token per line for the newline which joins them
+        tokens = [t + 1 for t in get_token_estimates(summaries)]
+        kept = []
+        used = 0
+        for summary, summary_tokens in zip(reversed(summaries), reversed(tokens)):
+            if used + summary_tokens > budget:
+                if len(kept) == 0:
+                    kept.append(truncate_to_token_limit(summary, max(0, budget - 1)))
+                    used = budget
+                break
+            kept.append(summary)
+            used += summary_tokens
+        kept.reverse()
+        return kept, used, len(summaries) - len(kept)
+
+    ## Summaries (depth above 0) have no speaker and may not have content, so they are labelled as summaries
+    def __format_recalled_memory(self, memory):
+        recorded_on = timestamp_to_datetime(memory['created_on'])
+        speaker = memory.get('speaker')
+        content = memory.get('content') or memory.get('summary')
+        source = f"FROM: {speaker}" if speaker else 'FROM: SUMMARY'
+        return f"[\nRECORDED ON: {recorded_on}\n{source}\nCONTENT: {content}\n]"
+
+    ## Pack recalled memories greedily by relevance score per token. Packed memories keep their original (relevance) order.
+    def __pack_recalled(self, recalled_memories, budget):
+        formatted = [self.__format_recalled_memory(r['memory']) for r in recalled_memories]
+        tokens = [t + 1 for t in get_token_estimates(formatted)]
+        order = sorted(range(len(formatted)), key=lambda i: float(recalled_memories[i]['score']) / max(1, tokens[i]), reverse=True)
+        chosen = set()
+        used = 0
+        for i in order:
+            if used + tokens[i] <= budget:
+                chosen.add(i)
+                used += tokens[i]
+        packed = [formatted[i] for i in range(len(formatted)) if i in chosen]
+        return packed, used, len(formatted) - len(packed)
+
+    def __build_prompt(self, anticipation, recalled, notes, conversation):
+        prompt_sections_list = []
+        prompt_content_list = []
+        if anticipation != '':
+            prompt_content_list.append(f"ANTICIPATED USER NEEDS:\n{anticipation}")
+        if len(recalled) > 0:
+            prompt_sections_list.append('CONVERSATION HISTORY')
+            prompt_content_list.append("CONVERSATION HISTORY:\n" + '\n'.join(recalled))
+        if notes != '':
+            prompt_sections_list.append('CONVERSATION NOTES')
+            prompt_content_list.append(f"CONVERSATION NOTES:\n{notes}")
+        prompt_sections_list.append('CONVERSATION LOG')
+        prompt_content_list.append("CONVERSATION LOG:\n" + '\n'.join(conversation))
+
+        prompt_sections = ' and '.join(prompt_sections_list)
+        prompt_content = '\n'.join(prompt_content_list)
+        return self.__prompts.Conversation.get_prompt(prompt_content, prompt_sections)
+
+    ## Build the conversation prompt. recalled_memories are dictionaries holding a memory row and its relevance score.
+    ## Returns the prompt, its estimated token count, and how many items each section dropped to fit.
+    def assemble(self, conversation_memories, anticipation = '', recalled_memories = None, note_memories = None):
+        recalled_memories = [] if recalled_memories is None else recalled_memories
+        note_memories = [] if note_memories is None else note_memories
+        trimmed = {}
+
+        ## Fixed allowances: anticipation and notes may use up to their reservation and no more
+        anticipation = truncate_to_token_limit(anticipation, self.__prompts.Anticipation.response_tokens) if anticipation != '' else ''
+        notes, notes_tokens, trimmed['notes'] = self.__fit_recent(note_memories, self.__prompts.EideticToEpisodicSummary.response_tokens) if len(note_memories) > 0 else ([], 0, 0)
+        notes = '\n'.join(notes)
+
+        ## The conversation log comes first, then recalled memories get whatever remains
+        conversation, conversation_tokens, trimmed['conversation'] = self.__fit_recent(conversation_memories, self.content_budget)
+        recalled, recalled_tokens, trimmed['recalled'] = self.__pack_recalled(recalled_memories, self.content_budget - conversation_tokens)
+
+        ## Drop the least relevant recalled memories, then the oldest conversation lines, until the whole prompt and its response fit.
+        ## The last conversation line is never dropped, only truncated.
+        input_limit = self.__max_token_input - self.__prompts.Conversation.response_tokens
+        prompt = self.__build_prompt(anticipation, recalled, notes, conversation)
+        prompt_tokens = get_token_estimate(prompt)
+        while prompt_tokens > input_limit:
+            if len(recalled) > 0:
+                recalled.pop()
+                trimmed['recalled'] += 1
+            elif len(conversation) > 1:
+                conversation.pop(0)
+                trimmed['conversation'] += 1
+            else:
+                last_line = conversation[0] if len(conversation) > 0 else ''
+                shortened = truncate_to_token_limit(last_line, max(0, get_token_estimate(last_line) - (prompt_tokens - input_limit)))
+                if shortened == last_line:
+                    break
+                conversation = [shortened]
+            prompt = self.__build_prompt(anticipation, recalled, notes, conversation)
+            prompt_tokens = get_token_estimate(prompt)
+        return prompt, prompt_tokens, trimmed
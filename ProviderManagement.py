@@ -0,0 +1,251 @@
+import re
+import json
+import math
+import hashlib
+from time import sleep
+from uuid import uuid4
+from threading import Lock
+
+## Providers hide which service answers chat, embedding, and vector requests. They are chosen in the [provider]
+## section of config.ini. Responses are shaped like the OpenAI and Pinecone responses so callers do not care which one is active.
+## The local stub providers never touch the network: they answer deterministically after a configurable delay, which makes
+## it possible to load-test the whole memory pipeline offline and to measure Raven's own overhead apart from model latency.
+
+## Interface for chat completion, streaming, and embedding providers
+class _LLMProvider:
+    ## Name of the model answering requests; part of the response cache key
+    @property
+    def model_name(self):
+        raise NotImplementedError()
+
+    ## Name of the model answering embedding requests
+    @property
+    def embedding_model_name(self):
+        raise NotImplementedError()
+
+    def chat_completion(self, messages, temperature, max_tokens, stop, top_p, frequency_penalty, presence_penalty):
+        raise NotImplementedError()
+
+    ## Yield the response text piece by piece
+    def chat_completion_stream(self, messages, temperature, max_tokens, stop, top_p, frequency_penalty, presence_penalty):
+        raise NotImplementedError()
+
+    def embedding(self, content):
+        raise NotImplementedError()
+
+class OpenAIProvider(_LLMProvider):
+    def __init__(self, api_key_path, chat_model, embedding_model):
+        import openai
+        self.__openai = openai
+        self.__openai.api_key = open_key_file(api_key_path)
+        self.__chat_model = chat_model
+        self.__embedding_model = embedding_model
+
+    @property
+    def model_name(self):
+        return self.__chat_model
+
+    @property
+    def embedding_model_name(self):
+        return self.__embedding_model
+
+    def chat_completion(self, messages, temperature, max_tokens, stop, top_p, frequency_penalty, presence_penalty):
+        return self.__openai.ChatCompletion.create(
+            model=self.__chat_model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            frequency_penalty=frequency_penalty,
+            presence_penalty=presence_penalty,
+            stop=stop)
+
+    def chat_completion_stream(self, messages, temperature, max_tokens, stop, top_p, frequency_penalty, presence_penalty):
+        response = self.__openai.ChatCompletion.create(
+            model=self.__chat_model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            frequency_penalty=frequency_penalty,
+            presence_penalty=presence_penalty,
+            stop=stop,
+            stream=True)
+        for chunk in response:
+            delta = chunk['choices'][0]['delta'].get('content', '')
+            if delta:
+                yield delta
+
+    def embedding(self, content):
+        return self.__openai.Embedding.create(input=content, engine=self.__embedding_model)
+
+## Deterministic offline provider. Prompts which expect JSON (recall extraction, recall relevancy, and theme extraction)
+## get schema-valid JSON back; every other prompt gets a short extractive reply built from the prompt itself.
+class LocalStubProvider(_LLMProvider):
+    def __init__(self, latency_seconds = 0.0, token_latency_seconds = 0.0, embedding_dimensions = 1536):
+        self.__latency_seconds = float(latency_seconds)
+        self.__token_latency_seconds = float(token_latency_seconds)
+        self.__embedding_dimensions = int(embedding_dimensions)
+
+    @property
+    def model_name(self):
+        return 'local_stub'
+
+    @property
+    def embedding_model_name(self):
+        return 'local_stub'
+
+    def __words(self, text):
+        return re.findall(r"[A-Za-z0-9']+", text)
+
+    def __last_section(self, text):
+        ## Most prompts open with one line of direction, then the content being worked on, then any INSTRUCTIONS
+        return text.split('INSTRUCTIONS:')[0].split('\n', 1)[-1]
+
+    ## Build the reply for a request based on which prompt it looks like
+    def respond(self, messages):
+        system_message = '\n'.join(m['content'] for m in messages if m['role'] == 'system')
+        prompt = messages[-1]['content'] if len(messages) > 0 else ''
+        if '"sufficient_information"' in system_message:
+            ## Ask for recall whenever the last message is a question, which exercises the whole recall path
+            last_line = prompt.split('INSTRUCTIONS:')[0].strip().split('\n')[-1]
+            needs_recall = '?' in last_line
+            return json.dumps({
+                'sufficient_information': not needs_recall,
+                'reasoning': 'The user is asking about: ' + ' '.join(self.__words(last_line)[:20]),
+                'required_information': ' '.join(self.__keywords(last_line, 5))
+            })
+        if '"pertinent_information_present"' in system_message:
+            information_ids = re.findall(r"INFORMATION ID: (\S+)", prompt)
+            return json.dumps({
+                'pertinent_information_present': len(information_ids) > 0,
+                'reasoning': 'Stub relevancy keeps every recalled memory.',
+                'relevant_information_ids': information_ids
+            })
+        if '{"themes":[]}' in prompt:
+            return json.dumps({'themes': self.__keywords(self.__last_section(prompt), 5)})
+        words = self.__words(self.__last_section(prompt))
+        return 'STUB: ' + ' '.join(words[-40:])
+
+    ## The longest distinct words, in order of first appearance; a cheap, deterministic stand-in for key phrases
+    def __keywords(self, text, count):
+        seen = []
+        for word in self.__words(text):
+            lowered = word.lower()
+            if len(lowered) > 4 and lowered not in seen:
+                seen.append(lowered)
+        ranked = sorted(seen, key=lambda w: (-len(w), seen.index(w)))[:count]
+        return sorted(ranked, key=seen.index)
+
+    def __usage(self, messages, response):
+        prompt_tokens = sum(len(self.__words(m['content'])) for m in messages)
+        completion_tokens = len(self.__words(response))
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+    def chat_completion(self, messages, temperature, max_tokens, stop, top_p, frequency_penalty, presence_penalty):
+        response = self.respond(messages)
+        usage = self.__usage(messages, response)
+        sleep(self.__latency_seconds + self.__token_latency_seconds * usage['completion_tokens'])
+        return {
+            'id': 'stub-%s' % str(uuid4()),
+            'usage': usage,
+            'choices': [{'message': {'role': 'assistant', 'content': response}}]
+        }
+
+    def chat_completion_stream(self, messages, temperature, max_tokens, stop, top_p, frequency_penalty, presence_penalty):
+        response = self.respond(messages)
+        sleep(self.__latency_seconds)
+        for piece in re.findall(r"\S+\s*", response):
+            sleep(self.__token_latency_seconds)
+            yield piece
+
+    ## Hash each word into a bucket so texts sharing words get similar vectors
+    def embedding(self, content):
+        vector = [0.0] * self.__embedding_dimensions
+        words = [w.lower() for w in self.__words(content)]
+        for word in words:
+            digest = hashlib.sha256(word.encode('utf-8')).digest()
+            bucket = int.from_bytes(digest[:4], 'little') % self.__embedding_dimensions
+            vector[bucket] += 1.0 if digest[4] % 2 == 0 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector))
+        if norm > 0:
+            vector = [v / norm for v in vector]
+        sleep(self.__latency_seconds)
+        return {'data': [{'embedding': vector}], 'usage': {'prompt_tokens': len(words), 'total_tokens': len(words)}}
+
+## In-process replacement for a Pinecone index. Vectors only live as long as the process does.
+class LocalStubVectorIndex:
+    def __init__(self, latency_seconds = 0.0):
+        self.__latency_seconds = float(latency_seconds)
+        self.__namespaces = {}
+        self.__lock = Lock()
+
+    def __cosine(self, a, b):
+        dot = sum(x * y for x, y in zip(a, b))
+        norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+        return dot / norm if norm > 0 else 0.0
+
+    def query(self, vector, top_k, namespace = '', **kwargs):
+        sleep(self.__latency_seconds)
+        with self.__lock:
+            records = list(self.__namespaces.get(namespace, {}).items())
+        scored = [{'id': record_id, 'score': self.__cosine(vector, record['values']), 'metadata': record['metadata']} for record_id, record in records]
+        scored.sort(key=lambda m: m['score'], reverse=True)
+        return {'matches': scored[:int(top_k)], 'namespace': namespace}
+
+    def upsert(self, vectors, namespace = '', **kwargs):
+        sleep(self.__latency_seconds)
+        with self.__lock:
+            records = self.__namespaces.setdefault(namespace, {})
+            for v in vectors:
+                records[v['id']] = {'values': list(v['values']), 'metadata': v.get('metadata', {}) or {}}
+        return {'upserted_count': len(vectors)}
+
+    def update(self, id, values = None, namespace = '', **kwargs):
+        with self.__lock:
+            records = self.__namespaces.setdefault(namespace, {})
+            if id in records and values is not None:
+                records[id]['values'] = list(values)
+        return {}
+
+    def fetch(self, ids, namespace = '', **kwargs):
+        sleep(self.__latency_seconds)
+        with self.__lock:
+            records = self.__namespaces.get(namespace, {})
+            vectors = {record_id: {'id': record_id, 'values': list(records[record_id]['values']), 'metadata': records[record_id]['metadata']} for record_id in ids if record_id in records}
+        return {'vectors': vectors, 'namespace': namespace}
+
+    def delete(self, ids, namespace = '', **kwargs):
+        sleep(self.__latency_seconds)
+        with self.__lock:
+            records = self.__namespaces.setdefault(namespace, {})
+            for record_id in ids:
+                records.pop(record_id, None)
+        return {}
+
+def open_key_file(filepath):
+    with open(filepath, 'r', encoding='utf-8') as infile:
+        return infile.read().strip()
+
+## Build the chat and embedding provider named in config.ini
+def create_llm_provider(config):
+    provider_name = config['provider']['llm_provider']
+    if provider_name == 'openai':
+        return OpenAIProvider(config['open_ai']['api_key'], config['open_ai']['model'], config['open_ai']['input_engine'])
+    if provider_name == 'local_stub':
+        return LocalStubProvider(
+            config['provider']['stub_latency_seconds'],
+            config['provider']['stub_token_latency_seconds'],
+            config['provider']['stub_embedding_dimensions'])
+    raise ValueError(f"Unknown llm_provider '{provider_name}' in config.ini")
+
+## Build the vector store named in config.ini
+def create_vector_store(config):
+    store_name = config['provider']['vector_store']
+    if store_name == 'pinecone':
+        import pinecone
+        pinecone.init(api_key=open_key_file(config['pinecone']['api_key']), environment=config['pinecone']['environment'])
+        return pinecone.Index(config['pinecone']['index'])
+    if store_name == 'local_stub':
+        return LocalStubVectorIndex(config['provider']['stub_latency_seconds'])
+    raise ValueError(f"Unknown vector_store '{store_name}' in config.ini")
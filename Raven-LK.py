@@ -1,7 +1,7 @@
 import re
 import os
 import json
-import openai
+import queue
 import tkinter as tk
 from time import time, sleep
 from threading import Thread
@@ -15,6 +15,9 @@ _full_height = False
 _window_width = 600
 _window_height = 600
 _show_debug_frame = False
+## Streamed response events are passed from the worker thread to the UI thread through this queue
+_response_queue = queue.Queue()
+_response_poll_ms = 50
 
 ####### TKINTER functions by GPT4 prompted by David Shapiro(daveshap); modified by Matt Hatton(hattoff)
 ####### https://github.com/daveshap/Chapter_Summarizer_GPT4/blob/main/chat_tkinter2.py
@@ -45,12 +48,39 @@ def display_user_response(user_input, timestamp = ''):
     chat_text.insert(tk.END, user_response, tag_name)
     chat_text.see(tk.END)
 
+## Runs on a worker thread; Tkinter widgets are only touched by poll_response_queue on the UI thread
 def get_ai_response():
     ## GPT Response
-    raven_response = conversation_manager.generate_response()
+    _response_queue.put(('start', ''))
+    raven_response = conversation_manager.generate_response(stream_callback=lambda delta: _response_queue.put(('delta', delta)))
+    ## Persist the complete response once it has finished streaming
     conversation_manager.log_message('RAVEN', raven_response)
-    display_ai_response(raven_response)
-    ai_status.set("")
+    _response_queue.put(('end', raven_response))
+
+## Drain streamed response events and append them to the chat window in one batch per poll
+def poll_response_queue():
+    pending_text = ''
+    finished = False
+    while True:
+        try:
+            event, text = _response_queue.get_nowait()
+        except queue.Empty:
+            break
+        if event == 'start':
+            pending_text += "\nRAVEN:\n"
+        elif event == 'delta':
+            pending_text += text
+        elif event == 'end':
+            pending_text += "\n\n"
+            finished = True
+    if pending_text != '':
+        chat_text.config(state='normal')
+        chat_text.insert(tk.END, pending_text, 'raven')
+        chat_text.see(tk.END)
+        chat_text.config(state='disabled')
+    if finished:
+        ai_status.set("")
+    root.after(_response_poll_ms, poll_response_queue)
 
 ## Display the response from the AI, if the timestamp has data then it will display 
 ## the "summary" version which is italic and append the timestamp to the speaker tag
@@ -190,6 +220,8 @@ def get_screen_info_at_cursor():
 
 # Define a function to check the spelling of the text in the text box
 def check_spelling(event):
+    ## Any typing counts as activity so idle retheming yields to the user
+    conversation_manager.notify_user_activity()
     ## Don't check spelling until the end of a word or sentence to avoid false positives
     punctuations = [",", ".", ";", ":", "?", "!", " ", "\n"]
     if event.char not in punctuations:
@@ -289,6 +321,8 @@ if __name__ == "__main__":
     chat_text.config(state='disabled')
 
     snap_window_to_cursor(800, 600)
+    root.after(_response_poll_ms, poll_response_queue)
+    conversation_manager.start_idle_retheming()
 
     right_frame.grid_forget()
     # Create a menu bar
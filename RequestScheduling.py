@@ -0,0 +1,209 @@
+import math
+import heapq
+import random
+import itertools
+import contextvars
+from time import monotonic, sleep
+from threading import Condition, Lock
+from contextlib import contextmanager
+
+## Every OpenAI call in the process goes through one request scheduler so concurrent callers (the UI worker,
+## memory compression, retheming) share the same rate limits instead of discovering them through errors.
+## Interactive calls are admitted ahead of background work, and failed calls back off exponentially with jitter.
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+## Time budget of the current conversation turn. Optional work checks it before starting, and failed requests are not
+## retried past it. It is held in a context variable, which the task manager copies onto its worker threads.
+_current_deadline = contextvars.ContextVar('raven_deadline', default=None)
+
+def current_deadline():
+    return _current_deadline.get()
+
+class Deadline:
+    ## A budget of zero or less never expires. The reserve is time set aside for the work which must happen last (the response).
+    def __init__(self, seconds, reserve_seconds = 0.0):
+        self.__seconds = float(seconds)
+        self.__expires = monotonic() + self.__seconds if self.__seconds > 0 else math.inf
+        self.__reserve = float(reserve_seconds)
+        self.__dropped = {}
+        self.__lock = Lock()
+
+    @property
+    def seconds(self):
+        return self.__seconds
+
+    def remaining(self):
+        return max(0.0, self.__expires - monotonic())
+
+    ## Time left for optional work once the reserve is set aside
+    def optional_remaining(self):
+        return max(0.0, self.remaining() - self.__reserve)
+
+    ## Note optional work which was skipped or cut short, and why
+    def drop(self, name, reason):
+        with self.__lock:
+            self.__dropped[name] = reason
+
+    @property
+    def dropped(self):
+        with self.__lock:
+            return dict(self.__dropped)
+
+    ## Make this the current deadline inside the block
+    @contextmanager
+    def activate(self):
+        token = _current_deadline.set(self)
+        try:
+            yield self
+        finally:
+            _current_deadline.reset(token)
+
+## Refills continuously at capacity-per-minute; callers take from it before making a request
+class TokenBucket:
+    def __init__(self, capacity_per_minute):
+        self.__capacity = float(capacity_per_minute)
+        self.__rate = self.__capacity / 60.0
+        self.__level = self.__capacity
+        self.__updated = monotonic()
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    def __refill(self, now):
+        self.__level = min(self.__capacity, self.__level + (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+    ## Seconds until the amount is available; zero if it is available now. A capacity of zero or less disables the bucket.
+    def time_until(self, amount, now):
+        if self.__capacity <= 0:
+            return 0.0
+        self.__refill(now)
+        amount = min(float(amount), self.__capacity)
+        if self.__level >= amount:
+            return 0.0
+        return (amount - self.__level) / self.__rate
+
+    def take(self, amount, now):
+        if self.__capacity <= 0:
+            return
+        self.__refill(now)
+        self.__level -= min(float(amount), self.__capacity)
+
+    ## Give back (or take more) once the real usage of a request is known
+    def adjust(self, amount, now):
+        if self.__capacity <= 0:
+            return
+        self.__refill(now)
+        self.__level = min(self.__capacity, self.__level + float(amount))
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute, tokens_per_minute, max_retry, backoff_base_seconds, backoff_max_seconds):
+        self.__requests = TokenBucket(requests_per_minute)
+        self.__tokens = TokenBucket(tokens_per_minute)
+        self.__max_retry = int(max_retry)
+        self.__backoff_base = float(backoff_base_seconds)
+        self.__backoff_max = float(backoff_max_seconds)
+        self.__condition = Condition()
+        self.__waiting = []
+        self.__sequence = itertools.count()
+        ## When the API asks us to back off, every caller waits, not just the one that was told
+        self.__paused_until = 0.0
+
+    @property
+    def max_retry(self):
+        return self.__max_retry
+
+    @property
+    def queue_length(self):
+        with self.__condition:
+            return len(self.__waiting)
+
+    ## Block until this caller is first in line (by priority, then arrival) and both buckets have capacity
+    def acquire(self, priority = PRIORITY_INTERACTIVE, estimated_tokens = 0):
+        with self.__condition:
+            ticket = (int(priority), next(self.__sequence))
+            heapq.heappush(self.__waiting, ticket)
+            try:
+                while True:
+                    now = monotonic()
+                    if now < self.__paused_until:
+                        wait = self.__paused_until - now
+                    elif self.__waiting[0] != ticket:
+                        ## Someone more important is ahead; wake up when they are admitted
+                        wait = 1.0
+                    else:
+                        wait = max(self.__requests.time_until(1, now), self.__tokens.time_until(estimated_tokens, now))
+                        if wait <= 0:
+                            self.__requests.take(1, now)
+                            self.__tokens.take(estimated_tokens, now)
+                            return
+                    self.__condition.wait(timeout=wait)
+            finally:
+                self.__waiting.remove(ticket)
+                heapq.heapify(self.__waiting)
+                self.__condition.notify_all()
+
+    ## Correct the token bucket with the real usage reported by the API
+    def record_usage(self, estimated_tokens, actual_tokens):
+        if actual_tokens is None or int(actual_tokens) < 0:
+            return
+        with self.__condition:
+            self.__tokens.adjust(float(estimated_tokens) - float(actual_tokens), monotonic())
+            self.__condition.notify_all()
+
+    ## Hold every caller until the given number of seconds has passed
+    def pause(self, seconds):
+        with self.__condition:
+            self.__paused_until = max(self.__paused_until, monotonic() + float(seconds))
+            self.__condition.notify_all()
+
+    ## Requests which can never succeed (bad request, bad key, missing model) are not retried
+    def is_retryable(self, err):
+        status = getattr(err, 'http_status', None)
+        return status not in (400, 401, 403, 404)
+
+    ## Seconds the server asked us to wait, if it said so
+    def get_retry_after(self, err):
+        headers = getattr(err, 'headers', None) or {}
+        for key in headers:
+            if str(key).lower() == 'retry-after':
+                try:
+                    return float(headers[key])
+                except (TypeError, ValueError):
+                    return None
+        return None
+
+    ## Exponential backoff with full jitter, unless the server gave a Retry-After
+    def get_retry_delay(self, err, attempt):
+        retry_after = self.get_retry_after(err)
+        if retry_after is not None:
+            ## Everyone waits when the server says so; that is what stops a retry storm
+            self.pause(retry_after)
+            return retry_after
+        ceiling = min(self.__backoff_max, self.__backoff_base * (2 ** (int(attempt) - 1)))
+        return random.uniform(0, ceiling)
+
+    ## Run a request under the rate limits and retry it on failure. The last error is raised once retries run out.
+    ## If a stats dictionary is given its 'retries' key is kept up to date.
+    def execute(self, request, priority = PRIORITY_INTERACTIVE, estimated_tokens = 0, description = 'OpenAI request', stats = None):
+        attempt = 0
+        while True:
+            self.acquire(priority, estimated_tokens)
+            try:
+                return request()
+            except Exception as err:
+                attempt += 1
+                if stats is not None:
+                    stats['retries'] = attempt
+                if not self.is_retryable(err) or attempt > self.__max_retry:
+                    raise
+                delay = self.get_retry_delay(err, attempt)
+                deadline = current_deadline()
+                if deadline is not None and delay >= deadline.remaining():
+                    print(f"Error during {description} ({err}), no time left before the turn deadline to retry.")
+                    raise
+                print(f"Error during {description} ({err}), retry {attempt} of {self.__max_retry} in {delay:.1f} seconds...")
+                sleep(delay)
@@ -0,0 +1,87 @@
+import re
+import json
+
+## Prompts which ask for JSON get it back wrapped in code fences, surrounded by prose, or with trailing commas often
+## enough that a plain json.loads is not enough. These helpers pull the JSON out of a response and check it against the
+## prompt's schema (a small subset of JSON schema: type, properties, required, and items). Nothing here ever waits on input.
+
+## Raised when a response cannot be turned into an object matching the prompt's schema
+class StructuredOutputError(ValueError):
+    def __init__(self, message, prompt_type = '', response = ''):
+        super().__init__(message)
+        self.prompt_type = prompt_type
+        self.response = response
+
+_json_types = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'boolean': bool,
+    'number': (int, float),
+    'integer': int,
+    'null': type(None)
+}
+
+_code_fence = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+_trailing_comma = re.compile(r",(\s*[}\]])")
+
+def _loads_tolerant(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(_trailing_comma.sub(r"\1", text))
+
+## Return the first JSON object or array found in the text. Raises StructuredOutputError if there is none.
+def extract_json(text):
+    if not isinstance(text, str):
+        raise StructuredOutputError(f"Expected a string response, got {type(text).__name__}", response=text)
+    candidates = [m.group(1) for m in _code_fence.finditer(text)] + [text]
+    for candidate in candidates:
+        candidate = candidate.strip()
+        try:
+            return _loads_tolerant(candidate)
+        except json.JSONDecodeError:
+            pass
+        ## Scan for JSON embedded in prose, starting at every opening bracket
+        decoder = json.JSONDecoder()
+        for match in re.finditer(r"[\[{]", candidate):
+            fragment = _trailing_comma.sub(r"\1", candidate[match.start():])
+            try:
+                value, _ = decoder.raw_decode(fragment)
+                return value
+            except json.JSONDecodeError:
+                continue
+    raise StructuredOutputError('No JSON found in the response', response=text)
+
+## Return a list of problems with the value; an empty list means it matches the schema
+def validate_schema(value, schema, path = '$'):
+    errors = []
+    expected_type = schema.get('type')
+    if expected_type is not None:
+        python_type = _json_types[expected_type]
+        ## bool is a subclass of int, so do not let true/false pass as numbers
+        is_bool_as_number = isinstance(value, bool) and expected_type in ('number', 'integer')
+        if not isinstance(value, python_type) or is_bool_as_number:
+            return [f"{path} should be of type {expected_type}"]
+    if isinstance(value, dict):
+        for key in schema.get('required', []):
+            if key not in value:
+                errors.append(f"{path} is missing required property {key}")
+        for key, property_schema in schema.get('properties', {}).items():
+            if key in value:
+                errors += validate_schema(value[key], property_schema, f"{path}.{key}")
+    if isinstance(value, list) and 'items' in schema:
+        for i, item in enumerate(value):
+            errors += validate_schema(item, schema['items'], f"{path}[{i}]")
+    return errors
+
+## Extract JSON from a response and validate it, raising StructuredOutputError with every problem found
+def parse_structured_response(text, schema, prompt_type = ''):
+    try:
+        value = extract_json(text)
+    except StructuredOutputError as err:
+        raise StructuredOutputError(str(err), prompt_type, text)
+    errors = validate_schema(value, schema)
+    if len(errors) > 0:
+        raise StructuredOutputError('; '.join(errors), prompt_type, text)
+    return value
@@ -0,0 +1,238 @@
+import os
+import json
+import struct
+import shutil
+import sqlite3
+import hashlib
+import zipfile
+from time import time
+from UtilityFunctions import *
+
+## A snapshot is a single zip file holding a whole world: every table, every vector, and the archive segments.
+## Tables are written as columnar JSON parts of at most chunk_rows rows (columns of similar values compress well), vectors
+## as blocks of little-endian float16 with their ids and metadata beside them, and archive segments as they are on disk.
+## manifest.json lists the schema, row and vector counts, and the sha256 of every other file in the snapshot.
+##
+## Importing builds a new database file next to the target: tables are created bare, rows are bulk loaded in one
+## transaction, and only then are indexes, triggers, and the full text index built. The file replaces the target once
+## every table has the row count the manifest says it should.
+
+SNAPSHOT_FORMAT = 'raven-snapshot'
+SNAPSHOT_FORMAT_VERSION = 1
+
+## Indexes which are not part of the schema (like full text indexes) are rebuilt from their tables after loading,
+## as (index table, source table, statement)
+_rebuild_statements = [
+    ('Memories_FTS', 'Memories', 'INSERT INTO Memories_FTS (rowid, memory_id, depth, content) SELECT rowid, id, depth, coalesce(content, summary) FROM Memories')
+]
+
+class SnapshotError(ValueError):
+    pass
+
+def _sha256_of_member(snapshot, member):
+    digest = hashlib.sha256()
+    with snapshot.open(member) as member_file:
+        for block in iter(lambda: member_file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+## Parts are checked as they are read so a corrupt snapshot never reaches the database
+def _read_verified(snapshot, manifest, member):
+    payload = snapshot.read(member)
+    if hashlib.sha256(payload).hexdigest() != manifest['files'][member]['sha256']:
+        raise SnapshotError(f"{member} failed its checksum")
+    return payload
+
+def _write_member(snapshot, manifest, member, payload, compress_type = zipfile.ZIP_DEFLATED):
+    snapshot.writestr(member, payload, compress_type=compress_type)
+    manifest['files'][member] = {'sha256': hashlib.sha256(payload).hexdigest(), 'bytes': len(payload)}
+
+## Virtual tables (like fts5) keep their data in shadow tables named after them; neither is exported as a plain table
+def _is_plain_table(entry, virtual_tables):
+    if entry['type'] != 'table' or entry['sql'].upper().startswith('CREATE VIRTUAL'):
+        return False
+    return not any(entry['name'].startswith(f"{v}_") for v in virtual_tables)
+
+def _vector_namespaces(sqldb, config):
+    namespaces = {}
+    for depth, memory_id in sqldb.execute('select depth, id from Memories order by depth, created_on'):
+        namespaces.setdefault(config['memory_management']['memory_namespace_template'] % int(depth), []).append(memory_id)
+    namespaces[config['memory_management']['theme_namespace_template']] = [t for (t,) in sqldb.execute('select id from Themes order by created_on')]
+    return namespaces
+
+def _encode_vectors(vectors):
+    values = [v for vector in vectors for v in vector['values']]
+    return struct.pack('<%ie' % len(values), *values)
+
+def _decode_vectors(payload, dimensions):
+    values = struct.unpack('<%ie' % (len(payload) // 2), payload)
+    return [list(values[i:i + dimensions]) for i in range(0, len(values), dimensions)]
+
+## Write the database, its vectors, and the archive segments to one snapshot file. Returns the manifest.
+def export_snapshot(snapshot_path, include_vectors = True, exclude_tables = None):
+    config = get_config()
+    chunk_rows = int(config['snapshot']['chunk_rows'])
+    exclude_tables = set(exclude_tables or [])
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'created_on': time(),
+        'schema': [],
+        'tables': [],
+        'vectors': [],
+        'archive': [],
+        'files': {}
+    }
+    sqldb = sqlite3.connect(config['database']['database_name'])
+    ## Every table is read inside one transaction so the snapshot is of a single moment
+    sqldb.execute('BEGIN')
+    try:
+        schema = [{'type': t, 'name': n, 'tbl_name': tn, 'sql': s} for t, n, tn, s in sqldb.execute(
+            "select type, name, tbl_name, sql from sqlite_master where sql is not null and name not like 'sqlite_%' order by rowid")]
+        virtual_tables = [e['name'] for e in schema if e['type'] == 'table' and e['sql'].upper().startswith('CREATE VIRTUAL')]
+        manifest['schema'] = [e for e in schema if e['type'] != 'table' or e['name'] in virtual_tables or _is_plain_table(e, virtual_tables)]
+        manifest['schema'] = [e for e in manifest['schema'] if e['tbl_name'] not in exclude_tables]
+        with zipfile.ZipFile(snapshot_path, 'w', zipfile.ZIP_DEFLATED) as snapshot:
+            for entry in manifest['schema']:
+                if not _is_plain_table(entry, virtual_tables):
+                    continue
+                cursor = sqldb.execute(f"select rowid, * from {entry['name']}")
+                columns = [c[0] for c in cursor.description]
+                table = {'name': entry['name'], 'columns': columns, 'rows': 0, 'parts': []}
+                while True:
+                    rows = cursor.fetchmany(chunk_rows)
+                    if len(rows) == 0:
+                        break
+                    member = 'tables/%s/%05i.json' % (entry['name'], len(table['parts']))
+                    _write_member(snapshot, manifest, member, json.dumps([list(c) for c in zip(*rows)], ensure_ascii=False).encode('utf-8'))
+                    table['parts'].append(member)
+                    table['rows'] += len(rows)
+                cursor.close()
+                manifest['tables'].append(table)
+                debug_message(f"Exported {table['rows']} rows of {entry['name']}.")
+
+            if include_vectors and pinecone_indexing_enabled:
+                for namespace, ids in _vector_namespaces(sqldb, config).items():
+                    vector_set = {'namespace': namespace, 'count': 0, 'dimensions': None, 'parts': []}
+                    for start in range(0, len(ids), chunk_rows):
+                        found = fetch_pinecone_vectors(ids[start:start + chunk_rows], namespace, config['snapshot']['vector_batch_size'])
+                        vectors = [found[i] for i in ids[start:start + chunk_rows] if i in found]
+                        if len(vectors) == 0:
+                            continue
+                        dimensions = len(vectors[0]['values'])
+                        if vector_set['dimensions'] not in (None, dimensions) or any(len(v['values']) != dimensions for v in vectors):
+                            raise SnapshotError(f"Vectors of namespace {namespace} do not all have the same dimensions")
+                        vector_set['dimensions'] = dimensions
+                        member = 'vectors/%s/%05i' % (namespace, len(vector_set['parts']))
+                        _write_member(snapshot, manifest, f"{member}.json", json.dumps({'ids': [v['id'] for v in vectors], 'metadata': [v['metadata'] for v in vectors]}, ensure_ascii=False).encode('utf-8'))
+                        _write_member(snapshot, manifest, f"{member}.f16", _encode_vectors(vectors))
+                        vector_set['parts'].append(member)
+                        vector_set['count'] += len(vectors)
+                    manifest['vectors'].append(vector_set)
+                    debug_message(f"Exported {vector_set['count']} vectors of {namespace}.")
+
+            ## Segments are already compressed so they are stored as they are
+            if 'Memory_Archive' not in exclude_tables and os.path.isdir(memory_archive.archive_dir):
+                for segment in sorted(os.listdir(memory_archive.archive_dir)):
+                    segment_path = os.path.join(memory_archive.archive_dir, segment)
+                    member = f"archive/{segment}"
+                    snapshot.write(segment_path, member, compress_type=zipfile.ZIP_STORED)
+                    manifest['files'][member] = {'sha256': _sha256_of_member(snapshot, member), 'bytes': os.path.getsize(segment_path)}
+                    manifest['archive'].append(member)
+
+            snapshot.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    finally:
+        sqldb.rollback()
+        sqldb.close()
+    return manifest
+
+def read_manifest(snapshot):
+    try:
+        manifest = json.loads(snapshot.read('manifest.json'))
+    except KeyError:
+        raise SnapshotError('The snapshot has no manifest.json')
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError('The file is not a snapshot')
+    if int(manifest.get('format_version', 0)) > SNAPSHOT_FORMAT_VERSION:
+        raise SnapshotError(f"The snapshot is format version {manifest['format_version']}; this version reads up to {SNAPSHOT_FORMAT_VERSION}")
+    return manifest
+
+## Check every file of a snapshot against the manifest without loading anything. Returns the manifest.
+def verify_snapshot(snapshot_path):
+    with zipfile.ZipFile(snapshot_path, 'r') as snapshot:
+        manifest = read_manifest(snapshot)
+        for member, expected in manifest['files'].items():
+            try:
+                checksum = _sha256_of_member(snapshot, member)
+            except KeyError:
+                raise SnapshotError(f"{member} is listed in the manifest but missing from the snapshot")
+            if checksum != expected['sha256']:
+                raise SnapshotError(f"{member} failed its checksum")
+    return manifest
+
+## Load a snapshot into a new database (the configured one unless another is named), then its vectors and archive segments.
+## An existing database is only replaced if asked. Returns the manifest.
+def import_snapshot(snapshot_path, database_name = None, replace = False, include_vectors = True):
+    config = get_config()
+    database_name = database_name or config['database']['database_name']
+    if os.path.exists(database_name) and os.path.getsize(database_name) > 0 and not replace:
+        raise SnapshotError(f"{database_name} already exists; import with replace to overwrite it")
+    manifest = verify_snapshot(snapshot_path)
+    clashing_segments = [m for m in manifest['archive'] if os.path.exists(os.path.join(memory_archive.archive_dir, os.path.basename(m)))]
+    if len(clashing_segments) > 0 and not replace:
+        raise SnapshotError(f"{memory_archive.archive_dir} already has segments of the same name; import with replace to overwrite them")
+    loading_name = f"{database_name}.importing"
+    if os.path.exists(loading_name):
+        os.remove(loading_name)
+
+    with zipfile.ZipFile(snapshot_path, 'r') as snapshot:
+        sqldb = sqlite3.connect(loading_name)
+        try:
+            ## Nothing else can see this file until it is complete, so there is no need for a journal
+            sqldb.execute('PRAGMA journal_mode = OFF')
+            sqldb.execute('PRAGMA synchronous = OFF')
+            tables = [e for e in manifest['schema'] if e['type'] == 'table' and not e['sql'].upper().startswith('CREATE VIRTUAL')]
+            with sqldb:
+                for entry in tables:
+                    sqldb.execute(entry['sql'])
+                for table in manifest['tables']:
+                    insert = f"INSERT INTO {table['name']} ({', '.join(table['columns'])}) VALUES ({', '.join('?' * len(table['columns']))})"
+                    for member in table['parts']:
+                        sqldb.executemany(insert, zip(*json.loads(_read_verified(snapshot, manifest, member))))
+                    (row_count,) = sqldb.execute(f"select count(*) from {table['name']}").fetchone()
+                    if row_count != table['rows']:
+                        raise SnapshotError(f"{table['name']} loaded {row_count} rows; the manifest lists {table['rows']}")
+                    debug_message(f"Imported {row_count} rows of {table['name']}.")
+            ## Indexes, virtual tables, and triggers are built once the rows are in instead of being kept up to date row by row
+            with sqldb:
+                for kind in ('index', 'table', 'view', 'trigger'):
+                    for entry in manifest['schema']:
+                        if entry['type'] == kind and (kind != 'table' or entry['sql'].upper().startswith('CREATE VIRTUAL')):
+                            sqldb.execute(entry['sql'])
+                schema_names = [e['name'] for e in manifest['schema']]
+                for index_table, source_table, statement in _rebuild_statements:
+                    if index_table in schema_names and source_table in schema_names:
+                        sqldb.execute(statement)
+        except Exception:
+            sqldb.close()
+            os.remove(loading_name)
+            raise
+        sqldb.close()
+        os.replace(loading_name, database_name)
+
+        for member in manifest['archive']:
+            os.makedirs(memory_archive.archive_dir, exist_ok=True)
+            with snapshot.open(member) as source, open(os.path.join(memory_archive.archive_dir, os.path.basename(member)), 'wb') as destination:
+                shutil.copyfileobj(source, destination, 1024 * 1024)
+
+        if include_vectors:
+            batch_size = int(config['snapshot']['vector_batch_size'])
+            for vector_set in manifest['vectors']:
+                for member in vector_set['parts']:
+                    part = json.loads(_read_verified(snapshot, manifest, f"{member}.json"))
+                    values = _decode_vectors(_read_verified(snapshot, manifest, f"{member}.f16"), vector_set['dimensions'])
+                    payload = [{'id': i, 'values': v, 'metadata': m} for i, v, m in zip(part['ids'], values, part['metadata'])]
+                    for start in range(0, len(payload), batch_size):
+                        save_payload_to_pinecone(payload[start:start + batch_size], vector_set['namespace'])
+                debug_message(f"Imported {vector_set['count']} vectors of {vector_set['namespace']}.")
+    return manifest
@@ -0,0 +1,92 @@
+import contextvars
+from time import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from UtilityFunctions import debug_message, get_config
+from TelemetryManagement import telemetry_stage
+
+## The task manager runs independent sub-prompts concurrently and pushes bookkeeping work (like prompt logging) off the critical path.
+## Python threads cannot be cancelled, so a stage which times out keeps running in the pool; its result is simply ignored.
+## Work runs in a copy of the caller's context so telemetry keeps attributing it to the caller's conversation turn.
+
+## A unit of work run by the task manager. If the stage fails or times out the default value is used instead.
+class Stage:
+    def __init__(self, name, function, args = (), kwargs = None, timeout = None, default = None):
+        self.name = name
+        self.function = function
+        self.args = tuple(args)
+        self.kwargs = {} if kwargs is None else kwargs
+        self.timeout = timeout
+        self.default = default
+
+class TaskManager:
+    def __init__(self):
+        self.__config = get_config()
+        self.debug_messages_enabled = True
+        stage_workers = int(self.__config['tasks']['stage_workers'])
+        self.__stage_executor = ThreadPoolExecutor(max_workers=stage_workers, thread_name_prefix='raven-stage')
+        ## Background work runs on a single thread so it is processed in the order it was submitted
+        self.__background_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='raven-background')
+        ## Outcome of each stage in the most recent run: 'completed', 'timeout', or 'error'
+        self.last_stage_status = {}
+        ## Wall time (in seconds) of each stage in the most recent run
+        self.last_stage_timings = {}
+
+    ## Run all stages at the same time and return a dictionary of their results keyed by stage name.
+    ## Each stage timeout is measured from the moment the stages were submitted.
+    def run_concurrently(self, stages):
+        start_time = time()
+        timings = {}
+        def timed(stage):
+            stage_start = time()
+            try:
+                with telemetry_stage(stage.name):
+                    return stage.function(*stage.args, **stage.kwargs)
+            finally:
+                timings[stage.name] = time() - stage_start
+        futures = {stage.name: (stage, self.__stage_executor.submit(contextvars.copy_context().run, timed, stage)) for stage in stages}
+        results = {}
+        status = {}
+        for name, (stage, future) in futures.items():
+            remaining = None
+            if stage.timeout is not None:
+                remaining = max(0.0, float(stage.timeout) - (time() - start_time))
+            try:
+                results[name] = future.result(timeout=remaining)
+                status[name] = 'completed'
+            except TimeoutError:
+                debug_message(f"Stage {name} did not finish within {stage.timeout} seconds, using its default value.", self.debug_messages_enabled)
+                results[name] = stage.default
+                status[name] = 'timeout'
+            except Exception as err:
+                debug_message(f"Stage {name} failed: {err}", self.debug_messages_enabled)
+                results[name] = stage.default
+                status[name] = 'error'
+        self.last_stage_status = status
+        self.last_stage_timings = timings
+        return results
+
+    ## Queue work which the caller does not need to wait on. Errors are reported but never raised.
+    def run_in_background(self, function, *args, **kwargs):
+        def guarded():
+            try:
+                with telemetry_stage('background'):
+                    return function(*args, **kwargs)
+            except Exception as err:
+                debug_message(f"Background task {getattr(function, '__name__', function)} failed: {err}", True)
+        return self.__background_executor.submit(contextvars.copy_context().run, guarded)
+
+    ## Block until all queued background work is done; useful before shutting down.
+    def wait_for_background(self):
+        self.__background_executor.submit(lambda: None).result()
+
+## Shared instance so every manager queues background work on the same thread
+_task_manager = None
+_task_manager_lock = Lock()
+
+def get_task_manager():
+    global _task_manager
+    with _task_manager_lock:
+        if _task_manager is None:
+            _task_manager = TaskManager()
+    return _task_manager
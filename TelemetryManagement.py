@@ -0,0 +1,168 @@
+import sqlite3
+import contextvars
+import functools
+from uuid import uuid4
+from time import time, perf_counter
+from threading import Lock
+from contextlib import contextmanager
+
+## Telemetry records the wall time of every model, embedding, vector, and SQL call as a span. Spans are grouped under
+## the conversation turn and pipeline stage which made them, so a slow turn can be broken down into what it waited on.
+## The current turn and stage are held in context variables; the task manager copies them onto its worker threads.
+## Spans are buffered in memory and written in batches to the Telemetry_Spans table on their own connection.
+
+_current_turn_id = contextvars.ContextVar('raven_turn_id', default=None)
+_current_stage = contextvars.ContextVar('raven_stage', default='')
+## Kind of the innermost open span; a span inside another of the same kind (an insert which updates) is not recorded twice
+_current_span_kind = contextvars.ContextVar('raven_span_kind', default=None)
+
+def current_turn_id():
+    return _current_turn_id.get()
+
+def current_stage():
+    return _current_stage.get()
+
+## Everything inside this block is attributed to the named pipeline stage
+@contextmanager
+def telemetry_stage(name):
+    token = _current_stage.set(name)
+    try:
+        yield name
+    finally:
+        _current_stage.reset(token)
+
+## Value at the given percentile (0-100) of an already sorted list, by linear interpolation
+def percentile(sorted_values, percent):
+    if len(sorted_values) == 0:
+        return None
+    position = (len(sorted_values) - 1) * (float(percent) / 100.0)
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+class Telemetry:
+    def __init__(self, database_name, enabled = True, flush_size = 50, completion_cost_per_1k_tokens = 0.0, embedding_cost_per_1k_tokens = 0.0):
+        self.__database_name = database_name
+        self.__enabled = bool(enabled)
+        self.__flush_size = int(flush_size)
+        self.__cost_per_1k_tokens = {'llm': float(completion_cost_per_1k_tokens), 'embedding': float(embedding_cost_per_1k_tokens)}
+        self.__spans = []
+        self.__lock = Lock()
+
+    @property
+    def enabled(self):
+        return self.__enabled
+
+    ## Everything inside this block belongs to one conversation turn; the turn's own wall time is recorded as a span too
+    @contextmanager
+    def turn(self):
+        turn_id = str(uuid4())
+        token = _current_turn_id.set(turn_id)
+        try:
+            with self.span('turn', 'conversation_turn'):
+                yield turn_id
+        finally:
+            _current_turn_id.reset(token)
+            self.flush()
+
+    ## Time the block and record it. The yielded dictionary can be filled in with model, tokens, retries, cache_hit, and success.
+    @contextmanager
+    def span(self, kind, name = ''):
+        if not self.__enabled or _current_span_kind.get() == kind:
+            yield {}
+            return
+        record = {'model': None, 'tokens': None, 'retries': 0, 'cache_hit': False}
+        token = _current_span_kind.set(kind)
+        success = True
+        start = perf_counter()
+        try:
+            yield record
+        except BaseException:
+            success = False
+            raise
+        finally:
+            latency_ms = (perf_counter() - start) * 1000.0
+            _current_span_kind.reset(token)
+            ## The caller may mark a handled failure itself
+            record['success'] = success and record.get('success', True)
+            self.record(kind, name, latency_ms, **record)
+
+    ## Decorator which records a span for every call. The span is named after the first argument (like a table name) unless a name is given.
+    def traced(self, kind, name = None):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                span_name = name if name is not None else (str(args[0]) if len(args) > 0 else function.__name__)
+                with self.span(kind, span_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, kind, name, latency_ms, model = None, tokens = None, retries = 0, cache_hit = False, success = True):
+        if not self.__enabled:
+            return
+        cost = None
+        if tokens is not None and kind in self.__cost_per_1k_tokens and not cache_hit:
+            cost = max(int(tokens), 0) / 1000.0 * self.__cost_per_1k_tokens[kind]
+        span = (str(uuid4()), _current_turn_id.get(), _current_stage.get(), kind, name, model, float(latency_ms),
+            tokens, int(retries), int(bool(cache_hit)), int(bool(success)), cost, time())
+        with self.__lock:
+            self.__spans.append(span)
+            should_flush = len(self.__spans) >= self.__flush_size
+        if should_flush:
+            self.flush()
+
+    ## Write buffered spans in a single transaction
+    def flush(self):
+        with self.__lock:
+            spans = self.__spans
+            self.__spans = []
+        if len(spans) == 0:
+            return
+        try:
+            sqldb = sqlite3.connect(self.__database_name)
+            with sqldb:
+                sqldb.executemany('insert into Telemetry_Spans (id, turn_id, stage, kind, name, model, latency_ms, tokens, retries, cache_hit, success, cost, created_on) values (?,?,?,?,?,?,?,?,?,?,?,?,?)', spans)
+            sqldb.close()
+        except sqlite3.Error as err:
+            print(f"Unable to save telemetry: {err}")
+
+    ## Latency percentiles grouped by the given column ('stage', 'name', or 'kind'), optionally only for (or without) one kind of span
+    def latency_report(self, group_by = 'stage', kind = None, since = None, exclude_kind = None):
+        if group_by not in ('stage', 'name', 'kind'):
+            raise ValueError(f"Unable to group telemetry by {group_by}")
+        self.flush()
+        conditions = []
+        params = []
+        if kind is not None:
+            conditions.append('kind = ?')
+            params.append(kind)
+        if exclude_kind is not None:
+            conditions.append('kind != ?')
+            params.append(exclude_kind)
+        if since is not None:
+            conditions.append('created_on >= ?')
+            params.append(float(since))
+        where = ('where ' + ' and '.join(conditions)) if len(conditions) > 0 else ''
+        sqldb = sqlite3.connect(self.__database_name)
+        rows = sqldb.execute(f"select {group_by}, latency_ms, tokens, retries, cache_hit, cost from Telemetry_Spans {where}", params).fetchall()
+        sqldb.close()
+        groups = {}
+        for group, latency_ms, tokens, retries, cache_hit, cost in rows:
+            groups.setdefault(group or '(none)', []).append((latency_ms, tokens or 0, retries or 0, cache_hit or 0, cost or 0.0))
+        report = []
+        for group, spans in groups.items():
+            latencies = sorted(s[0] for s in spans)
+            report.append({
+                group_by: group,
+                'count': len(spans),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'tokens': sum(s[1] for s in spans),
+                'retries': sum(s[2] for s in spans),
+                'cache_hits': sum(s[3] for s in spans),
+                'cost': sum(s[4] for s in spans)
+            })
+        report.sort(key=lambda r: r['p95_ms'], reverse=True)
+        return report
@@ -0,0 +1,151 @@
+import re
+import calendar
+import datetime
+from time import time
+
+## Phrases like 'yesterday', 'last week', or '3 days ago' are resolved into a range of unix times here, without a completion.
+## Ranges are in local time and end-exclusive. 'Last time' (the previous conversation) depends on when messages were sent,
+## so it is returned as a marker for the memory manager to resolve from the database.
+## A time phrase alone does not ask for memories ('How are you today?', 'I will go on friday'); resolve_recall_time_range
+## only resolves phrases in sentences which ask to recall something.
+
+_number_words = {
+    'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10,
+    'a couple of': 2, 'a couple': 2, 'couple of': 2, 'a few': 3, 'few': 3, 'several': 3
+}
+_number_pattern = r"(\d+|a couple of|a couple|couple of|a few|few|several|an|a|one|two|three|four|five|six|seven|eight|nine|ten)"
+_unit_pattern = r"(minute|hour|day|week|month|year)s?"
+_weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+## Parts of today as (start hour, end hour)
+_parts_of_day = {
+    'this morning': (5, 12),
+    'this afternoon': (12, 17),
+    'this evening': (17, 24),
+    'tonight': (17, 24)
+}
+
+_previous_session = re.compile(r"\b(last time|last conversation|last session|previous conversation|previous session|last chat|last we (spoke|talked))\b", re.IGNORECASE)
+_ago = re.compile(rf"\b{_number_pattern} {_unit_pattern} ago\b", re.IGNORECASE)
+_past = re.compile(rf"\b(?:last|past) {_number_pattern} {_unit_pattern}\b", re.IGNORECASE)
+_relative = re.compile(r"\b(day before yesterday|yesterday|last night|earlier today|today|this morning|this afternoon|this evening|tonight|(?:this|last) (?:week|month|year))\b", re.IGNORECASE)
+_weekday = re.compile(rf"\b(?:on|last) ({'|'.join(_weekdays)})\b", re.IGNORECASE)
+
+## A sentence asks to recall something if it uses a recall verb, or is a question about the past
+_recall_verbs = re.compile(r"\b(remember|recall|remind|forget|forgot|mention(?:ed)?|discuss(?:ed)?|talk(?:ed)? about|spoke about|told|said|tell me|go over|went over)\b", re.IGNORECASE)
+_past_question = re.compile(r"\b(did|was|were|had|happened|went|where were we)\b", re.IGNORECASE)
+_sentence = re.compile(r"[^.!?\n]+[.!?]*")
+
+def _to_number(word):
+    word = word.lower()
+    if word.isdigit():
+        return int(word)
+    return _number_words[word]
+
+def _start_of_day(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _start_of_month(moment):
+    return _start_of_day(moment).replace(day=1)
+
+## The same day of another month, or that month's last day if it is shorter
+def _add_months(moment, months):
+    month_index = moment.month - 1 + months
+    year, month = moment.year + month_index // 12, month_index % 12 + 1
+    return moment.replace(year=year, month=month, day=min(moment.day, calendar.monthrange(year, month)[1]))
+
+## The calendar unit (day, week, month, or year) which contains the moment
+def _unit_containing(moment, unit):
+    if unit == 'day':
+        start = _start_of_day(moment)
+        return start, start + datetime.timedelta(days=1)
+    if unit == 'week':
+        start = _start_of_day(moment) - datetime.timedelta(days=moment.weekday())
+        return start, start + datetime.timedelta(weeks=1)
+    if unit == 'month':
+        start = _start_of_month(moment)
+        return start, _add_months(start, 1)
+    start = _start_of_month(moment).replace(month=1)
+    return start, start.replace(year=start.year + 1)
+
+def _shift(moment, unit, count):
+    if unit == 'minute':
+        return moment - datetime.timedelta(minutes=count)
+    if unit == 'hour':
+        return moment - datetime.timedelta(hours=count)
+    if unit == 'day':
+        return moment - datetime.timedelta(days=count)
+    if unit == 'week':
+        return moment - datetime.timedelta(weeks=count)
+    if unit == 'month':
+        return _add_months(moment, -count)
+    return _add_months(moment, -12 * count)
+
+def _range(phrase, start, end):
+    return {'phrase': phrase, 'start': start.timestamp(), 'end': end.timestamp()}
+
+## Resolve the first time phrase in the text. Returns {'phrase', 'start', 'end'}, {'phrase', 'session': 'previous'}, or None.
+def resolve_time_range(text, now = None):
+    now = datetime.datetime.fromtimestamp(time() if now is None else float(now))
+    today = _start_of_day(now)
+
+    match = _previous_session.search(text)
+    if match is not None:
+        return {'phrase': match.group(0), 'session': 'previous'}
+
+    match = _ago.search(text)
+    if match is not None:
+        count, unit = _to_number(match.group(1)), match.group(2).lower()
+        moment = _shift(now, unit, count)
+        ## Minutes and hours are too short to be exact about; allow a unit either side
+        if unit in ('minute', 'hour'):
+            return _range(match.group(0), _shift(moment, unit, 1), _shift(moment, unit, -1))
+        start, end = _unit_containing(moment, unit)
+        return _range(match.group(0), start, end)
+
+    match = _past.search(text)
+    if match is not None:
+        count, unit = _to_number(match.group(1)), match.group(2).lower()
+        return _range(match.group(0), _shift(now, unit, count), now)
+
+    match = _relative.search(text)
+    if match is not None:
+        phrase = match.group(1).lower()
+        if phrase == 'day before yesterday':
+            return _range(match.group(0), today - datetime.timedelta(days=2), today - datetime.timedelta(days=1))
+        if phrase == 'yesterday':
+            return _range(match.group(0), today - datetime.timedelta(days=1), today)
+        if phrase == 'last night':
+            return _range(match.group(0), today - datetime.timedelta(hours=6), today + datetime.timedelta(hours=5))
+        if phrase in ('today', 'earlier today'):
+            return _range(match.group(0), today, now)
+        if phrase in _parts_of_day:
+            start_hour, end_hour = _parts_of_day[phrase]
+            return _range(match.group(0), today + datetime.timedelta(hours=start_hour), min(now, today + datetime.timedelta(hours=end_hour)))
+        which, unit = phrase.split(' ')
+        start, end = _unit_containing(now, unit)
+        if which == 'this':
+            return _range(match.group(0), start, now)
+        return _range(match.group(0), *_unit_containing(_shift(start, unit, 1), unit))
+
+    match = _weekday.search(text)
+    if match is not None:
+        ## The most recent such day before today
+        days_back = (now.weekday() - _weekdays.index(match.group(1).lower())) % 7 or 7
+        start = today - datetime.timedelta(days=days_back)
+        return _range(match.group(0), start, start + datetime.timedelta(days=1))
+    return None
+
+def asks_to_recall(sentence):
+    if _recall_verbs.search(sentence) is not None:
+        return True
+    return sentence.rstrip().endswith('?') and _past_question.search(sentence) is not None
+
+## Resolve the first time phrase in a sentence which asks to recall something, or None if there is none (see resolve_time_range)
+def resolve_recall_time_range(text, now = None):
+    for sentence in _sentence.findall(text):
+        if asks_to_recall(sentence):
+            time_range = resolve_time_range(sentence, now)
+            if time_range is not None:
+                return time_range
+    return None
@@ -4,8 +4,9 @@ import json
 import glob
 import random
 from time import time,sleep
+from threading import Thread, Event
 import datetime
-from uuid import uuid4
+from uuid import uuid4, uuid5, NAMESPACE_URL
 # import pinecone
 # import tiktoken
 import re
@@ -43,6 +44,18 @@ class ThemeManager:
         self.__config = get_config()
         self.debug_messages_enabled = True
         self.__prompts = PromptManager()
+        ## Running total of model calls and tokens spent by this theme manager; used to budget background retheming
+        self.__usage = {'llm_calls': 0, 'tokens': 0}
+
+    @property
+    def usage(self):
+        return dict(self.__usage)
+
+    ## Embeddings made while theming count against the same budget as completions
+    def __embed(self, content):
+        self.__usage['llm_calls'] += 1
+        self.__usage['tokens'] += get_token_estimate(content)
+        return gpt3_embedding(content, PRIORITY_BACKGROUND)
 
     def __theme_template(self):
         theme = {
@@ -87,163 +100,208 @@ class ThemeManager:
     def create_theme_link_object(self, **kwargs):
         return create_row_object('Theme_Links', **kwargs)
 
-    ## Get a list of themes from a summary of a memory and prepare the theme embedding objects
-    def extract_themes(self, content):
+    ## Add a phrase to a theme (if it is new) and append a history entry for it, in SQL rather than by rewriting the row,
+    ## so compression and retheming can extract themes at the same time without losing each other's changes
+    def append_theme_phrase(self, theme_id, phrase, similarity, sqldb = None):
+        query = '''
+        update Themes set
+            phrases = case when exists (select 1 from json_each(Themes.phrases) where value = :phrase) then phrases else json_insert(coalesce(phrases, '[]'), '$[#]', :phrase) end,
+            theme_history = json_patch(coalesce(theme_history, '{}'), json_object(:phrase, json_insert(
+                coalesce((select h.value from json_each(Themes.theme_history) h where h.key = :phrase), '[]'), '$[#]',
+                json_object('iteration', coalesce((select json_array_length(h.value) from json_each(Themes.theme_history) h where h.key = :phrase), 0), 'similarity', :similarity, 'created_on', :timestamp)))),
+            modified_on = :timestamp
+        where id = :id
+        '''
+        params = {'id': theme_id, 'phrase': phrase, 'similarity': float(similarity), 'timestamp': time()}
+        if sqldb is None:
+            with sql_transaction() as sqldb:
+                return sqldb.execute(query, params).rowcount
+        return sqldb.execute(query, params).rowcount
+
+    ## Get a list of themes from a summary of a memory, match them to existing themes, and save the changes
+    ## Given a prompt id, a saved extraction is reused and new theme ids are derived from it so a repeated extraction makes the same themes
+    ## is_preempted is asked between model calls; if it returns True the extraction stops, nothing is saved, and None is returned.
+    ## Raises StructuredOutputError if the extraction failed, also without saving anything.
+    def extract_themes(self, content, prompt_id = None, is_preempted = None):
+        theme_plan = self.plan_themes(content, prompt_id, is_preempted)
+        if theme_plan is None:
+            return None
+        with sql_transaction() as sqldb:
+            return self.apply_themes(sqldb, theme_plan)
+
+    ## Decide what extracting themes from the content changes, without changing anything: the model and embedding calls happen
+    ## here and the writes in apply_themes, so an extraction which is interrupted part way leaves no trace. Themes made earlier
+    ## in the same extraction are matched locally since their vectors are not saved yet. Returns None if preempted.
+    ## A failed extraction raises StructuredOutputError rather than planning no themes, so it is not recorded as finished.
+    def plan_themes(self, content, prompt_id = None, is_preempted = None):
         print('Extracting themes...')
-        timestamp = str(time())
-        extracted_themes = {}
+        timestamp = time()
+        theme_plan = {'themes': {}, 'new_themes': {}, 'appended_phrases': [], 'phrases': {}, 'vectors': {}}
         ## Prompt for themes
-        themes_result = self.extract_content_themes(content)
-        ## Cleanup themes
-        themes, has_error = self.cleanup_theme_response(themes_result)
-        if has_error:
-            breakpoint('there was a thematic extraction error')
-            return extracted_themes
+        themes = self.extract_content_themes(content, prompt_id)
         theme_namespace = self.__config['memory_management']['theme_namespace_template']
         theme_match_threshold = float(self.__config['memory_management']['theme_match_threshold'])
         print('themes extracted...')
         for phrase in themes:
+            if is_preempted is not None and is_preempted():
+                debug_message('Theme extraction preempted.', self.debug_messages_enabled)
+                return None
             phrase = (str(phrase)).lower()
             ## Embed this theme and check for the most similar Theme Object
-            vector = gpt3_embedding(phrase)
-            theme_matches = query_pinecone(vector, 1, namespace=theme_namespace)
-            if theme_matches is not None:
-                if len(theme_matches['matches']) > 0:
-                    ## There is a match so check the threshold
-                    match_score = float(theme_matches['matches'][0]['score'])
-                    if match_score >= theme_match_threshold:
-                        ## Theme score is above the threshold, update an existing theme
-                        existing_theme_id = theme_matches['matches'][0]['id']
-                        ## Load, update, and save theme
-                        query_themes = sql_query_by_ids('Themes','id',existing_theme_id)
-                        if len(query_themes) == 0:
-                            print(query_themes)
-                            print(type(existing_theme_id))
-                            breakpoint(f"Issue fetching existing theme from database: {existing_theme_id}")
-                            continue
-                        existing_theme = query_themes[0]
-                        if phrase not in existing_theme['phrases']:
-                            ## Add new phrase to the themes list
-                            existing_theme['phrases'].append(phrase)
-                             ## Start tracking the history of this newly added theme
-                            if existing_theme['theme_history'] is None:
-                                existing_theme['theme_history'] = {}
-                            existing_theme['theme_history'].update({phrase: [self.generate_theme_history(0, match_score)]})
-                            ## Embed the new collection of phrases
-                            new_phrases_string = ','.join(existing_theme['phrases'])
-                            new_phrases_vector = gpt3_embedding(new_phrases_string)
-                            ## Update existing pinecone record's vector
-                            update_pinecone_vector(existing_theme_id, new_phrases_vector, theme_namespace)
-                        else:
-                            ## Get the existing theme history, the count elements is the new iteration number
-                            history_count = len(existing_theme['theme_history'][phrase])
-                            ## Track the match_score of this theme
-                            existing_theme['theme_history'][phrase].append(self.generate_theme_history(history_count, match_score))
-
-                        ## Update the existing Theme Object
-                        sql_update_row('Themes','id', existing_theme)
-                            
-                        ## Add to extracted theme id to list and keep track of how many times a similar theme has been extracted
-                        if existing_theme_id not in extracted_themes:
-                            extracted_themes[existing_theme_id] = {'recurrence':1, 'new_theme':False}
-                        else:
-                            extracted_themes[existing_theme_id]['recurrence'] += 1
+            vector = self.__embed(phrase)
+            match_id, match_score = None, 0.0
+            for new_theme_id, new_theme in theme_plan['new_themes'].items():
+                new_theme_score = cosine_similarity(vector, theme_plan['vectors'][new_theme_id])
+                if new_theme_score > match_score:
+                    match_id, match_score = new_theme_id, new_theme_score
+            theme_matches = query_pinecone(vector, 3, namespace=theme_namespace)
+            for theme_match in (theme_matches['matches'] if theme_matches is not None else []):
+                if float(theme_match['score']) < max(theme_match_threshold, match_score):
+                    break
+                ## Vectors of themes made in this extraction, or left by one which was interrupted, have no Themes row yet
+                if theme_match['id'] in theme_plan['new_themes']:
+                    continue
+                if theme_match['id'] not in theme_plan['phrases']:
+                    query_themes = sql_query_by_ids('Themes','id',theme_match['id'])
+                    if len(query_themes) == 0:
                         continue
-            ## The theme score falls under the threshold or there was no match, make a new theme
-            unique_id = str(uuid4())
-
-            ## Add the theme to pinecone before making it so that similar themes in the current list can be merged
-            payload = [{'id': unique_id, 'values': vector}]
-            save_payload_to_pinecone(payload, theme_namespace)
+                    theme_plan['phrases'][theme_match['id']] = list(query_themes[0]['phrases'] or [])
+                match_id, match_score = theme_match['id'], float(theme_match['score'])
+                break
+
+            if match_id is not None and match_score >= theme_match_threshold:
+                ## Theme score is above the threshold, update an existing theme (or one made earlier in this extraction)
+                if phrase not in theme_plan['phrases'][match_id]:
+                    ## The collection of phrases will be embedded again once every phrase has been matched
+                    theme_plan['phrases'][match_id].append(phrase)
+                    theme_plan['vectors'][match_id] = None
+                if match_id in theme_plan['new_themes']:
+                    new_theme = theme_plan['new_themes'][match_id]
+                    new_theme['phrases'] = theme_plan['phrases'][match_id]
+                    new_theme['theme_history'].setdefault(phrase, [])
+                    new_theme['theme_history'][phrase].append(self.generate_theme_history(len(new_theme['theme_history'][phrase]), match_score))
+                else:
+                    theme_plan['appended_phrases'].append({'theme_id': match_id, 'phrase': phrase, 'similarity': match_score})
+                ## Keep track of how many times a similar theme has been extracted
+                if match_id not in theme_plan['themes']:
+                    theme_plan['themes'][match_id] = {'recurrence':1, 'new_theme':False}
+                else:
+                    theme_plan['themes'][match_id]['recurrence'] += 1
+                continue
 
-            ## Make theme and save it to the database
+            ## The theme score falls under the threshold or there was no match, make a new theme
+            if prompt_id is None:
+                unique_id = str(uuid4())
+            else:
+                unique_id = str(uuid5(NAMESPACE_URL, f"{prompt_id}:{phrase}"))
             ## Initialize the theme history tracking. The similarity score is 1 (100%)
-            new_theme = self.create_theme_object(
+            theme_plan['new_themes'][unique_id] = self.create_theme_object(
                     id=unique_id,
                     phrases=[phrase],
                     theme_history={phrase: [self.generate_theme_history(0, 1.0)]},
                     created_on=timestamp,
                     modified_on=timestamp
                 )
-            sql_insert_row('Themes','id', new_theme)
-
-            ## Add to extracted theme list
-            extracted_themes[unique_id] = {'recurrence':1, 'new_theme':True}
-
-        return extracted_themes
-
-    ## Get themes
-    def extract_content_themes(self, content):
+            theme_plan['phrases'][unique_id] = [phrase]
+            theme_plan['vectors'][unique_id] = vector
+            theme_plan['themes'][unique_id] = {'recurrence':1, 'new_theme':True}
+
+        ## Embed the new collection of phrases of every theme which gained one
+        for theme_id, theme_vector in theme_plan['vectors'].items():
+            if theme_vector is None:
+                if is_preempted is not None and is_preempted():
+                    return None
+                theme_plan['vectors'][theme_id] = self.__embed(','.join(theme_plan['phrases'][theme_id]))
+        return theme_plan
+
+    ## Save a theme plan on the given transaction and return the extracted themes, {theme id: {'recurrence', 'new_theme'}}.
+    ## Vectors are saved before the first write so the database is not locked while waiting on pinecone. Theme ids are
+    ## deterministic, so if the transaction does not commit, saving the same vectors again is harmless.
+    def apply_themes(self, sqldb, theme_plan):
+        theme_namespace = self.__config['memory_management']['theme_namespace_template']
+        payload = [{'id': theme_id, 'values': theme_plan['vectors'][theme_id]} for theme_id in theme_plan['new_themes']]
+        if len(payload) > 0:
+            save_payload_to_pinecone(payload, theme_namespace)
+        for theme_id, theme_vector in theme_plan['vectors'].items():
+            if theme_id not in theme_plan['new_themes']:
+                update_pinecone_vector(theme_id, theme_vector, theme_namespace)
+        for new_theme in theme_plan['new_themes'].values():
+            sqldb.execute('insert or replace into Themes (id, phrases, theme_history, created_on, modified_on) values (?,?,?,?,?)',
+                (new_theme['id'], json.dumps(new_theme['phrases']), json.dumps(new_theme['theme_history']), new_theme['created_on'], new_theme['modified_on']))
+        for appended in theme_plan['appended_phrases']:
+            self.append_theme_phrase(appended['theme_id'], appended['phrase'], appended['similarity'], sqldb)
+        return theme_plan['themes']
+
+    ## Get a list of themes; raises StructuredOutputError if the response cannot be used even after a repair.
+    ## Failed extractions are saved with -1 tokens and never reused.
+    def extract_content_themes(self, content, prompt_id = None):
+        if prompt_id is not None:
+            saved_prompts = sql_query_by_ids('Prompts', 'id', prompt_id)
+            if len(saved_prompts) > 0 and saved_prompts[0]['response'] and int(saved_prompts[0]['tokens'] or 0) >= 0:
+                try:
+                    saved_response = saved_prompts[0]['response']
+                    if not isinstance(saved_response, str):
+                        saved_response = json.dumps(saved_response)
+                    themes_obj = parse_structured_response(saved_response, self.__prompts.ThemeExtraction.response_schema, 'ThemeExtraction')
+                    debug_message(f"Reusing saved theme extraction {prompt_id}...", True)
+                    return themes_obj['themes']
+                except StructuredOutputError:
+                    pass
         prompt = self.__prompts.ThemeExtraction.get_prompt(content)
         temperature = self.__prompts.ThemeExtraction.temperature
         response_tokens = self.__prompts.ThemeExtraction.response_tokens
 
         message = [self.compose_gpt_message(prompt,'user')]
-        response, tokens = gpt_completion(message, temperature, response_tokens)
+        extraction_error = None
+        try:
+            themes_obj, response, tokens = gpt_structured_completion(message, self.__prompts.ThemeExtraction.response_schema, temperature, response_tokens, priority=PRIORITY_BACKGROUND, prompt_type='ThemeExtraction')
+        except StructuredOutputError as err:
+            extraction_error = err
+            response, tokens = err.response, -1
+        self.__usage['llm_calls'] += 1
+        self.__usage['tokens'] += max(int(tokens), 0)
 
         ## Save anticipation prompt and response
         prompt_row = create_row_object(
             table_name='Prompts',
-            id=str(uuid4()),
+            id=prompt_id if prompt_id is not None else str(uuid4()),
             prompt=prompt,
             response=response,
             tokens=tokens,
             temperature=temperature,
             comments='Extract themes.',
-            created_on=str(time())
+            created_on=time()
         )
         sql_insert_row('Prompts','id',prompt_row)
 
-        return response
+        if extraction_error is not None:
+            raise extraction_error
+        return themes_obj['themes']
 
-    ## Get themes
+    ## Get a list of themes; raises StructuredOutputError if the response cannot be used even after a repair
     def extract_recall_themes(self, content):
         prompt = self.__prompts.RecallThemeExtraction.get_prompt(content)
         temperature = self.__prompts.ThemeExtraction.temperature
         response_tokens = self.__prompts.ThemeExtraction.response_tokens
 
         message = [self.compose_gpt_message(prompt,'user')]
-        response, tokens = gpt_completion(message, temperature, response_tokens)
-        return response
+        themes_obj, response, tokens = gpt_structured_completion(message, self.__prompts.RecallThemeExtraction.response_schema, temperature, response_tokens, prompt_type='RecallThemeExtraction')
+        return themes_obj['themes']
 
-    ## Ensure the theme extraction has been cleaned up
+    ## Ensure the theme extraction has been cleaned up. Returns the list of themes and whether there was an error.
     def cleanup_theme_response(self, themes):
-        has_error = True
         if type(themes) == list:
-                has_error = False
-                return themes, has_error
-        themes_obj = {}
+            return themes, False
         try:
-            themes_obj = json.loads(themes)
-        except Exception as err:
-            print('ERROR: unable to parse the json object when extracting themes')
-            print('Value from GPT:\n\n%s' % themes)
-            breakpoint('\n\npausing...')
-            return [], has_error
-
-        dict_keys = list(themes_obj.keys())
-        if len(dict_keys) > 1:
-            print('ERROR: unknown response for theme extraction')
-            print('Value from GPT:\n\n%s' % themes)
-            print(themes_obj)
-            breakpoint('\n\npausing...')
-            return [], has_error
-        else:
-            key = dict_keys[0]
-            if type(themes_obj[key]) == list:
-                has_error = False
-                return themes_obj[key], has_error
-            else:
-                print('ERROR: unknown response for theme extraction')
-                print('Value from GPT:\n\n%s' % themes)
-                print(themes_obj)
-                breakpoint('\n\npausing...')
-                return [], has_error
-        return [], has_error
+            themes_obj = parse_structured_response(themes, self.__prompts.ThemeExtraction.response_schema, 'ThemeExtraction')
+        except StructuredOutputError as err:
+            debug_message(f"ERROR: unable to use the theme extraction response ({err})\nValue from GPT:\n\n{themes}", True)
+            return [], True
+        return themes_obj['themes'], False
         
     ## Object used to track theme history. I intend to use this to analyze theme decoherence.
     def generate_theme_history(self, iteration = 0, similarity = 0.0):
-        timestamp = str(time())
+        timestamp = time()
         theme_history_obj = {
             'iteration':iteration,
             'similarity':similarity,
@@ -280,140 +338,184 @@ class ThemeManager:
     ## Thematic Re-Classification
         ## Process of re-classification will be to select from various themes, get a random assortment of memories, get a random variation of memory ranges, and re-theme them. Link strength will need to be updated based on the results. We will calculate the Mediant for new weights. If that is too drastic then we can use a hyperparameter to adjust the rate of correction.
 
-    def retheme(self):
+    ## Retheme up to theme_count random themes. should_continue is asked before each theme (with the number finished so far)
+    ## and ends the run early when it returns False. is_preempted is asked between the model calls of each theme and abandons
+    ## the theme in progress when it returns True. Returns how many themes were attempted and completed.
+    def retheme(self, theme_count = 5, should_continue = None, is_preempted = None):
+        progress = {'themes_attempted': 0, 'themes_completed': 0}
         ## Query all themes; we will choose from this list at random
         all_themes_query = sql_query_by_ids('Themes', 'id')
         if len(all_themes_query) <= 0:
             debug_message('No themes found, skipping retheme.')
-            return
+            return progress
         all_themes = {x["id"]: x for x in all_themes_query}
 
-        ## Get up to between 2 and 5 random themes to begin the process
-        for t in range(0, min(len(all_themes.keys()), 5)):
-            ## Get a random theme from the all_themes_list
-            random_theme_id = random.choice(list(all_themes.keys()))
-            debug_message(f"Retheming of theme {random_theme_id} in process...", self.debug_messages_enabled)
-            random_theme = all_themes[random_theme_id]
-            
-            ## Pre-define some objects to avoid errors
-            memories = {}
-            random_memory = {}
-            random_link = {}
-            ## Limit retry attempts to 4
-            retry = 4
-            attempt = 0
-            done = False
-            while not done:
-                ## Get all link ids associated with the random theme
-                all_theme_links = {x["id"]: x for x in sql_query_by_ids('Theme_Links', 'theme_id', random_theme_id)}
-                ## Choose a link id at random
-                random_link_id = random.choice(list(all_theme_links.keys()))
-                random_link = all_theme_links[random_link_id]
-                if self.__link_is_updateable(random_link):
+        ## Choose distinct random themes to begin the process
+        random_theme_ids = random.sample(list(all_themes.keys()), min(len(all_themes.keys()), int(theme_count)))
+        for random_theme_id in random_theme_ids:
+            if should_continue is not None and not should_continue(progress['themes_completed']):
+                break
+            progress['themes_attempted'] += 1
+            if self.retheme_theme(random_theme_id, is_preempted):
+                progress['themes_completed'] += 1
+        return progress
+
+    ## Re-extract themes from a random run of memories linked to the theme and update their link weights. Returns True if links were updated.
+    ## is_preempted is asked between model calls so a retheme in progress yields as soon as it returns True.
+    def retheme_theme(self, random_theme_id, is_preempted = None):
+        debug_message(f"Retheming of theme {random_theme_id} in process...", self.debug_messages_enabled)
+
+        ## Pre-define some objects to avoid errors
+        memories = {}
+        random_memory = {}
+        random_link = {}
+        ## Limit retry attempts to 4
+        retry = 4
+        attempt = 0
+        done = False
+        while not done:
+            ## Get all link ids associated with the random theme
+            all_theme_links = {x["id"]: x for x in sql_query_by_ids('Theme_Links', 'theme_id', random_theme_id)}
+            if len(all_theme_links) == 0:
+                break
+            ## Choose a link id at random
+            random_link_id = random.choice(list(all_theme_links.keys()))
+            random_link = all_theme_links[random_link_id]
+            if self.__link_is_updateable(random_link):
+                done = True
+            else:
+                attempt += 1
+                ## Reload theme link because the cooldown was updated when it was checked
+                all_theme_links[random_link_id] = (sql_query_by_ids('Theme_Links', 'id', random_link_id))[0]
+                ## Clear out the random_link object in case we don't get an updatable link
+                random_link = {}
+                if attempt > retry:
                     done = True
-                else:
-                    attempt += 1
-                    ## Reload theme link because the cooldown was updated when it was checked
-                    all_theme_links[random_link_id] = (sql_query_by_ids('Theme_Links', 'id', random_link_id))[0]
-                    ## Clear out the random_link object in case we don't get an updatable link
-                    random_link = {}
-                    if attempt > retry:
-                        done = True
-            
-            ## Check to be sure a random link was chosen
-            if 'id' not in random_link:
-                debug_message(f'Unable to get a memory link from theme {random_theme_id}', self.debug_messages_enabled)
-                continue
-            
-            random_memory_id = random_link['memory_id']
-            random_memory = (sql_query_by_ids('Memories', 'id', random_memory_id))[0]
-            ## Keep track of all memories set to be rethemed
-            random_memory_set = {}
-            random_memory_set[random_memory_id] = random_memory
-
-            ## Get a random bool and set the search direction
-            coin_toss = bool(random.getrandbits(1))
-            if coin_toss:
+        
+        ## Check to be sure a random link was chosen
+        if 'id' not in random_link:
+            debug_message(f'Unable to get a memory link from theme {random_theme_id}', self.debug_messages_enabled)
+            return False
+        
+        random_memory_id = random_link['memory_id']
+        random_memory = (sql_query_by_ids('Memories', 'id', random_memory_id))[0]
+        ## Keep track of all memories set to be rethemed
+        random_memory_set = {}
+        random_memory_set[random_memory_id] = random_memory
+
+        ## Get a random bool and set the search direction
+        coin_toss = bool(random.getrandbits(1))
+        if coin_toss:
+            search_direction = 'next_sibling_id'
+        else:
+            search_direction = 'past_sibling_id'
+        
+        ## If that direction ends early then reverse the direction
+        if random_memory[search_direction] is None:
+            if not coin_toss:
                 search_direction = 'next_sibling_id'
             else:
-                search_direction = 'past_sibling_id'
-            
-            ## If that direction ends early then reverse the direction
-            if random_memory[search_direction] is None:
-                if not coin_toss:
-                    search_direction = 'next_sibling_id'
+                search_direction = 'past_sibling_id'    
+
+        ## Get up to 2 or 5 memories in the randomly chosen search direction:
+        for i in range(random.randint(2, 5)):
+            sibling_memory_id = random_memory[search_direction]
+            ## If there are no remaining sibling memories then exit
+            if sibling_memory_id is None:
+                break
+            ## Load sibling memory and add it to the set of memories to be rethemed
+            random_memory = (sql_query_by_ids('Memories', 'id', sibling_memory_id))[0]
+            random_memory_set[sibling_memory_id] = random_memory
+
+        if len(random_memory_set) <= 1:
+            debug_message('Not enough memories found. Skipping retheme.', self.debug_messages_enabled)
+            return False
+
+        ## Sort the list of memories from oldest to most recent
+        random_memory_set = dict(sorted(random_memory_set.items(), key=lambda x: x[1]["created_on"], reverse=True))
+        random_memory_keys = list(random_memory_set.keys())
+
+        ## Concatenate the content from each of the memories and retheme
+        contents = []
+        content_tokens = 0
+        for m in random_memory_keys:
+            contents.append(random_memory_set[m]['summary'])
+        content = '\n'.join(contents)
+        ## Extract the themes from the content
+        if is_preempted is not None and is_preempted():
+            return False
+        try:
+            theme_plan = self.plan_themes(content, is_preempted=is_preempted)
+        except StructuredOutputError as err:
+            debug_message(f"There was a thematic extraction error: {err}", True)
+            return False
+        if theme_plan is None or (is_preempted is not None and is_preempted()):
+            debug_message(f"Retheming of theme {random_theme_id} preempted.", self.debug_messages_enabled)
+            return False
+        with sql_transaction() as sqldb:
+            retheme_results = self.apply_themes(sqldb, theme_plan)
+        rethemes_keys = list(retheme_results.keys())
+        ## Get all of the theme items so we can update the record with new links if needed
+        rethemes = sql_query_by_ids('Themes','id',rethemes_keys)
+
+        ## Begin rethemeing process
+        for memory_id in random_memory_keys:
+            for retheme_id in rethemes_keys:
+                ## Query all existing existing links for this theme and get the associated memory ids
+                existing_memory_links = {x['memory_id']: x['id'] for x in sql_query_by_ids('Theme_Links', 'theme_id', retheme_id)}
+                ## Make sure the recurrence is at least 1
+                recurrence = retheme_results[retheme_id]['recurrence']
+                if recurrence <= 0:
+                    recurrence = 1
+                if retheme_results[retheme_id]['new_theme'] or memory_id not in existing_memory_links:
+                    ## If the theme is new or was never linked to this memory, create a new theme link record
+                    timestamp = time()
+                    new_theme_id = str(uuid4())
+                    new_theme = self.create_theme_link_object(
+                        id=new_theme_id,
+                        depth=int(random_memory_set[memory_id]['depth']),
+                        memory_id=memory_id,
+                        theme_id=retheme_id,
+                        recurrence=recurrence,
+                        cooldown=2,
+                        created_on=timestamp,
+                        modified_on=timestamp
+                    )
+                    ## Insert new theme link record
+                    sql_insert_row('Theme_Links','id',new_theme)
                 else:
-                    search_direction = 'past_sibling_id'    
-
-            ## Get up to 2 or 5 memories in the randomly chosen search direction:
-            for i in range(random.randint(2, 5)):
-                sibling_memory_id = random_memory[search_direction]
-                ## If there are no remaining sibling memories then exit
-                if sibling_memory_id is None:
-                    break
-                ## Load sibling memory and add it to the set of memories to be rethemed
-                random_memory_set[sibling_memory_id] = (sql_query_by_ids('Memories', 'id', sibling_memory_id))[0]
-
-            if len(random_memory_set) <= 1:
-                debug_message('Not enough memories found. Skipping retheme.', self.debug_messages_enabled)
-                continue
-
-            ## Sort the list of memories from oldest to most recent
-            random_memory_set = dict(sorted(random_memory_set.items(), key=lambda x: x[1]["created_on"], reverse=True))
-            random_memory_keys = list(random_memory_set.keys())
-
-            ## Concatenate the content from each of the memories and retheme
-            contents = []
-            content_tokens = 0
-            for m in random_memory_keys:
-                contents.append(random_memory_set[m]['summary'])
-            content = '\n'.join(contents)
-            ## Extract the themes from the content
-            retheme_results = self.extract_themes(content)
-            rethemes_keys = list(retheme_results.keys())
-            ## Get all of the theme items so we can update the record with new links if needed
-            rethemes = sql_query_by_ids('Themes','id',rethemes_keys)
-
-            ## Begin rethemeing process
-            for memory_id in random_memory_keys:
-                for retheme_id in rethemes_keys:
-                    ## Query all existing existing links for this theme and get the associated memory ids
-                    existing_memory_links = {x['memory_id']: x['id'] for x in sql_query_by_ids('Theme_Links', 'theme_id', retheme_id)}
-                    ## Make sure the recurrence is at least 1
-                    recurrence = retheme_results[retheme_id]['recurrence']
-                    if recurrence <= 0:
-                        recurrence = 1
-                    ## Update the current memory's theme count
-                    random_memory_set[memory_id]['total_themes'] += recurrence
-                    if retheme_results[retheme_id]['new_theme'] or memory_id not in existing_memory_links:
-                        ## If the theme is new or was never linked to this memory, create a new theme link record
-                        timestamp = str(time())
-                        new_theme_id = str(uuid4())
-                        new_theme = self.create_theme_link_object(
-                            id=new_theme_id,
-                            depth=int(random_memory_set[memory_id]['depth']),
-                            memory_id=memory_id,
-                            theme_id=retheme_id,
-                            recurrence=recurrence,
-                            cooldown=2,
-                            created_on=timestamp,
-                            modified_on=timestamp
-                        )
-                        ## Insert new theme link record
-                        sql_insert_row('Theme_Links','id',new_theme)
-                    else:
-                        ## Otherwise update the existing theme link record with the new weight
-                        sql_update_row('Theme_Links','id',{'id':existing_memory_links[memory_id],'recurrence':recurrence,'cooldown':2})
-                ## All theme links associated with this memory need to have their weights updated:
-                weight_update_theme_links = sql_query_by_ids('Theme_Links', 'memory_id', memory_id)
-                for wuth in weight_update_theme_links:
-                    if wuth['recurrence'] <= 0:
-                        wuth['recurrence'] = 1
-                    wuth['weight'] = wuth['recurrence']/random_memory_set[memory_id]['total_themes']
-                    sql_update_row('Theme_Links','id', wuth)
-                ## Update memory record with the new total_themes count
-                sql_update_row('Memories', 'id', {'id':memory_id, 'total_themes':random_memory_set[memory_id]['total_themes']})
-        return
+                    ## Otherwise update the existing theme link record with the new weight
+                    sql_update_row('Theme_Links','id',{'id':existing_memory_links[memory_id],'recurrence':recurrence,'cooldown':2})
+        ## All theme links associated with these memories need to have their weights updated, as do the memories' theme totals
+        self.recompute_theme_weights(random_memory_keys)
+        return True
+
+    ## Set each memory's total_themes to the sum of its links' recurrences (at least 1 each) and each link's weight to its share
+    ## of that sum, with one statement for the memories and one for the links. Without memory ids every memory is recomputed.
+    ## Runs on the given transaction, or in one of its own. Returns the number of memories and links which changed.
+    def recompute_theme_weights(self, memory_ids = None, sqldb = None):
+        if sqldb is None:
+            with sql_transaction() as sqldb:
+                return self.recompute_theme_weights(memory_ids, sqldb)
+        if memory_ids is None:
+            memory_filter, params = '', ()
+        else:
+            if type(memory_ids) not in (tuple, list):
+                memory_ids = [memory_ids]
+            memory_filter, params = 'where memory_id in (select value from json_each(?))', (json.dumps(list(memory_ids)),)
+        totals = f"select memory_id, sum(max(recurrence, 1)) as total from Theme_Links {memory_filter} group by memory_id"
+        changed_memories = sqldb.execute(f'''
+            update Memories set total_themes = totals.total, modified_on = ?
+            from ({totals}) as totals
+            where Memories.id = totals.memory_id and Memories.total_themes is not totals.total
+            ''', (time(),) + params).rowcount
+        ## A link's weight only depends on its memory's links so it can be recomputed from the same totals
+        changed_links = sqldb.execute(f'''
+            update Theme_Links set weight = cast(max(Theme_Links.recurrence, 1) as real) / totals.total
+            from ({totals}) as totals
+            where Theme_Links.memory_id = totals.memory_id and Theme_Links.weight is not cast(max(Theme_Links.recurrence, 1) as real) / totals.total
+            ''', params).rowcount
+        return {'memories': changed_memories, 'links': changed_links}
 
     ## If link is on cooldown decrement the cooldown counter, update the link, and return False; otherwise return True
     def __link_is_updateable(self, link):
@@ -438,3 +540,105 @@ class ThemeManager:
         ## Process of thematic searching will be to search for themes of the current conversation, focusing on the last user message, getting a number of top results, getting the memories referenced in those results, and comparing the returned memories to the semantic search results and the theme link strengths. The results of these comparisons will produce several memories which can then be extended to their most recent neighbor for context, affixed with the timestamp, and summarized in contast with the user's message. This recall will then be added as a section in the conversation prompt.
     
 
+
+## Rethemes while the user is away. Each run is limited by model calls, tokens, and wall time, and stops before the next
+## theme as soon as the user becomes active again. Model calls made while retheming use background priority, so a
+## conversation turn which starts mid-theme is admitted ahead of them. Every run is recorded in Retheme_Runs.
+class RethemeScheduler:
+    def __init__(self, theme_manager = None):
+        self.__config = get_config()
+        self.debug_messages_enabled = True
+        self.__themes = theme_manager if theme_manager is not None else ThemeManager()
+        retheme_config = self.__config['retheme']
+        self.__enabled = retheme_config.getboolean('idle_retheme_enabled')
+        self.__idle_seconds = float(retheme_config['idle_seconds'])
+        self.__poll_seconds = float(retheme_config['poll_seconds'])
+        self.__min_seconds_between_runs = float(retheme_config['min_seconds_between_runs'])
+        self.__max_themes = int(retheme_config['max_themes_per_run'])
+        self.__max_llm_calls = int(retheme_config['max_llm_calls_per_run'])
+        self.__max_tokens = int(retheme_config['max_tokens_per_run'])
+        self.__max_seconds = float(retheme_config['max_seconds_per_run'])
+        self.__last_activity = time()
+        self.__last_run_finished = 0.0
+        self.__stop = Event()
+        self.__thread = None
+        ## Metrics of the most recent run
+        self.last_run = {}
+
+    ## Call whenever the user types or a conversation turn starts or ends
+    def notify_activity(self):
+        self.__last_activity = time()
+
+    @property
+    def is_idle(self):
+        return time() - self.__last_activity >= self.__idle_seconds
+
+    def start(self):
+        if not self.__enabled or self.__thread is not None:
+            return
+        self.__stop.clear()
+        self.__thread = Thread(target=self.__run_loop, name='raven-retheme', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread = None
+
+    def __run_loop(self):
+        while not self.__stop.wait(self.__poll_seconds):
+            if self.is_idle and time() - self.__last_run_finished >= self.__min_seconds_between_runs:
+                try:
+                    with telemetry_stage('retheme'):
+                        self.run_once()
+                except Exception as err:
+                    debug_message(f"Idle retheme failed: {err}", True)
+                self.__last_run_finished = time()
+
+    ## Retheme until the work is done, a budget runs out, or the user comes back
+    def run_once(self):
+        started_on = time()
+        starting_usage = self.__themes.usage
+        run = {'stop_reason': 'completed'}
+
+        def within_budget(themes_completed):
+            usage = self.__themes.usage
+            ## Stop early if one more theme at the average cost so far would overrun a budget
+            def projected(spent):
+                return spent + (spent / themes_completed if themes_completed > 0 else 0)
+            if self.__stop.is_set() or not self.is_idle:
+                run['stop_reason'] = 'preempted'
+            elif projected(usage['llm_calls'] - starting_usage['llm_calls']) > self.__max_llm_calls:
+                run['stop_reason'] = 'llm_call_budget'
+            elif projected(usage['tokens'] - starting_usage['tokens']) > self.__max_tokens:
+                run['stop_reason'] = 'token_budget'
+            elif projected(time() - started_on) > self.__max_seconds:
+                run['stop_reason'] = 'time_budget'
+            else:
+                return True
+            return False
+
+        ## The user coming back also abandons the theme in progress, between its model calls
+        def is_preempted():
+            if self.__stop.is_set() or not self.is_idle:
+                run['stop_reason'] = 'preempted'
+                return True
+            return False
+
+        progress = self.__themes.retheme(self.__max_themes, within_budget, is_preempted)
+        finished_on = time()
+        usage = self.__themes.usage
+        self.last_run = create_row_object(
+            table_name='Retheme_Runs',
+            id=str(uuid4()),
+            themes_attempted=progress['themes_attempted'],
+            themes_completed=progress['themes_completed'],
+            llm_calls=usage['llm_calls'] - starting_usage['llm_calls'],
+            tokens=usage['tokens'] - starting_usage['tokens'],
+            elapsed_seconds=finished_on - started_on,
+            stop_reason=run['stop_reason'],
+            started_on=started_on,
+            finished_on=finished_on
+        )
+        sql_insert_row('Retheme_Runs', 'id', self.last_run)
+        debug_message(f"Idle retheme finished ({run['stop_reason']}): {progress['themes_completed']} of {progress['themes_attempted']} themes in {self.last_run['elapsed_seconds']:.1f} seconds.", self.debug_messages_enabled)
+        return self.last_run
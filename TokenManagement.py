@@ -0,0 +1,84 @@
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+import tiktoken
+
+## Counts tokens the same way the model will see them. The encoder is loaded once and counts are remembered
+## by a hash of the content, so the same memory or template is never encoded twice while it stays in the LRU.
+class TokenCounter:
+    def __init__(self, model_name, max_cached_counts = 10000, batch_threads = 4):
+        self.__model_name = model_name
+        self.__max_cached_counts = int(max_cached_counts)
+        self.__batch_threads = int(batch_threads)
+        self.__encoding = None
+        self.__encoding_lock = Lock()
+        self.__counts = OrderedDict()
+        self.__counts_lock = Lock()
+        self.__stats = {'hits': 0, 'misses': 0}
+
+    ## The encoder is loaded on first use; loading it is the slowest part of counting
+    @property
+    def encoding(self):
+        if self.__encoding is None:
+            with self.__encoding_lock:
+                if self.__encoding is None:
+                    self.__encoding = tiktoken.encoding_for_model(self.__model_name)
+        return self.__encoding
+
+    @property
+    def stats(self):
+        with self.__counts_lock:
+            stats = dict(self.__stats)
+            stats['cached_counts'] = len(self.__counts)
+        return stats
+
+    ## Messages are sent with non-ASCII characters removed, so count them the same way
+    def __clean(self, content):
+        return content.encode(encoding='ASCII',errors='ignore').decode()
+
+    def __key(self, content):
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+    def __get_cached(self, key):
+        with self.__counts_lock:
+            if key in self.__counts:
+                self.__counts.move_to_end(key)
+                self.__stats['hits'] += 1
+                return self.__counts[key]
+            self.__stats['misses'] += 1
+            return None
+
+    def __set_cached(self, key, count):
+        with self.__counts_lock:
+            self.__counts[key] = count
+            self.__counts.move_to_end(key)
+            while len(self.__counts) > self.__max_cached_counts:
+                self.__counts.popitem(last=False)
+
+    def count(self, content):
+        key = self.__key(content)
+        count = self.__get_cached(key)
+        if count is None:
+            count = len(self.encoding.encode(self.__clean(content)))
+            self.__set_cached(key, count)
+        return count
+
+    ## Count several texts at once; anything not already cached is encoded in one multi-threaded batch
+    def count_batch(self, contents):
+        keys = [self.__key(c) for c in contents]
+        counts = [self.__get_cached(k) for k in keys]
+        missing = [i for i, c in enumerate(counts) if c is None]
+        if len(missing) > 0:
+            encoded = self.encoding.encode_batch([self.__clean(contents[i]) for i in missing], num_threads=self.__batch_threads)
+            for i, tokens in zip(missing, encoded):
+                counts[i] = len(tokens)
+                self.__set_cached(keys[i], counts[i])
+        return counts
+
+    ## Cut the content down to at most max_tokens tokens
+    def truncate(self, content, max_tokens):
+        max_tokens = max(0, int(max_tokens))
+        tokens = self.encoding.encode(self.__clean(content))
+        if len(tokens) <= max_tokens:
+            return content
+        return self.encoding.decode(tokens[:max_tokens])
@@ -5,11 +5,17 @@ import glob
 from time import time,sleep
 import datetime
 from uuid import uuid4
-import pinecone
-import tiktoken
 import re
-import openai
 import sqlite3
+import asyncio
+from contextlib import contextmanager
+from CacheManagement import ResponseCache, SingleFlight
+from ArchiveManagement import MemoryArchive
+from TokenManagement import TokenCounter
+from ProviderManagement import create_llm_provider, create_vector_store
+from RequestScheduling import RequestScheduler, Deadline, current_deadline, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from TelemetryManagement import Telemetry, telemetry_stage, current_turn_id
+from ResponseParsing import StructuredOutputError, parse_structured_response
 _raven_update_debug = None
 
 #####################################################
@@ -40,10 +46,37 @@ config = configparser.ConfigParser()
 config.read('config.ini')
 enable_all_debug_message = False
 
-openai.api_key = open_file(config['open_ai']['api_key'])
 pinecone_indexing_enabled = config.getboolean('pinecone', 'pinecone_indexing_enabled')
-pinecone.init(api_key=open_file(config['pinecone']['api_key']), environment=config['pinecone']['environment'])
-vector_db = pinecone.Index(config['pinecone']['index'])
+## API keys are read when a provider which needs them is created, see the [provider] section of config.ini
+llm_provider = create_llm_provider(config)
+vector_db = create_vector_store(config)
+## The rate limits and response cache are OpenAI's; the local stub skips them unless the [provider] section asks for them
+llm_is_stub = config['provider']['llm_provider'] == 'local_stub'
+rate_limits_enabled = not llm_is_stub or config.getboolean('provider', 'stub_rate_limits_enabled')
+response_cache = ResponseCache(
+    config['database']['database_name'],
+    config['response_cache']['ttl_seconds'],
+    config['response_cache']['max_entries'],
+    config.getboolean('response_cache', 'response_cache_enabled') and (not llm_is_stub or config.getboolean('provider', 'stub_response_cache_enabled')))
+request_scheduler = RequestScheduler(
+    config['rate_limits']['requests_per_minute'] if rate_limits_enabled else 0,
+    config['rate_limits']['tokens_per_minute'] if rate_limits_enabled else 0,
+    config['rate_limits']['max_retry'],
+    config['rate_limits']['backoff_base_seconds'],
+    config['rate_limits']['backoff_max_seconds'])
+telemetry = Telemetry(
+    config['database']['database_name'],
+    config.getboolean('telemetry', 'telemetry_enabled'),
+    config['telemetry']['flush_size'],
+    config['telemetry']['completion_cost_per_1k_tokens'],
+    config['telemetry']['embedding_cost_per_1k_tokens'])
+memory_archive = MemoryArchive(
+    config['archive']['archive_dir'],
+    float(config['archive']['segment_max_megabytes']) * 1024 * 1024,
+    config['archive']['read_cache_size'])
+## Identical embeddings and deterministic completions requested at the same time share one call
+embedding_flights = SingleFlight()
+completion_flights = SingleFlight()
 
 def get_config():
     return config
@@ -77,55 +110,186 @@ def timestamp_to_detailed_datetime(unix_time):
 
 #####################################################
                 ## TikToken ##
+## TODO: TikToken doesn't know about the new model names, so the tokenizer model is set separately in config.ini.
+token_counter = TokenCounter(
+    config['tokens']['tokenizer_model'],
+    config['tokens']['max_cached_counts'],
+    config['tokens']['batch_threads'])
+
 def get_token_estimate(content):
-    content = content.encode(encoding='ASCII',errors='ignore').decode()
-    # encoding = tiktoken.encoding_for_model(str(config['open_ai']['model']))
-    ## TODO: TikToken doesn't know about the new model names, will need to hard code for now.
-    encoding = tiktoken.encoding_for_model('gpt-3.5-turbo-0301')
-    tokens = encoding.encode(content)
-    token_count = len(tokens)
-    return token_count
+    return token_counter.count(content)
+
+## Count several texts at once; faster than counting them one at a time when most are new
+def get_token_estimates(contents):
+    return token_counter.count_batch(list(contents))
+
+def truncate_to_token_limit(content, max_tokens):
+    return token_counter.truncate(content, max_tokens)
 
 #####################################################
                 ## OpenAI ##
-def gpt3_embedding(content):
-    engine = config['open_ai']['input_engine']
+## All OpenAI calls go through the shared request scheduler. Pass priority=PRIORITY_BACKGROUND for work the user is not waiting on.
+## Concurrent requests to embed the same text share one call
+def gpt3_embedding(content, priority = PRIORITY_INTERACTIVE):
     content = content.encode(encoding='ASCII',errors='ignore').decode()
-    response = openai.Embedding.create(input=content,engine=engine)
-    vector = response['data'][0]['embedding']
+    estimated_tokens = get_token_estimate(content)
+    with telemetry.span('embedding', 'embedding') as span:
+        span['model'] = llm_provider.embedding_model_name
+        def request():
+            response = request_scheduler.execute(
+                lambda: llm_provider.embedding(content),
+                priority, estimated_tokens, 'embedding', span)
+            request_scheduler.record_usage(estimated_tokens, response['usage']['total_tokens'] if 'usage' in response else None)
+            span['tokens'] = response['usage']['total_tokens'] if 'usage' in response else estimated_tokens
+            return response['data'][0]['embedding']
+        vector, shared = embedding_flights.do(content, request)
+        span['cache_hit'] = shared
     return vector
 
-def gpt_completion(messages, temp=0.0, tokens=400, stop=['USER:', 'RAVEN:'], print_response = False):
-    engine = config['open_ai']['model']
+## gpt3_embedding for asyncio tasks; joins an identical request already in flight from any thread or task
+async def gpt3_embedding_async(content, priority = PRIORITY_INTERACTIVE):
+    content = content.encode(encoding='ASCII',errors='ignore').decode()
+    return await embedding_flights.do_async(content, gpt3_embedding, content, priority)
+
+## Cosine similarity of two embedding vectors
+def cosine_similarity(vector_a, vector_b):
+    dot = sum(a * b for a, b in zip(vector_a, vector_b))
+    norm_a = sum(a * a for a in vector_a) ** 0.5
+    norm_b = sum(b * b for b in vector_b) ** 0.5
+    if norm_a == 0 or norm_b == 0:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+## Estimate the tokens a chat request will use so the scheduler can reserve them: the prompt plus the full response allowance
+def estimate_request_tokens(messages, response_tokens):
+    return sum(get_token_estimates(m['content'] for m in messages)) + int(response_tokens)
+
+## Deterministic (temperature 0) completions are served from the response cache when an identical request was made before
+## The prompt type (the PromptManager prompt name) labels the call in telemetry.
+## Identical deterministic requests made at the same time share one call.
+def gpt_completion(messages, temp=0.0, tokens=400, stop=['USER:', 'RAVEN:'], print_response = False, use_cache = True, priority = PRIORITY_INTERACTIVE, prompt_type = ''):
+    engine = llm_provider.model_name
     top_p=1.0
     freq_pen=0.0
     pres_pen=0.0
 
-    max_retry = 15
-    retry = 0
-    while True:
-        try:
-            response = openai.ChatCompletion.create(
-                model=engine,
-                messages=messages,
-                temperature=temp,
-                max_tokens=tokens,
-                top_p=top_p,
-                frequency_penalty=freq_pen,
-                presence_penalty=pres_pen,
-                stop=stop)
+    with telemetry.span('llm', prompt_type) as span:
+        span['model'] = engine
+        cache_key = None
+        if use_cache and response_cache.is_cacheable(temp):
+            cache_key = response_cache.make_key(engine, messages, temp, tokens, stop)
+            cached_response = response_cache.get(cache_key)
+            if cached_response is not None:
+                debug_message('Using cached response.')
+                span['cache_hit'] = True
+                span['tokens'] = cached_response[1]
+                return cached_response
+
+        estimated_tokens = estimate_request_tokens(messages, tokens)
+        def request():
+            response = request_scheduler.execute(
+                lambda: llm_provider.chat_completion(messages, temp, tokens, stop, top_p, freq_pen, pres_pen),
+                priority, estimated_tokens, 'chat completion', span)
             total_tokens = int(response['usage']['total_tokens'])
-            response_str = response['choices'][0]['message']['content'].strip()
+            request_scheduler.record_usage(estimated_tokens, total_tokens)
             if print_response:
                 print_response_stats(response)
-            return response_str, total_tokens
+            return response['choices'][0]['message']['content'].strip(), total_tokens
+        try:
+            if float(temp) == 0.0:
+                (response_str, total_tokens), shared = completion_flights.do(response_cache.make_key(engine, messages, temp, tokens, stop), request)
+            else:
+                (response_str, total_tokens), shared = request(), False
         except Exception as oops:
-            retry += 1
-            debug_message(f"Didn't get a response from OpenAI, trying again in {2*retry} seconds...")
-            if retry >= max_retry:
-                return "GPT3.5 error: %s" % oops, -1
             print('Error communicating with OpenAI:', oops)
-            sleep(2*retry)
+            span['success'] = False
+            return "GPT3.5 error: %s" % oops, -1
+        span['cache_hit'] = shared
+        span['tokens'] = total_tokens
+    if cache_key is not None and not shared:
+        response_cache.put(cache_key, engine, response_str, total_tokens)
+    return response_str, total_tokens
+
+## gpt_completion for asyncio tasks; joins an identical deterministic request already in flight from any thread or task
+async def gpt_completion_async(messages, temp=0.0, tokens=400, stop=['USER:', 'RAVEN:'], use_cache = True, priority = PRIORITY_INTERACTIVE, prompt_type = ''):
+    arguments = (messages, temp, tokens, stop, False, use_cache, priority, prompt_type)
+    if float(temp) != 0.0:
+        return await asyncio.to_thread(gpt_completion, *arguments)
+    try:
+        return await completion_flights.do_async(response_cache.make_key(llm_provider.model_name, messages, temp, tokens, stop), gpt_completion, *arguments)
+    except Exception as oops:
+        return "GPT3.5 error: %s" % oops, -1
+
+## Ask for a response matching a JSON schema and return (parsed object, raw response, total tokens). A response which does not
+## parse or match the schema gets one repair attempt, where the model is shown its response and the problems with it.
+## Raises StructuredOutputError if the repaired response is still unusable, or if the request itself failed.
+def gpt_structured_completion(messages, schema, temp=0.0, tokens=400, stop=['USER:', 'RAVEN:'], priority = PRIORITY_INTERACTIVE, prompt_type = ''):
+    response, total_tokens = gpt_completion(messages, temp, tokens, stop, priority=priority, prompt_type=prompt_type)
+    if total_tokens < 0:
+        raise StructuredOutputError(response, prompt_type, response)
+    try:
+        return parse_structured_response(response, schema, prompt_type), response, total_tokens
+    except StructuredOutputError as err:
+        debug_message(f"Unable to use the {prompt_type} response ({err}), asking for a repair...", True)
+        ## Never serve the unusable response from the cache again
+        if response_cache.is_cacheable(temp):
+            response_cache.discard(response_cache.make_key(llm_provider.model_name, messages, temp, tokens, stop))
+        repair_messages = list(messages) + [
+            compose_gpt_message(response, 'assistant'),
+            compose_gpt_message(f"That response could not be used: {err}. Respond again with only JSON which conforms to this schema:\n{json.dumps(schema)}", 'user')]
+    repair_response, repair_tokens = gpt_completion(repair_messages, 0.0, tokens, stop, priority=priority, prompt_type=prompt_type)
+    if repair_tokens < 0:
+        raise StructuredOutputError(repair_response, prompt_type, repair_response)
+    return parse_structured_response(repair_response, schema, prompt_type), repair_response, total_tokens + repair_tokens
+
+## Stream a chat completion, yielding the response text as it arrives. Retries only happen before the first delta is received.
+## Telemetry records the whole stream as one call, from the request until the last delta
+## Streams do not report usage, so the tokens recorded are the prompt's plus the tokens counted in the streamed deltas
+def gpt_completion_stream(messages, temp=0.0, tokens=400, stop=['USER:', 'RAVEN:'], priority = PRIORITY_INTERACTIVE, prompt_type = ''):
+    top_p=1.0
+    freq_pen=0.0
+    pres_pen=0.0
+
+    estimated_tokens = estimate_request_tokens(messages, tokens)
+    prompt_tokens = estimated_tokens - int(tokens)
+    deltas = []
+    retry = 0
+    start_time = time()
+    def record_stream(success):
+        total_tokens = None
+        if len(deltas) > 0:
+            total_tokens = prompt_tokens + get_token_estimate(''.join(deltas))
+            request_scheduler.record_usage(estimated_tokens, total_tokens)
+        telemetry.record('llm', prompt_type, (time() - start_time) * 1000.0, model=llm_provider.model_name, tokens=total_tokens, retries=retry, success=success)
+    while True:
+        received_delta = False
+        request_scheduler.acquire(priority, estimated_tokens)
+        try:
+            for delta in llm_provider.chat_completion_stream(messages, temp, tokens, stop, top_p, freq_pen, pres_pen):
+                received_delta = True
+                deltas.append(delta)
+                yield delta
+            record_stream(True)
+            return
+        except Exception as oops:
+            ## Once part of the response has been shown it cannot be taken back, so stop here
+            if received_delta:
+                print('Error while streaming from OpenAI:', oops)
+                record_stream(False)
+                return
+            retry += 1
+            if not request_scheduler.is_retryable(oops) or retry > request_scheduler.max_retry:
+                record_stream(False)
+                yield "GPT3.5 error: %s" % oops
+                return
+            delay = request_scheduler.get_retry_delay(oops, retry)
+            deadline = current_deadline()
+            if deadline is not None and delay >= deadline.remaining():
+                record_stream(False)
+                yield "GPT3.5 error: %s" % oops
+                return
+            print(f"Error communicating with OpenAI ({oops}), trying again in {delay:.1f} seconds...")
+            sleep(delay)
 
 def print_response_stats(response):
     response_id = ('\nResponse %s' % str(response['id']))
@@ -157,6 +321,7 @@ def debug_message(message, display_debug = False):
 #####################################################
                 ## Pinecone ##
 
+@telemetry.traced('vector', 'query')
 def query_pinecone(vector, return_n, namespace = "", search_all = False):
     if search_all:
         results = vector_db.query(vector=vector, top_k=return_n)
@@ -172,11 +337,13 @@ def disable_pinecone_indexing():
     global pinecone_indexing_enabled 
     pinecone_indexing_enabled = False
 
+@telemetry.traced('vector', 'upsert')
 def save_payload_to_pinecone(payload, namespace):
     if not pinecone_indexing_enabled:
         return
     vector_db.upsert(payload, namespace=namespace)
 
+@telemetry.traced('vector', 'upsert')
 def save_vector_to_pinecone(vector, unique_id, metadata, namespace=""):
     if not pinecone_indexing_enabled:
         return
@@ -186,6 +353,28 @@ def save_vector_to_pinecone(vector, unique_id, metadata, namespace=""):
     payload.append(payload_content)
     vector_db.upsert(payload, namespace=namespace)
 
+## Delete vectors in batches; returns how many ids were sent
+@telemetry.traced('vector', 'delete')
+def delete_pinecone_vectors(ids, namespace = "", batch_size = 1000):
+    if not pinecone_indexing_enabled:
+        return 0
+    ids = list(ids)
+    for start in range(0, len(ids), int(batch_size)):
+        vector_db.delete(ids=ids[start:start + int(batch_size)], namespace=namespace)
+    return len(ids)
+
+## Fetch stored vectors by id in batches; returns {id: {'id', 'values', 'metadata'}} of the ids which were found
+@telemetry.traced('vector', 'fetch')
+def fetch_pinecone_vectors(ids, namespace = "", batch_size = 100):
+    vectors = {}
+    ids = list(ids)
+    for start in range(0, len(ids), int(batch_size)):
+        response = vector_db.fetch(ids=ids[start:start + int(batch_size)], namespace=namespace)
+        for record_id, record in response['vectors'].items():
+            vectors[record_id] = {'id': record_id, 'values': list(record['values']), 'metadata': dict(record.get('metadata', None) or {})}
+    return vectors
+
+@telemetry.traced('vector', 'update')
 def update_pinecone_vector(id, vector, namespace):
     if not pinecone_indexing_enabled:
         return
@@ -243,14 +432,38 @@ def get_table_template(table_name):
     return template
 
 ## Build a row object of a particular table template and populate it with none, some, or all elemnts
+## Rows of tables with a turn_id column (like Prompts) are tagged with the current conversation turn unless one is given
 def create_row_object(table_name, **kwargs):
     row = get_table_template(table_name)
+    if 'turn_id' in row:
+        row['turn_id'] = current_turn_id()
     for key, value in kwargs.items():
         if key in row:
             row[key] = value
     return row
 
+## Archived memories keep a stub row without their content or summary. Fill those back in from the archive, in place,
+## so anything reading Memories rows never has to know a memory was archived. Any row with an id and an empty content or
+## summary column is looked up, so queries do not need to select the archived flag; only the selected columns are filled.
+def fault_in_archived_memories(rows):
+    archived_ids = [row['id'] for row in rows if 'id' in row and row.get('archived', 1) == 1 and any(key in row and row[key] is None for key in ('content', 'summary'))]
+    if len(archived_ids) == 0:
+        return rows
+    sqldb = get_sqldb()
+    locations = {l['memory_id']: l for l in sqldb.execute('select * from Memory_Archive where memory_id in (select value from json_each(?))', (json.dumps(archived_ids),)).fetchall()}
+    sqldb.close()
+    if len(locations) == 0:
+        return rows
+    records = memory_archive.read(locations)
+    for row in rows:
+        if row.get('id') in records:
+            for key in ('content', 'summary'):
+                if key in row:
+                    row[key] = records[row['id']][key]
+    return rows
+
 ## Search a SQL Database table using a list of ids. Leaving ids blank will fetch all records.
+@telemetry.traced('sql')
 def sql_query_by_ids(table_name, key_name, ids=None):
     if type(ids) == str:
         ids = [ids]
@@ -270,9 +483,12 @@ def sql_query_by_ids(table_name, key_name, ids=None):
         rows = cursor.fetchall()
     cursor.close()
     sqldb.close()
+    if table_name == 'Memories':
+        fault_in_archived_memories(rows)
     return rows
 
 ## Take a dictionary representing a row in a table and update all values in that row
+@telemetry.traced('sql')
 def sql_update_row(table_name, primary_key_name, row):
     actual_table_columns = get_table_template(table_name)
     verified_row = {}
@@ -301,8 +517,8 @@ def sql_update_row(table_name, primary_key_name, row):
                     value = json.dumps(value)
                 except json.JSONDecodeError:
                     pass
-            ## Otherwise escape single quotes to avoid issues with the UPDATE statement
-            elif value is not None:
+            ## Escape single quotes (including any inside dumped JSON) to avoid issues with the UPDATE statement
+            if value is not None:
                 try:
                     escaped_val = value.replace("'", "''")
                 except AttributeError:
@@ -332,6 +548,7 @@ def sql_update_row(table_name, primary_key_name, row):
     return update_success
 
 ## Insert a blank new record into the database then update it with the row contents.
+@telemetry.traced('sql')
 def sql_insert_row(table_name, key_name, row):
     sqldb = get_sqldb()
     ## Ensure the row passed 
@@ -364,6 +581,7 @@ def sql_insert_row(table_name, key_name, row):
     return insert_success
 
 ## Remove a record from the database
+@telemetry.traced('sql')
 def sql_delete_row(table_name, key_name, id):
     sqldb = get_sqldb()
     update_sql = f"DELETE FROM {table_name} where {key_name} = '{id}'"
@@ -383,6 +601,7 @@ def sql_delete_row(table_name, key_name, id):
     return update_success
 
 ## Execute simple queries
+@telemetry.traced('sql', 'custom_query')
 def sql_custom_query(query, params = None):
     sqldb = get_sqldb()
     cursor = sqldb.cursor()
@@ -395,4 +614,102 @@ def sql_custom_query(query, params = None):
     results = cursor.fetchall()
     cursor.close()
     sqldb.close()
-    return results
\ No newline at end of file
+    return fault_in_archived_memories(results)
+
+## Run a query and yield its rows a page at a time instead of loading them all. The connection stays open until the pages run out or the generator is closed.
+def sql_query_pages(query, params = None, page_size = 100):
+    sqldb = get_sqldb()
+    cursor = sqldb.cursor()
+    try:
+        if params is not None:
+            if type(params) not in (tuple, list):
+                params = (params,)
+            cursor.execute(query, params)
+        else:
+            cursor.execute(query)
+        while True:
+            page = cursor.fetchmany(int(page_size))
+            if len(page) == 0:
+                break
+            yield fault_in_archived_memories(page)
+    finally:
+        cursor.close()
+        sqldb.close()
+
+## Run several statements on one connection in a single transaction. Commits when the block ends and rolls back if it raises.
+@contextmanager
+def sql_transaction():
+    sqldb = get_sqldb()
+    try:
+        with sqldb:
+            yield sqldb
+    finally:
+        sqldb.close()
+
+## Rebuild the database file so pages freed by deletes are returned to the file system
+def sql_vacuum():
+    sqldb = get_sqldb()
+    sqldb.execute('VACUUM')
+    sqldb.close()
+
+## Execute a statement which changes the database (like a batched update) and return the number of rows changed
+@telemetry.traced('sql', 'execute')
+def sql_execute(query, params = None):
+    sqldb = get_sqldb()
+    cursor = sqldb.cursor()
+    changed_rows = 0
+    try:
+        if params is not None:
+            if type(params) not in (tuple, list):
+                params = (params,)
+            cursor.execute(query, params)
+        else:
+            cursor.execute(query)
+        sqldb.commit()
+        changed_rows = cursor.rowcount
+    except Exception as e:
+        debug_message(f"Execute failed: {str(e)}")
+        sqldb.rollback()
+    cursor.close()
+    sqldb.close()
+    return changed_rows
+
+## Search the full text index of memories. Results are ordered by BM25 rank (lower is more relevant).
+## Given ancestor ids, only memories summarized into one of them are searched.
+@telemetry.traced('sql', 'Memories_FTS')
+def sql_fulltext_search(match_query, depth = 0, limit = 10, ancestor_ids = None):
+    if ancestor_ids is not None:
+        query = """
+        select
+            f.memory_id as id
+            ,bm25(Memories_FTS) as rank
+            ,c.ancestor_id as ancestor_id
+        from
+            Memories_FTS as f
+        join
+            Memory_Closure as c on c.descendant_id = f.memory_id
+        where
+            Memories_FTS match ?
+            and f.depth = ?
+            and c.ancestor_id in (select value from json_each(?))
+        order by
+            rank
+        limit ?
+        """
+        return sql_custom_query(query, (match_query, int(depth), json.dumps(list(ancestor_ids)), int(limit)))
+    query = """
+    select
+        f.memory_id as id
+        ,bm25(Memories_FTS) as rank
+    from
+        Memories_FTS as f
+    join
+        Memories as m on m.rowid = f.rowid
+    where
+        Memories_FTS match ?
+        and f.depth = ?
+    order by
+        rank
+    limit ?
+    """
+    return sql_custom_query(query, (match_query, int(depth), int(limit)))
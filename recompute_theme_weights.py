@@ -0,0 +1,14 @@
+import argparse
+from time import time
+from ThemeManagement import ThemeManager
+
+## Recompute every memory's total_themes and every theme link's weight from the links' recurrences.
+## Only rows whose value changes are written, so running it on a consistent database is quick.
+## Usage: python recompute_theme_weights.py
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recompute all theme totals and theme link weights.')
+    args = parser.parse_args()
+    start = time()
+    changed = ThemeManager().recompute_theme_weights()
+    print(f"Updated {changed['memories']} memories and {changed['links']} theme links in {time() - start:.2f} seconds.")
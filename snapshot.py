@@ -0,0 +1,37 @@
+import sys
+import argparse
+from SnapshotManagement import export_snapshot, import_snapshot, verify_snapshot, SnapshotError
+
+## Export the whole world (every table, the vectors, and the archive segments) to one snapshot file, check one, or load one.
+## Usage: python snapshot.py export raven_snapshot.zip [--exclude Telemetry_Spans] [--no-vectors]
+##        python snapshot.py verify raven_snapshot.zip
+##        python snapshot.py import raven_snapshot.zip [--database raven.sqlite] [--replace] [--no-vectors]
+
+def print_summary(manifest):
+    for table in manifest['tables']:
+        print(f"{table['name']:<28} {table['rows']:>9} rows")
+    for vector_set in manifest['vectors']:
+        print(f"{vector_set['namespace']:<28} {vector_set['count']:>9} vectors")
+    if len(manifest['archive']) > 0:
+        print(f"{'archive':<28} {len(manifest['archive']):>9} segments")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export, verify, or import a snapshot of the whole world.')
+    parser.add_argument('command', choices=['export', 'verify', 'import'])
+    parser.add_argument('snapshot', help='Path of the snapshot file.')
+    parser.add_argument('--exclude', nargs='*', default=[], help='Tables to leave out of an export.')
+    parser.add_argument('--database', default=None, help='Database file to import into; defaults to the one in config.ini.')
+    parser.add_argument('--replace', action='store_true', help='Overwrite an existing database and archive segments on import.')
+    parser.add_argument('--no-vectors', action='store_true', help='Skip the vectors.')
+    args = parser.parse_args()
+    try:
+        if args.command == 'export':
+            manifest = export_snapshot(args.snapshot, not args.no_vectors, args.exclude)
+        elif args.command == 'verify':
+            manifest = verify_snapshot(args.snapshot)
+        else:
+            manifest = import_snapshot(args.snapshot, args.database, args.replace, not args.no_vectors)
+    except SnapshotError as e:
+        print(f"Snapshot {args.command} failed: {str(e)}")
+        sys.exit(1)
+    print_summary(manifest)
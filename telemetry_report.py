@@ -0,0 +1,25 @@
+import sys
+import argparse
+from time import time
+from UtilityFunctions import telemetry
+
+## Print latency percentiles from the Telemetry_Spans table, by pipeline stage, by prompt type, and by kind of call.
+## Usage: python telemetry_report.py [--hours 24]
+
+def print_table(title, group_by, rows):
+    print(f"\n{title}")
+    print(f"{group_by:<28} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'tokens':>9} {'retries':>8} {'cached':>7} {'cost $':>9}")
+    for r in rows:
+        print(f"{str(r[group_by])[:28]:<28} {r['count']:>7} {r['p50_ms']:>10.1f} {r['p95_ms']:>10.1f} {r['p99_ms']:>10.1f} {r['tokens']:>9} {r['retries']:>8} {r['cache_hits']:>7} {r['cost']:>9.4f}")
+    if len(rows) == 0:
+        print('(no spans recorded)')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Latency report of recorded telemetry.')
+    parser.add_argument('--hours', type=float, default=None, help='Only include spans from the last N hours.')
+    args = parser.parse_args()
+    since = None if args.hours is None else time() - args.hours * 3600
+    print_table('Conversation turns', 'kind', telemetry.latency_report('kind', 'turn', since))
+    print_table('By stage (model, embedding, vector, and SQL calls)', 'stage', telemetry.latency_report('stage', None, since, exclude_kind='turn'))
+    print_table('By prompt type', 'name', telemetry.latency_report('name', 'llm', since))
+    print_table('By kind of call', 'kind', telemetry.latency_report('kind', None, since))